@@ -7,6 +7,8 @@
 #include <stdint.h>
 #include <time.h>
 #include <console.h>
+#include <system.h>
+#include <generated/mem.h>
 #include "ci.h"
 
 
@@ -56,6 +58,56 @@ static void mr(unsigned int addr, unsigned int length)
 	dump_bytes(addr, length, (unsigned)addr);
 }
 
+#ifdef CSR_SPIFLASH_ENGINE_COMMAND_ADDR
+/* Commands of the gateware engine, see gateware/spi_flash.py */
+#define SPIFLASH_ENGINE_PROGRAM 1
+#define SPIFLASH_ENGINE_ERASE 2
+
+static void flash_engine_run(unsigned int addr, int command)
+{
+	spiflash_engine_address_write(addr);
+	spiflash_engine_command_write(command);
+	while(spiflash_engine_busy_read());
+	/* The caches may still hold the old flash contents. */
+#ifdef CSR_SPIFLASH_CACHE_BASE
+	spiflash_cache_invalidate_write(1);
+#endif
+	flush_cpu_dcache();
+}
+
+void flash_erase_sector(unsigned int addr)
+{
+	flash_engine_run(addr, SPIFLASH_ENGINE_ERASE);
+}
+
+int flash_program_page(unsigned int addr, const unsigned char *data, unsigned int len)
+{
+	/* Writes to the flash window fill the page buffer of the engine. */
+	volatile unsigned char *buffer = (unsigned char *)SPIFLASH_BASE;
+	unsigned int i;
+
+	if(len == 0 || len > SPIFLASH_PAGE_SIZE)
+		return -1;
+	if((addr % SPIFLASH_PAGE_SIZE) + len > SPIFLASH_PAGE_SIZE)
+		return -1;
+	for(i = 0; i < len; i++)
+		buffer[i] = data[i];
+	spiflash_engine_length_write(len);
+	flash_engine_run(addr, SPIFLASH_ENGINE_PROGRAM);
+	return 0;
+}
+#endif
+
+#ifdef CSR_SPIFLASH_READ_MODE_ADDR
+void flash_read_mode(int mode)
+{
+	/* The gateware switches the flash to and from QPI itself, before the
+	 * next read. */
+	spiflash_read_mode_write(mode);
+	flush_cpu_dcache();
+}
+#endif
+
 void flash_test(void) {
 	printf("flash_test\n");
 	mr(0x20000000, test_size);
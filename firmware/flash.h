@@ -3,4 +3,18 @@
 
 void flash_test(void);
 
+#ifdef CSR_SPIFLASH_ENGINE_COMMAND_ADDR
+void flash_erase_sector(unsigned int addr);
+int flash_program_page(unsigned int addr, const unsigned char *data, unsigned int len);
+#endif
+
+#ifdef CSR_SPIFLASH_READ_MODE_ADDR
+/* Values of the read_mode CSR, see gateware/spi_flash.py */
+#define SPIFLASH_READ_SPI 0
+#define SPIFLASH_READ_QPI 1
+#define SPIFLASH_READ_DTR 2
+
+void flash_read_mode(int mode);
+#endif
+
 #endif /* __FLASH_H */
@@ -0,0 +1,84 @@
+/*
+ * LZ4 block decompression, see
+ * https://github.com/lz4/lz4/blob/dev/doc/lz4_Block_format.md
+ *
+ * Both functions run from sram (.ramtext) and must not call anything in
+ * main_ram, it is overwritten while they run.
+ */
+
+#include "lz4.h"
+
+static const unsigned int crc_table[16] __attribute__((section(".ramdata"))) = {
+	0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
+	0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
+	0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
+	0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c,
+};
+
+/* Same CRC32 as zlib.crc32, a nibble at a time to keep the table small. */
+unsigned int lz4_crc32(const unsigned char *data, unsigned int len)
+{
+	unsigned int crc = 0xffffffff;
+
+	while(len--) {
+		crc ^= *data++;
+		crc = (crc >> 4) ^ crc_table[crc & 0xf];
+		crc = (crc >> 4) ^ crc_table[crc & 0xf];
+	}
+	return ~crc;
+}
+
+int lz4_decompress(const unsigned char *src, unsigned int src_len,
+	unsigned char *dst, unsigned int dst_len)
+{
+	const unsigned char *src_end = src + src_len;
+	unsigned char *out = dst;
+	unsigned char *out_end = dst + dst_len;
+	const unsigned char *match;
+	unsigned int token, length, offset, b;
+
+	while(src < src_end) {
+		token = *src++;
+
+		length = token >> 4;
+		if(length == 15) {
+			do {
+				if(src >= src_end)
+					return -1;
+				b = *src++;
+				length += b;
+			} while(b == 255);
+		}
+		if(length > (unsigned int)(src_end - src) || length > (unsigned int)(out_end - out))
+			return -1;
+		while(length--)
+			*out++ = *src++;
+		if(src >= src_end)
+			break;
+
+		if(src_end - src < 2)
+			return -1;
+		offset = src[0] | (src[1] << 8);
+		src += 2;
+		if(offset == 0 || offset > (unsigned int)(out - dst))
+			return -1;
+
+		length = token & 0xf;
+		if(length == 15) {
+			do {
+				if(src >= src_end)
+					return -1;
+				b = *src++;
+				length += b;
+			} while(b == 255);
+		}
+		length += 4;
+		if(length > (unsigned int)(out_end - out))
+			return -1;
+		/* Byte at a time, the match may overlap the output. */
+		match = out - offset;
+		while(length--)
+			*out++ = *match++;
+	}
+	return out - dst;
+}
@@ -0,0 +1,11 @@
+#ifndef __LZ4_H
+#define __LZ4_H
+
+#define RAMTEXT __attribute__((section(".ramtext"), noinline))
+
+/* Returns the number of bytes written to dst, or -1 if src is corrupt. */
+int lz4_decompress(const unsigned char *src, unsigned int src_len,
+	unsigned char *dst, unsigned int dst_len) RAMTEXT;
+unsigned int lz4_crc32(const unsigned char *data, unsigned int len) RAMTEXT;
+
+#endif /* __LZ4_H */
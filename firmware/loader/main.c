@@ -0,0 +1,234 @@
+/*
+ * Boots a firmware image stored in the flash behind this loader, either
+ *
+ *   loader .fbi | padding to 4 bytes | compressed firmware (see tools/lz4.py)
+ *
+ * from mkimage.py --compress-firmware, or
+ *
+ *   loader .fbi | padding to 4 bytes | "FWAB" record
+ *
+ * from mkimage.py --firmware-slots, where the newest valid of two firmware
+ * slots is booted (see tools/firmware_slots.py).
+ *
+ * The BIOS boots this loader from FLASH_BOOT_ADDRESS like any other firmware
+ * (copying it to MAIN_RAM_BASE).
+ */
+
+#include <stdio.h>
+#include <string.h>
+
+#include <irq.h>
+#include <uart.h>
+#include <system.h>
+#include <generated/csr.h>
+#include <generated/mem.h>
+
+#include "lz4.h"
+
+#define FWLZ_HEADER_SIZE 20
+
+#define SLOT_COUNT 2
+#define SLOT_HEADER_SIZE 24
+#define SLOT_FORMAT_VERSION 1
+#define SLOT_MAX_BLOCKS ((4096 - SLOT_HEADER_SIZE - 4) / 4)
+
+#define NOINIT_MAGIC 0x46574142
+
+extern void boot_helper(unsigned int r1, unsigned int r2, unsigned int r3, unsigned int addr);
+
+extern unsigned int _framtext, _eramtext, _framtext_load;
+
+/* The slots which failed to load, kept when the loader restarts itself. */
+static unsigned int noinit_magic __attribute__((section(".noinit")));
+static unsigned int failed_slots __attribute__((section(".noinit")));
+
+struct image {
+	const unsigned char *data;
+	unsigned int length;
+	/* Compressed images */
+	unsigned int size;
+	unsigned int crc;
+	/* Slots, the CRC of each block_size bytes of data */
+	int slot;
+	const unsigned char *crcs;
+	unsigned int block_size;
+	unsigned int loader_len;
+};
+
+/* Called through pointers, sram is out of range of a relative call. */
+static unsigned int (* volatile crc32)(const unsigned char *, unsigned int);
+static void (* volatile boot)(const struct image *);
+
+void isr(void);
+void isr(void)
+{
+}
+
+/* Used from main_ram and sram, so always inlined. */
+static inline __attribute__((always_inline)) unsigned int read_be32(const unsigned char *p)
+{
+	return (p[0] << 24) | (p[1] << 16) | (p[2] << 8) | p[3];
+}
+
+static void RAMTEXT __attribute__((noreturn)) load_and_boot(const struct image *image)
+{
+	unsigned char *dst = (unsigned char *)MAIN_RAM_BASE;
+	const unsigned char *src;
+	unsigned int i, n, offset;
+	int ok = 1;
+
+	/* Nothing can be printed from here, the console code is overwritten. */
+	if(image->size) {
+		ok = lz4_decompress(image->data, image->length, dst, image->size) == image->size &&
+			lz4_crc32(dst, image->size) == image->crc;
+	} else {
+		for(i = 0, offset = 0; offset < image->length; i++, offset += n) {
+			n = image->length - offset;
+			if(n > image->block_size)
+				n = image->block_size;
+			src = image->data + offset;
+			while(src < image->data + offset + n)
+				*dst++ = *src++;
+			if(lz4_crc32(dst - n, n) != read_be32(image->crcs + 4*i)) {
+				ok = 0;
+				break;
+			}
+		}
+	}
+
+	if(ok) {
+		noinit_magic = 0;
+		flush_cpu_icache();
+		boot_helper(0, 0, 0, MAIN_RAM_BASE);
+	}
+
+	if(image->slot >= 0) {
+		/* Put the loader back and start it again, to try the other slot. */
+		failed_slots |= 1 << image->slot;
+		dst = (unsigned char *)MAIN_RAM_BASE;
+		src = (const unsigned char *)FLASH_BOOT_ADDRESS + 8;
+		for(n = 0; n < image->loader_len; n++)
+			*dst++ = *src++;
+		flush_cpu_icache();
+		boot_helper(0, 0, 0, MAIN_RAM_BASE);
+	}
+	while(1);
+}
+
+static unsigned int read_slot(const unsigned char *record, int slot, unsigned int loader_len, struct image *image)
+{
+	const unsigned char *header = (const unsigned char *)FLASH_BOOT_ADDRESS + read_be32(record + 4 + 8*slot);
+	unsigned int length, block_size, count;
+
+	if(memcmp(header, "FWSL", 4) != 0)
+		return 0;
+	if(((header[4] << 8) | header[5]) != SLOT_FORMAT_VERSION || ((header[6] << 8) | header[7]) != slot)
+		return 0;
+	length = read_be32(header + 12);
+	block_size = read_be32(header + 16);
+	count = read_be32(header + 20);
+	if(block_size == 0 || count > SLOT_MAX_BLOCKS || count != (length + block_size - 1) / block_size)
+		return 0;
+	if(crc32(header, SLOT_HEADER_SIZE + 4*count) != read_be32(header + SLOT_HEADER_SIZE + 4*count))
+		return 0;
+
+	image->data = (const unsigned char *)FLASH_BOOT_ADDRESS + read_be32(record + 8 + 8*slot);
+	image->length = length;
+	image->size = 0;
+	image->crc = 0;
+	image->slot = slot;
+	image->crcs = header + SLOT_HEADER_SIZE;
+	image->block_size = block_size;
+	image->loader_len = loader_len;
+	if(memcmp(image->data, "FWLZ", 4) == 0) {
+		image->size = read_be32(image->data + 4);
+		image->crc = read_be32(image->data + 12);
+		image->length = read_be32(image->data + 8);
+		image->data += FWLZ_HEADER_SIZE;
+	}
+	return read_be32(header + 8);
+}
+
+int main(void)
+{
+	const unsigned char *p;
+	unsigned int loader_len;
+	struct image image, slots[SLOT_COUNT];
+	unsigned int sequence[SLOT_COUNT];
+	int slot, best;
+
+	irq_setmask(0);
+	irq_setie(0);
+	uart_init();
+
+	/* Nothing has run from sram yet, so the icache has no stale lines for it. */
+	memcpy(&_framtext, &_framtext_load, (char *)&_eramtext - (char *)&_framtext);
+	crc32 = lz4_crc32;
+	boot = load_and_boot;
+
+	if(noinit_magic != NOINIT_MAGIC) {
+		noinit_magic = NOINIT_MAGIC;
+		failed_slots = 0;
+	}
+
+	loader_len = *(unsigned int *)FLASH_BOOT_ADDRESS;
+	p = (const unsigned char *)FLASH_BOOT_ADDRESS + 8 + ((loader_len + 3) & ~3);
+
+	if(memcmp(p, "FWAB", 4) == 0) {
+		for(slot = 0; slot < SLOT_COUNT; slot++) {
+			sequence[slot] = 0;
+			if(failed_slots & (1 << slot))
+				printf("Firmware slot %c failed to load\n", 'A' + slot);
+			else
+				sequence[slot] = read_slot(p, slot, loader_len, &slots[slot]);
+		}
+		while(1) {
+			best = -1;
+			for(slot = 0; slot < SLOT_COUNT; slot++)
+				if(sequence[slot] && (best < 0 || sequence[slot] > sequence[best]))
+					best = slot;
+			if(best < 0) {
+				printf("No valid firmware slot\n");
+				noinit_magic = 0;
+				return 1;
+			}
+			if(slots[best].size > MAIN_RAM_SIZE || slots[best].length > MAIN_RAM_SIZE) {
+				printf("Firmware slot %c doesn't fit in main_ram\n", 'A' + best);
+				sequence[best] = 0;
+				continue;
+			}
+			printf("Booting firmware slot %c (sequence %d, %d bytes%s) at 0x%08x.\n",
+				'A' + best, sequence[best], slots[best].length,
+				slots[best].size ? ", compressed" : "", MAIN_RAM_BASE);
+			uart_sync();
+			boot(&slots[best]);
+		}
+	}
+
+	if(memcmp(p, "FWLZ", 4) != 0) {
+		printf("No compressed firmware at 0x%08x\n", (unsigned int)p);
+		return 1;
+	}
+	image.size = read_be32(p + 4);
+	image.length = read_be32(p + 8);
+	image.crc = read_be32(p + 12);
+	image.data = p + FWLZ_HEADER_SIZE;
+	image.slot = -1;
+
+	printf("Decompressing firmware from 0x%08x (%d -> %d bytes)\n",
+		(unsigned int)image.data, image.length, image.size);
+	if(image.size > MAIN_RAM_SIZE) {
+		printf("Firmware doesn't fit in main_ram (%d bytes)\n", MAIN_RAM_SIZE);
+		return 1;
+	}
+	/* There is nothing to fall back to, check it before main_ram is overwritten. */
+	if(crc32(image.data, image.length) != read_be32(p + 16)) {
+		printf("Compressed firmware CRC failed\n");
+		return 1;
+	}
+
+	printf("Booting program at 0x%08x.\n", MAIN_RAM_BASE);
+	uart_sync();
+	boot(&image);
+	return 0;
+}
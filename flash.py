@@ -2,39 +2,269 @@
 
 import os
 import argparse
+import tempfile
 
 import make
+from tools import daemon
+from tools import firmware_slots
+from tools import flash_engine
+from tools import flash_state
+from tools import lz4
+from tools import region_table
+
+
+def slot_update(args, builddir, manifest, prog):
+    """The writes updating the inactive firmware slot, data first then header."""
+    regions = firmware_slots.layout(manifest["flash"])
+    headers = []
+    for slot in firmware_slots.SLOTS:
+        pos, size = regions["header_" + slot]
+        headers.append(firmware_slots.unpack_header(prog.read(pos, firmware_slots.MAX_HEADER_SIZE)))
+    current = firmware_slots.active(headers)
+    slot, sequence = firmware_slots.next_update(headers)
+    if args.slot != "auto":
+        slot = args.slot
+    if current is not None and firmware_slots.SLOTS[current.slot] == slot:
+        print("Warning: overwriting the firmware slot in use.")
+
+    if args.override_firmware:
+        filename = args.override_firmware
+    else:
+        filename = make.get_firmware(builddir, "flash")
+    assert os.path.exists(filename), "firmware not found at %s" % filename
+    with open(filename, "rb") as f:
+        data = f.read()
+    assert filename.endswith(".fbi"), "Firmware must be a MiSoC .fbi image."
+    data = data[8:]
+    if args.compress_firmware:
+        data = lz4.pack_firmware(data)
+
+    header = firmware_slots.make_header(slot, sequence, data)
+    print("Writing firmware slot {} (sequence {}, {} bytes){}.".format(
+        slot.upper(), sequence, len(data),
+        ", current slot {}".format(firmware_slots.SLOTS[current.slot].upper()) if current else ""))
+    slot_pos, slot_size = regions["slot_" + slot]
+    header_pos, header_size = regions["header_" + slot]
+    return slot, [
+        ("slot " + slot, slot_pos, slot_pos + slot_size + 1, data),
+        ("header " + slot, header_pos, header_pos + header_size + 1,
+         firmware_slots.pack_header(header)),
+    ]
+
+
+def record_slot_headers(args, flash, address_start, data):
+    """Bring the --board-id record of the firmware slot headers in line with
+    data written at address_start by a mode other than slot."""
+    if not args.board_id or not flash["sector_size"] or flash["firmware_offset"] is None:
+        return
+    try:
+        regions = firmware_slots.layout(flash)
+    except AssertionError:
+        # No room for slots in this flash.
+        return
+    file_end = address_start + len(data)
+    for slot in firmware_slots.SLOTS:
+        pos, size = regions["header_" + slot]
+        if file_end <= pos or pos + size <= address_start:
+            continue
+        # The sector holding the header was erased, and maybe written again.
+        header = None
+        if address_start <= pos and pos + firmware_slots.MAX_HEADER_SIZE <= file_end:
+            header = data[pos - address_start:pos - address_start + firmware_slots.MAX_HEADER_SIZE]
+            if firmware_slots.unpack_header(header) is None:
+                header = None
+        flash_state.update_slot_header(args.board_id, slot, header)
+
+
+def table_sector(flash, sector_size):
+    """Start of the flash sector holding the region table, the table ends it."""
+    table_end = region_table.table_offset(flash) + region_table.TABLE_SIZE
+    assert sector_size and table_end % sector_size == 0, (
+        "The region table can only be rewritten if it ends a flash sector.")
+    return table_end - sector_size
+
+
+def table_sector_data(flash, sector, gateware, regions):
+    """The contents of the sector holding the region table, as in the image:
+    the end of the gateware, zeros up to the table, then the table."""
+    table_pos = region_table.table_offset(flash)
+    data = gateware[sector:table_pos]
+    return data + bytes(table_pos - sector - len(data)) + region_table.pack(regions)
+
+
+def region_table_write(args, builddir, flash, sector_size, name, address_start, data):
+    """The (regions, sector, sector data) rewriting the region table of
+    --board-id after data is written at address_start, None if the board has
+    no table."""
+    assert args.board_id or args.ignore_region_table, (
+        "The board may hold a region table, which --mode={} would leave out of date. "
+        "Give --board-id (or $BOARD_ID) to rewrite it, or --ignore-region-table.".format(args.mode))
+    if args.ignore_region_table:
+        return None
+    regions = flash_state.region_table(args.board_id)
+    assert regions is not None, (
+        "Writing the region table of {} was interrupted, flash an image first.".format(args.board_id))
+    if not regions:
+        return None
+
+    sector = table_sector(flash, sector_size)
+    if name == "gateware":
+        gateware = data
+    else:
+        assert address_start + len(data) <= sector or sector + sector_size <= address_start, (
+            "--mode={} writes over the region table.".format(args.mode))
+        # Only the table changes, the end of the gateware has to be known.
+        with open(make.get_gateware(builddir, "flash"), "rb") as f:
+            gateware = f.read()
+        old = table_sector_data(flash, sector, gateware, regions)
+        written = flash_state.load(args.board_id, sector_size).get(sector)
+        assert written == flash_state.sector_hashes(old, sector, sector_size)[sector], (
+            "The gateware on {} isn't the one of this build, the region table can't be "
+            "rewritten. Flash the gateware or an image.".format(args.board_id))
+
+    regions = region_table.update(regions, name, address_start, data)
+    return regions, sector, table_sector_data(flash, sector, gateware, regions)
+
+
+def slot_region_table(args, flash, sector_size, prog, writes):
+    """Update the entries of the slot writes in the region table on the board."""
+    table_pos = region_table.table_offset(flash)
+    regions = region_table.unpack(prog.read(table_pos, region_table.TABLE_SIZE))
+    if regions is None:
+        return
+    for name, address_start, address_end, data in writes:
+        regions = region_table.update(regions, name.replace(" ", "_"), address_start, data)
+    sector = table_sector(flash, sector_size)
+    if args.board_id:
+        flash_state.update_region_table(args.board_id, None)
+        flash_state.invalidate(args.board_id, sector_size, [sector])
+    prog.write(table_pos, region_table.pack(regions))
+    if args.board_id:
+        # Read back, the rest of the sector is whatever was on the flash.
+        flash_state.update(args.board_id, sector_size, flash_state.sector_hashes(
+            prog.read(sector, sector_size), sector, sector_size))
+        flash_state.update_region_table(args.board_id, regions)
+
+
+def connect(args):
+    from litex.soc.tools.remote import RemoteClient
+
+    # The default address of the boards, as in test/common.py.
+    ipaddress = args.ipaddress or "{}.50".format(args.iprange)
+    print("Connecting to {}".format(ipaddress))
+    wb = RemoteClient(ipaddress, 1234, csr_csv=os.path.join(make.get_testdir(args), "csr.csv"))
+    wb.open()
+    return wb
+
+
+def write(args, prog, sector_size, name, address_start, data, filepath=None):
+    """Program data at address_start, only the changed sectors with --delta."""
+    file_end = address_start + len(data)
+    if sector_size and args.board_id:
+        hashes = flash_state.sector_hashes(data, address_start, sector_size)
+    else:
+        hashes = None
+
+    if args.delta:
+        previous = flash_state.load(args.board_id, sector_size)
+        runs = flash_state.changed_runs(hashes, previous, sector_size)
+        changed = sum(end - start for start, end in runs) // sector_size
+        print("{} of {} sectors of the {} changed since {} was last flashed.".format(
+            changed, len(hashes), name, args.board_id))
+        if not runs:
+            return
+    else:
+        runs = [(address_start, file_end)]
+
+    if hashes:
+        flash_state.invalidate(args.board_id, sector_size, hashes)
+    for start, end in runs:
+        start = max(start, address_start)
+        end = min(end, file_end)
+        if filepath and (start, end) == (address_start, file_end):
+            prog.flash(address_start, filepath)
+            continue
+        with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as f:
+            f.write(data[start-address_start:end-address_start])
+        try:
+            print("Flashing 0x{:08x}-0x{:08x}".format(start, end))
+            prog.flash(start, f.name)
+        finally:
+            os.unlink(f.name)
+    if hashes:
+        flash_state.update(args.board_id, sector_size, hashes)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Board flashing tool")
     make.get_args(parser)
 
-    parser.add_argument("--mode", default="image", choices=["image", "gateware", "bios", "firmware", "other"], help="Type of file to flash")
+    parser.add_argument("--mode", default="image", choices=["image", "gateware", "bios", "firmware", "slot", "other", "load"], help="Type of file to flash, slot writes the firmware to the A/B firmware slot not in use over Etherbone (see --firmware-slots and --ipaddress), load loads the gateware into the FPGA without flashing it")
     parser.add_argument("--other-file", default=None)
     parser.add_argument("--address", type=int, help="Where to flash if using --mode=other")
+    parser.add_argument("--board-id", default=os.environ.get("BOARD_ID", None), help="Device DNA or serial number identifying the board, to remember what was flashed on it")
+    parser.add_argument("--programmer-serial", default=os.environ.get("PROG_SERIAL", None), help="Serial number of the programmer to use, when several boards are connected")
+    parser.add_argument("--delta", action="store_true", help="Only program the sectors which changed since the last time --board-id was flashed")
+    parser.add_argument("--slot", default="auto", choices=("auto",) + firmware_slots.SLOTS, help="Firmware slot to write with --mode=slot (default: the one not in use)")
+    parser.add_argument("--ipaddress", default=None, help="Address of the running board (litex_server) --mode=slot programs the flash through (default: IPRANGE.50)")
+    parser.add_argument("--ignore-region-table", action="store_true", help="Write a single region without rewriting the region table, which then no longer matches the flash")
 
     args = parser.parse_args()
+    make.check_args(parser, args)
+    if args.delta and not args.board_id:
+        parser.error("--delta needs --board-id (or $BOARD_ID)")
 
     builddir = make.get_builddir(args)
-    platform = make.get_platform(args)
-    soc = make.get_soc(args, platform)
-    bios_maxsize = make.get_bios_maxsize(args, soc)
+    manifest = make.get_manifest(args)
+    flash = manifest["flash"]
+    gateware_size = flash["gateware_size"]
+    bios_maxsize = flash["bios_maxsize"]
+    spiflash_total_size = flash["total_size"]
+    sector_size = flash["sector_size"]
+    assert sector_size or not args.delta, "--delta needs the flash sector size of the platform."
+
+    if args.mode == 'load':
+        filename = make.get_gateware(builddir, "load")
+        assert os.path.exists(filename), "gateware not found at %s" % filename
+        platform = make.get_platform(args)
+        prog = make.get_prog(args, platform)
+        prog.load_bitstream(filename)
+        return
+
+    if args.mode == 'slot':
+        # Programmed by the flash engine of the gateware, so the board keeps
+        # running the firmware in the other slot.
+        wb = connect(args)
+        try:
+            prog = flash_engine.EngineProgrammer(
+                wb, manifest["memory_regions"]["spiflash"]["origin"], sector_size, flash["page_size"] or 256)
+            slot, writes = slot_update(args, builddir, manifest, prog)
+            if args.board_id:
+                flash_state.update_slot_header(args.board_id, slot, None)
+            for name, address_start, address_end, data in writes:
+                assert address_start + len(data) < address_end, "Firmware doesn't fit in the {}.".format(name)
+                write(args, prog, sector_size, name, address_start, data)
+            if args.board_id:
+                flash_state.update_slot_header(args.board_id, slot, writes[-1][3])
+            slot_region_table(args, flash, sector_size, prog, writes)
+        finally:
+            wb.close()
+        return
 
     if args.mode == 'image':
         filename = make.get_image(builddir, "flash")
         address_start = 0
-        address_end = platform.spiflash_total_size
+        address_end = spiflash_total_size
 
     elif args.mode == 'gateware':
         filename = make.get_gateware(builddir, "flash")
         address_start = 0
-        address_end = platform.gateware_size
+        address_end = gateware_size
 
     elif args.mode == 'bios':
         filename = make.get_bios(builddir, "flash")
-        address_start = platform.gateware_size
-        address_end = platform.gateware_size + bios_maxsize
+        address_start = gateware_size
+        address_end = gateware_size + bios_maxsize
 
     elif args.mode == 'firmware':
         if args.override_firmware:
@@ -42,13 +272,13 @@ def main():
         else:
             filename = make.get_firmware(builddir, "flash")
 
-        address_start = platform.gateware_size + bios_maxsize
-        address_end = platform.spiflash_total_size
+        address_start = gateware_size + bios_maxsize
+        address_end = spiflash_total_size
 
     elif args.mode == 'other':
         filename = args.other_file
         address_start = args.address
-        address_end = platform.spiflash_total_size
+        address_end = spiflash_total_size
 
     else:
         assert False, "Unknown flashing mode."
@@ -59,15 +289,35 @@ def main():
     assert os.path.exists(filepath), "%s not found at %s" % (
             args.mode, filepath)
 
-    file_size = len(open(filepath, 'rb').read())
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    file_size = len(data)
 
     file_end = address_start+file_size
     assert file_end < address_end, "File is too big!\n%s file doesn't fit in %s space (%s extra bytes)." % (
         filename, file_size, address_end - address_start)
 
+    table = None
+    if args.mode != 'image':
+        name = args.mode if args.mode != 'other' else None
+        table = region_table_write(args, builddir, flash, sector_size, name, address_start, data)
+
+    platform = make.get_platform(args)
     prog = make.get_prog(args, platform)
-    prog.flash(address_start, filepath)
+    if args.board_id and (args.mode == 'image' or table):
+        flash_state.update_region_table(args.board_id, None)
+    write(args, prog, sector_size, args.mode, address_start, data, filepath)
+    record_slot_headers(args, flash, address_start, data)
+    if table:
+        regions, sector, sector_data = table
+        write(args, prog, sector_size, "region table", sector, sector_data)
+        flash_state.update_region_table(args.board_id, regions)
+    elif args.board_id and args.mode == 'image':
+        table_pos = region_table.table_offset(flash)
+        regions = region_table.unpack(data[table_pos:table_pos + region_table.TABLE_SIZE])
+        flash_state.update_region_table(args.board_id, regions or [])
 
 
 if __name__ == "__main__":
+    daemon.client("flash")
     main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Flash or load the same build onto several boards at once.
+
+Each board is handled by its own flash.py process (with --board-id and
+--programmer-serial set), the other arguments are passed on to flash.py:
+
+    ./fleet.py --boards opsis1:210311 opsis2:210312 --mode=image
+    ./fleet.py --boards-file rack3.txt --mode=load
+
+Boards are given as NAME[:PROGRAMMER_SERIAL], the name is used as the serial
+when there is no serial. A boards file has one board per line, # starts a
+comment.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import make
+
+
+FLASH_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flash.py")
+
+# OpenOCD prints these when the flash was read back and matched.
+VERIFIED = ("contents match", "verified")
+
+
+class Board:
+    def __init__(self, spec):
+        self.name, _, self.serial = spec.partition(":")
+        self.serial = self.serial or self.name
+        self.result = "pending"
+        self.verified = None
+        self.time = None
+        self.error = None
+
+
+def read_boards_file(filename):
+    boards = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                boards.append(line)
+    return boards
+
+
+def run(board, flash_args, log, output_lock):
+    cmd = [sys.executable, FLASH_PY] + flash_args + [
+        "--board-id", board.name, "--programmer-serial", board.serial]
+    start = time.time()
+    board.result = "running"
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    p = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+        universal_newlines=True, bufsize=1)
+    last = None
+    for line in p.stdout:
+        line = line.rstrip()
+        if line.startswith("Error"):
+            board.error = board.error or line
+        if any(v in line for v in VERIFIED):
+            board.verified = True
+        log.write("{}\n".format(line))
+        with output_lock:
+            print("[{}] {}".format(board.name, line))
+        last = line or last
+    p.wait()
+    board.time = time.time() - start
+    # The litex programmers don't check the exit status of OpenOCD & co, so
+    # their error messages are needed to spot failures.
+    if p.returncode != 0:
+        board.error = board.error or last or "flash.py exited with {}".format(p.returncode)
+    board.result = "failed" if board.error else "ok"
+    return board
+
+
+def report(boards, mode):
+    print()
+    print("{:20} {:12} {:8} {:>8}  {}".format("Board", "Programmer", "Result", "Time", "Verified"))
+    print("-"*60)
+    for board in boards:
+        if board.verified:
+            verified = "yes"
+        elif mode in ("load",) or board.result != "ok":
+            verified = "-"
+        else:
+            verified = "no"
+        print("{:20} {:12} {:8} {:>7.1f}s  {}".format(
+            board.name, board.serial, board.result, board.time or 0, verified))
+        if board.error:
+            print("    {}".format(board.error))
+    failed = sum(board.result != "ok" for board in boards)
+    print("-"*60)
+    print("{} of {} boards ok.".format(len(boards) - failed, len(boards)))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boards", nargs="+", default=[], help="NAME[:PROGRAMMER_SERIAL] of each board")
+    parser.add_argument("--boards-file", help="file listing the boards, one per line")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="boards handled at once (default: all of them)")
+    parser.add_argument("--log-dir", default=None, help="directory for the output of each board (default: <build dir>/fleet)")
+    parser.add_argument("--report", default=None, help="also write the results as JSON to this file")
+    args, flash_args = parser.parse_known_args()
+
+    specs = list(args.boards)
+    if args.boards_file:
+        specs += read_boards_file(args.boards_file)
+    if not specs:
+        parser.error("No boards given, use --boards or --boards-file")
+    boards = [Board(spec) for spec in specs]
+    names = [board.name for board in boards]
+    assert len(set(names)) == len(names), "Board names must be unique."
+
+    # Elaborate once here rather than in every flash.py at the same time.
+    make_parser = argparse.ArgumentParser(add_help=False)
+    make.get_args(make_parser)
+    make_parser.add_argument("--mode", default="image")
+    make_args, _ = make_parser.parse_known_args(flash_args)
+    make.check_args(make_parser, make_args)
+    make.get_manifest(make_args)
+    mode = make_args.mode
+
+    log_dir = args.log_dir or os.path.join(make.get_builddir(make_args), "fleet")
+    os.makedirs(log_dir, exist_ok=True)
+
+    jobs = args.jobs or len(boards)
+    output_lock = threading.Lock()
+    start = time.time()
+    print("{} of {} boards, {} at a time.".format(
+        "Loading" if mode == "load" else "Flashing", len(boards), jobs))
+
+    def work(board):
+        with open(os.path.join(log_dir, "{}.log".format(board.name)), "w") as log:
+            try:
+                run(board, flash_args, log, output_lock)
+            except Exception as e:
+                board.result = "failed"
+                board.error = "{}: {}".format(type(e).__name__, e)
+        with output_lock:
+            done = sum(b.result in ("ok", "failed") for b in boards)
+            print("[{}/{}] {} {} ({:.1f}s)".format(
+                done, len(boards), board.name, board.result, board.time or 0))
+        return board
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(work, boards))
+
+    failed = report(boards, mode)
+    print("Total time {:.1f}s, logs in {}".format(time.time() - start, log_dir))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([{
+                "board": board.name,
+                "serial": board.serial,
+                "result": board.result,
+                "verified": board.verified,
+                "time": board.time,
+                "error": board.error,
+            } for board in boards], f, indent=2, sort_keys=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Read cache for the memory mapped SPI flash.
+"""
+
+from functools import reduce
+from operator import or_
+
+from migen import *
+
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr import AutoCSR, CSR, CSRStatus
+
+
+class FlashCache(Module, AutoCSR):
+    def __init__(self, slave, size=4096, line_words=8, ways=1):
+        """
+        Direct mapped (ways=1) or 2-way set associative line cache in front
+        of the flash bus `slave`, use `bus` in its place.
+
+        A miss reads the whole line from the flash, one sequential word after
+        the other, which the SpiFlash cores turn into a single burst with
+        continuous=True. Writes go straight to the flash bus (they fill the
+        page buffer of the program engine, and don't change the flash), the
+        slave has to ack them even without an engine.
+
+        Writing to `invalidate` empties the cache, needed after the flash was
+        programmed. `hits` and `misses` count the reads, writing to `clear`
+        resets them.
+        """
+        assert ways in (1, 2)
+        assert size % (line_words*4*ways) == 0
+        self.bus = bus = wishbone.Interface()
+
+        self.invalidate = CSR()
+        self.clear = CSR()
+        self.hits = CSRStatus(32)
+        self.misses = CSRStatus(32)
+
+        # # #
+
+        sets = size//(line_words*4*ways)
+        offset_bits = log2_int(line_words)
+        index_bits = log2_int(sets)
+        tag_bits = len(bus.adr) - index_bits - offset_bits
+
+        offset = bus.adr[:offset_bits]
+        index = bus.adr[offset_bits:offset_bits + index_bits]
+        tag = bus.adr[offset_bits + index_bits:]
+
+        count = Signal(max=max(sets, line_words))
+        victim = Signal(max=max(ways, 2))
+        hit = Signal()
+        hit_way = Signal(max=max(ways, 2))
+        dat_r = Signal(32)
+        lookup_hit = Signal()
+        count_hit = Signal()
+        count_miss = Signal()
+        # The lookup after a fill, it's the same read as the miss.
+        refill = Signal()
+        fill = Signal()
+        tag_we = Signal()
+        tag_valid = Signal()
+
+        if ways > 1:
+            # The way to replace next in each set.
+            lru = Memory(1, sets)
+            lru_rd = lru.get_port()
+            lru_wr = lru.get_port(write_capable=True)
+            self.specials += lru, lru_rd, lru_wr
+            self.comb += [
+                lru_rd.adr.eq(index),
+                lru_wr.adr.eq(index),
+                lru_wr.dat_w.eq(hit_way == 0),
+                lru_wr.we.eq(lookup_hit),
+            ]
+
+        hits = []
+        for way in range(ways):
+            data = Memory(32, sets*line_words)
+            data_rd = data.get_port()
+            data_wr = data.get_port(write_capable=True)
+            tags = Memory(tag_bits + 1, sets)
+            tags_rd = tags.get_port()
+            tags_wr = tags.get_port(write_capable=True)
+            self.specials += data, data_rd, data_wr, tags, tags_rd, tags_wr
+
+            way_hit = Signal()
+            self.comb += [
+                data_rd.adr.eq(Cat(offset, index)),
+                data_wr.adr.eq(Cat(count[:offset_bits], index)),
+                data_wr.dat_w.eq(slave.dat_r),
+                data_wr.we.eq(fill & slave.ack & (victim == way)),
+                tags_rd.adr.eq(index),
+                tags_wr.dat_w.eq(Cat(tag, tag_valid)),
+                tags_wr.we.eq(tag_we & ((victim == way) | ~tag_valid)),
+                way_hit.eq(tags_rd.dat_r[-1] & (tags_rd.dat_r[:-1] == tag)),
+                If(way_hit, hit_way.eq(way), dat_r.eq(data_rd.dat_r)),
+            ]
+            # Invalidating sweeps every set.
+            self.comb += If(tag_valid, tags_wr.adr.eq(index)).Else(tags_wr.adr.eq(count))
+            hits.append(way_hit)
+        self.comb += [
+            hit.eq(reduce(or_, hits)),
+            count_hit.eq(lookup_hit & ~refill),
+        ]
+
+        self.sync += [
+            If(self.clear.re,
+                self.hits.status.eq(0),
+                self.misses.status.eq(0),
+            ).Elif(count_hit,
+                self.hits.status.eq(self.hits.status + 1),
+            ).Elif(count_miss,
+                self.misses.status.eq(self.misses.status + 1),
+            )
+        ]
+
+        self.submodules.fsm = fsm = FSM(reset_state="INVALIDATE")
+        invalidate = Signal()
+        self.sync += [
+            If(self.invalidate.re,
+                invalidate.eq(1)
+            ).Elif(fsm.ongoing("INVALIDATE"),
+                invalidate.eq(0)
+            )
+        ]
+        fsm.act("INVALIDATE",
+            tag_we.eq(1),
+            NextValue(refill, 0),
+            NextValue(count, count + 1),
+            If(count == sets - 1,
+                NextValue(count, 0),
+                NextState("IDLE")
+            )
+        )
+        # The memories are read with the address of the request, the tags
+        # are compared a cycle later.
+        fsm.act("IDLE",
+            If(invalidate,
+                NextValue(count, 0),
+                NextState("INVALIDATE")
+            ).Elif(bus.cyc & bus.stb,
+                If(bus.we,
+                    NextState("WRITE")
+                ).Else(
+                    NextState("LOOKUP")
+                )
+            )
+        )
+        fsm.act("LOOKUP",
+            NextValue(refill, 0),
+            If(hit,
+                bus.dat_r.eq(dat_r),
+                bus.ack.eq(1),
+                lookup_hit.eq(1),
+                NextState("IDLE")
+            ).Else(
+                count_miss.eq(1),
+                NextValue(victim, lru_rd.dat_r if ways > 1 else 0),
+                NextValue(count, 0),
+                NextState("FILL")
+            )
+        )
+        # Read the line, then look the request up again.
+        fsm.act("FILL",
+            fill.eq(1),
+            slave.adr.eq(Cat(count[:offset_bits], index, tag)),
+            slave.sel.eq(2**len(slave.sel) - 1),
+            slave.cyc.eq(1),
+            slave.stb.eq(1),
+            If(slave.ack,
+                NextValue(count, count + 1),
+                If(count == line_words - 1,
+                    tag_we.eq(1),
+                    tag_valid.eq(1),
+                    NextValue(refill, 1),
+                    NextState("IDLE")
+                )
+            )
+        )
+        fsm.act("WRITE",
+            slave.adr.eq(bus.adr),
+            slave.dat_w.eq(bus.dat_w),
+            slave.sel.eq(bus.sel),
+            slave.we.eq(1),
+            slave.cyc.eq(1),
+            slave.stb.eq(1),
+            bus.ack.eq(slave.ack),
+            If(slave.ack, NextState("IDLE"))
+        )
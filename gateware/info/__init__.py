@@ -14,9 +14,16 @@ from gateware.info import platform as platform_info
 
 class Info(Module, AutoCSR):
     def __init__(self, platform, target_name):
-        self.submodules.dna = dna.DNA()
-        self.submodules.git = git.GitInfo()
+        # DNA_PORT is a Xilinx primitive.
+        if platform.device.startswith("xc"):
+            self.submodules.dna = dna.DNA()
         target = target_name.lower()[:-3]
+        toolchain = type(getattr(platform, "toolchain", None)).__module__.split(".")[-1]
+        self.submodules.git = git.GitInfo(extra={
+            "platform": platform.name,
+            "target": target,
+            "toolchain": toolchain,
+        })
         self.submodules.platform = platform_info.PlatformInfo(platform.name, target)
 
         if "xc7" in platform.device:
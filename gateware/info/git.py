@@ -1,73 +1,195 @@
 import binascii
+import json
 import os
+import socket
 import subprocess
 import sys
 
 from migen.fhdl import *
 from litex.soc.interconnect.csr import *
 
+
+TOP_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+# Size of the build information ROM, small enough to be read with a single
+# Etherbone record.
+INFO_SIZE = 255
+
+# The git information is cached in this file (set by make.py to a file in
+# the build directory) and in the process, until HEAD or the index change.
+# The dirty status is never cached, edits to the work tree don't touch the
+# files the cache key is made of.
+cache_file = None
+_root = None
+# (cache key, resolved information) of this process.
+_info = None
+
+
+def _git(*args):
+    return subprocess.check_output(
+        ["git"] + list(args),
+        cwd=git_root(),
+    ).decode('ascii').strip()
+
+
 def git_root():
+    global _root
+    if _root is not None:
+        return _root
+
     if sys.platform == "win32":
         # Git on Windows is likely to use Unix-style paths (`/c/path/to/repo`),
         # whereas directories passed to Python should be Windows-style paths
         # (`C:/path/to/repo`) (because Python calls into the Windows API).
         # `cygpath` converts between the two.
         git = subprocess.Popen(
-            "git rev-parse --show-toplevel",
+            ["git", "rev-parse", "--show-toplevel"],
             cwd=os.path.dirname(__file__),
             stdout=subprocess.PIPE,
         )
         path = subprocess.check_output(
-            "cygpath -wf -",
+            ["cygpath", "-wf", "-"],
             stdin=git.stdout,
         )
         git.wait()
-        return path.decode('ascii').strip()
     else:
-        return subprocess.check_output(
-            "git rev-parse --show-toplevel",
-            shell=True,
+        path = subprocess.check_output(
+            ["git", "rev-parse", "--show-toplevel"],
             cwd=os.path.dirname(__file__),
-        ).decode('ascii').strip()
+        )
+    _root = path.decode('ascii').strip()
+    return _root
+
+
+def _cache_key():
+    """Modification times of the git files which change with HEAD / the index."""
+    gitdir = os.path.join(TOP_DIR, ".git")
+    key = []
+    names = ["HEAD", "index", "packed-refs"]
+    try:
+        with open(os.path.join(gitdir, "HEAD")) as f:
+            head = f.read().strip()
+        if head.startswith("ref: "):
+            names.append(head[5:])
+    except OSError:
+        return None
+    for name in names:
+        try:
+            key.append(os.stat(os.path.join(gitdir, name)).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return key
+
+
+def _resolve():
+    commit, commit_time = _git("log", "-1", "--format=%H %ct").split()
+    return {
+        "commit": commit,
+        "describe": _git("describe", "--always"),
+        "time": int(commit_time),
+        "host": socket.gethostname(),
+    }
+
+
+def _dirty():
+    # The same changes `git describe --dirty` looks at.
+    return int(_git("status", "--porcelain", "--untracked-files=no") != "")
+
+
+def _resolved():
+    global _info
+    key = _cache_key()
+    if _info is not None and key is not None and _info[0] == key:
+        return dict(_info[1])
+
+    info = None
+    if cache_file and key is not None:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                info = cached["info"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if info is None:
+        info = _resolve()
+        if cache_file and key is not None:
+            os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+            with open(cache_file + ".tmp", "w") as f:
+                json.dump({"key": key, "info": info}, f, indent=2, sort_keys=True)
+            os.replace(cache_file + ".tmp", cache_file)
+    _info = (key, info)
+    return dict(info)
+
+
+def get_info():
+    """The git commit, describe and dirty status, the build host and time."""
+    info = _resolved()
+    info["dirty"] = _dirty()
+    if info["dirty"]:
+        info["describe"] += "-dirty"
+    return info
+
+
+def state():
+    """The part of get_info() a change to the repository can alter, a SoC
+    elaborated with another state has stale build information."""
+    info = get_info()
+    return info["commit"], info["describe"], info["dirty"]
+
 
 def git_commit():
-    data = subprocess.check_output(
-        "git rev-parse HEAD",
-        shell=True,
-        cwd=git_root(),
-    ).decode('ascii').strip()
-    return binascii.unhexlify(data)
+    return binascii.unhexlify(get_info()["commit"])
+
 
 def git_describe():
-    return subprocess.check_output(
-        "git describe --dirty",
-        shell=True,
-        cwd=git_root(),
-    ).decode('ascii').strip()
+    return get_info()["describe"]
+
 
 def git_status():
-    return subprocess.check_output(
-        "git status --short",
-        shell=True,
-        cwd=git_root(),
-    ).decode('ascii').strip()
+    return _git("status", "--short")
+
+
+# The build information ROM holds "key=value" strings, each followed by a NUL,
+# with an extra NUL after the last one.
+INFO_FIELDS = ("commit", "describe", "dirty", "time", "host", "platform", "target", "toolchain")
+
+
+def encode_info(info):
+    data = b""
+    for name in INFO_FIELDS:
+        if name not in info:
+            continue
+        field = "{}={}".format(name, info[name]).encode("utf-8") + b"\0"
+        if len(data) + len(field) + 1 > INFO_SIZE:
+            break
+        data += field
+    return data + b"\0"*(INFO_SIZE - len(data))
+
+
+def decode_info(data):
+    info = {}
+    for field in bytes(data).split(b"\0\0")[0].split(b"\0"):
+        name, _, value = field.decode("utf-8", "replace").partition("=")
+        if name:
+            info[name] = value
+    return info
 
 
 class GitInfo(Module, AutoCSR):
-    def __init__(self):
+    def __init__(self, extra=None):
         commit = sum(int(x) << (i*8) for i, x in enumerate(reversed(git_commit())))
         self.commit = CSRStatus(160)
 
-	# FIXME: This should be a read-only Memory object
-        #extradata = [ord(x) for x in "\0".join([
-        #    "https://github.com/timvideos/HDMI2USB-misoc-firmware.git",
-        #    git_describe(),
-        #    git_status(),
-        #    "",
-        #    ])]
-        #self.extradata = CSRStatus(len(extradata)*8)
+        info = dict(get_info())
+        # The commit time rather than the current time, so the gateware stays
+        # the same (and can come from the gateware cache) when nothing changed.
+        info["time"] = int(os.environ.get("SOURCE_DATE_EPOCH", info["time"]))
+        info.update(extra or {})
+        self.extradata = Memory(8, INFO_SIZE, init=list(encode_info(info)))
+        self.extradata.bus_read_only = True
 
         self.comb += [
             self.commit.status.eq(commit),
-        #    self.extradata.status.eq(extradata),
         ]
@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 from migen import *
 from migen.genlib.misc import timeline
 
@@ -10,6 +12,40 @@ from litex.soc.interconnect.csr import AutoCSR, CSRStorage, CSRStatus
 _FAST_READ = 0x0b
 _DIOFR = 0xbb
 _QIOFR = 0xeb
+_DTRQIOFR = 0xed
+
+_WREN = 0x06
+_RDSR = 0x05
+_PP = 0x02
+_SE = 0xd8
+_WEVCR = 0x61
+
+# Values of the engine command CSR.
+COMMAND_PROGRAM = 1
+COMMAND_ERASE = 2
+
+# Values of the read_mode CSR.
+READ_SPI = 0
+READ_QPI = 1
+READ_DTR = 2
+
+# The faster quad read modes of the flash parts named by the platforms'
+# spiflash_model, with their read command and dummy clocks (the datasheet
+# defaults). QPI also needs the commands which switch the flash to 4-4-4
+# commands and back.
+_N25Q = {
+    READ_QPI: dict(cmd=_QIOFR, dummy=10,
+        # Quad I/O protocol bit of the enhanced volatile configuration register
+        enter=[[_WREN], [_WEVCR, 0x5f]],
+        exit=[[_WREN], [_WEVCR, 0xdf]]),
+    READ_DTR: dict(cmd=_DTRQIOFR, dummy=8),
+}
+
+SPIFLASH_MODELS = {
+    "n25q32": _N25Q,
+    "n25q128": _N25Q,
+    "n25q128a13": _N25Q,
+}
 
 
 def _format_cmd(cmd, spi_width):
@@ -27,12 +63,554 @@ def _format_cmd(cmd, spi_width):
     return c
 
 
+class SpiFlashEngine(Module, AutoCSR):
+    def __init__(self, div=2, page_size=256, erase_cmd=_SE, cs_gap=16):
+        """
+        Page program / sector erase command engine.
+
+        Writes to the flash window of the bus fill the page buffer (the
+        address is taken modulo page_size). Writing COMMAND_PROGRAM to
+        `command` then programs the first `length` bytes of the buffer at
+        `address` (a `length` of 0 does nothing), COMMAND_ERASE erases the
+        sector holding `address`. Both send write enable first and poll the
+        status register until the flash is done, `busy` is set until then.
+
+        The flash is driven one bit at a time (dq0 out, dq1 in), the parent
+        connects the pads while `active` is set. A command waits for `ready`,
+        so the parent can finish what it is doing with the flash first.
+        """
+        self.address = CSRStorage(24)
+        self.length = CSRStorage(log2_int(page_size) + 1, reset=page_size)
+        self.command = CSRStorage(2)
+        self.busy = CSRStatus()
+
+        # A command was written, it starts once ready is set.
+        self.pending = Signal()
+        self.ready = Signal(reset=1)
+
+        # Pads side
+        self.active = Signal()
+        self.clk = Signal()
+        self.cs_n = Signal(reset=1)
+        self.mosi = Signal()
+        self.miso = Signal()
+        self.oe = Signal()
+
+        # Page buffer write port (bytes in bus order, big endian)
+        self.wr_adr = Signal(log2_int(page_size//4))
+        self.wr_dat = Signal(32)
+        self.wr_sel = Signal(4)
+        self.wr_stb = Signal()
+
+        # # #
+
+        buf = Memory(32, page_size//4)
+        wr_port = buf.get_port(write_capable=True, we_granularity=8)
+        rd_port = buf.get_port()
+        self.specials += buf, wr_port, rd_port
+        self.comb += [
+            wr_port.adr.eq(self.wr_adr),
+            wr_port.dat_w.eq(self.wr_dat),
+            If(self.wr_stb, wr_port.we.eq(self.wr_sel)),
+        ]
+
+        # Byte shifter, SPI mode 0: dq0 changes on the falling edge and dq1 is
+        # sampled on the rising edge.
+        load = Signal()
+        tx_byte = Signal(8)
+        done = Signal()
+        tx = Signal(8)
+        rx = Signal(8)
+        bits = Signal(max=9)
+        i = Signal(max=div)
+        self.comb += self.mosi.eq(tx[7])
+        self.sync += [
+            done.eq(0),
+            If(load,
+                tx.eq(tx_byte),
+                bits.eq(8),
+                i.eq(0),
+                self.clk.eq(0),
+            ).Elif(bits != 0,
+                If(i == div//2 - 1,
+                    self.clk.eq(1),
+                    rx.eq(Cat(self.miso, rx[:-1])),
+                ),
+                If(i == div - 1,
+                    i.eq(0),
+                    self.clk.eq(0),
+                    tx.eq(Cat(0, tx[:-1])),
+                    bits.eq(bits - 1),
+                    If(bits == 1, done.eq(1)),
+                ).Else(
+                    i.eq(i + 1),
+                ),
+            ),
+        ]
+
+        program = Signal()
+        count = Signal(max=page_size + 1)
+        gap = Signal(max=cs_gap + 1)
+        address = Signal(24)
+        byte = Signal(2)
+        self.comb += [
+            rd_port.adr.eq(count[2:]),
+            byte.eq(count[:2]),
+        ]
+
+        start = Signal()
+        self.sync += [
+            If(self.command.re & (self.command.storage != 0),
+                self.pending.eq(1)
+            ).Elif(start,
+                self.pending.eq(0)
+            )
+        ]
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        self.comb += [
+            self.active.eq(~fsm.ongoing("IDLE")),
+            self.busy.status.eq(self.active | self.pending),
+        ]
+        fsm.act("IDLE",
+            If(self.pending & self.ready,
+                start.eq(1),
+                # Nothing to program, count would wrap before matching.
+                If((self.command.storage != COMMAND_PROGRAM) | (self.length.storage != 0),
+                    NextValue(program, self.command.storage == COMMAND_PROGRAM),
+                    NextValue(address, self.address.storage),
+                    NextState("WREN"),
+                )
+            )
+        )
+        fsm.act("WREN",
+            self.cs_n.eq(0), self.oe.eq(1),
+            load.eq(1), tx_byte.eq(_WREN),
+            NextState("WREN_WAIT"),
+        )
+        fsm.act("WREN_WAIT",
+            self.cs_n.eq(0), self.oe.eq(1),
+            If(done,
+                NextValue(gap, cs_gap),
+                NextState("WREN_GAP"),
+            )
+        )
+        fsm.act("WREN_GAP",
+            NextValue(gap, gap - 1),
+            If(gap == 0, NextState("CMD")),
+        )
+        fsm.act("CMD",
+            self.cs_n.eq(0), self.oe.eq(1),
+            load.eq(1), tx_byte.eq(Mux(program, _PP, erase_cmd)),
+            NextValue(count, 0),
+            NextState("CMD_WAIT"),
+        )
+        fsm.act("CMD_WAIT",
+            self.cs_n.eq(0), self.oe.eq(1),
+            If(done, NextState("ADDR")),
+        )
+        fsm.act("ADDR",
+            self.cs_n.eq(0), self.oe.eq(1),
+            load.eq(1), tx_byte.eq(address[16:]),
+            NextValue(address, address << 8),
+            NextValue(count, count + 1),
+            NextState("ADDR_WAIT"),
+        )
+        fsm.act("ADDR_WAIT",
+            self.cs_n.eq(0), self.oe.eq(1),
+            If(done,
+                If(count != 3,
+                    NextState("ADDR"),
+                ).Elif(program,
+                    NextValue(count, 0),
+                    NextState("DATA_READ"),
+                ).Else(
+                    NextValue(gap, cs_gap),
+                    NextState("CMD_GAP"),
+                )
+            )
+        )
+        # The buffer is read synchronously, one cycle for the read port.
+        fsm.act("DATA_READ",
+            self.cs_n.eq(0), self.oe.eq(1),
+            NextState("DATA"),
+        )
+        fsm.act("DATA",
+            self.cs_n.eq(0), self.oe.eq(1),
+            load.eq(1),
+            Case(byte, {
+                0: tx_byte.eq(rd_port.dat_r[24:32]),
+                1: tx_byte.eq(rd_port.dat_r[16:24]),
+                2: tx_byte.eq(rd_port.dat_r[8:16]),
+                3: tx_byte.eq(rd_port.dat_r[0:8]),
+            }),
+            NextValue(count, count + 1),
+            NextState("DATA_WAIT"),
+        )
+        fsm.act("DATA_WAIT",
+            self.cs_n.eq(0), self.oe.eq(1),
+            If(done,
+                If(count == self.length.storage,
+                    NextValue(gap, cs_gap),
+                    NextState("CMD_GAP"),
+                ).Else(
+                    NextState("DATA_READ"),
+                )
+            )
+        )
+        fsm.act("CMD_GAP",
+            NextValue(gap, gap - 1),
+            If(gap == 0, NextState("RDSR")),
+        )
+        fsm.act("RDSR",
+            self.cs_n.eq(0), self.oe.eq(1),
+            load.eq(1), tx_byte.eq(_RDSR),
+            NextState("RDSR_WAIT"),
+        )
+        fsm.act("RDSR_WAIT",
+            self.cs_n.eq(0), self.oe.eq(1),
+            If(done, NextState("STATUS")),
+        )
+        # The flash keeps sending the status register while cs_n is low.
+        fsm.act("STATUS",
+            self.cs_n.eq(0),
+            load.eq(1), tx_byte.eq(0xff),
+            NextState("STATUS_WAIT"),
+        )
+        fsm.act("STATUS_WAIT",
+            self.cs_n.eq(0),
+            If(done,
+                If(rx[0],
+                    NextState("STATUS"),
+                ).Else(
+                    NextValue(gap, cs_gap),
+                    NextState("END_GAP"),
+                )
+            )
+        )
+        fsm.act("END_GAP",
+            NextValue(gap, gap - 1),
+            If(gap == 0, NextState("IDLE")),
+        )
+
+
+def _connect_engine_bus(module, engine, bus, endianness):
+    """Send writes to the flash window of the bus to the engine's page buffer,
+    returns their ack."""
+    wr_ack = Signal()
+    write = bus.cyc & bus.stb & bus.we
+    if endianness == "big":
+        module.comb += [
+            engine.wr_dat.eq(bus.dat_w),
+            engine.wr_sel.eq(bus.sel),
+        ]
+    else:
+        module.comb += [
+            engine.wr_dat.eq(reverse_bytes(bus.dat_w)),
+            engine.wr_sel.eq(Cat(*reversed([bus.sel[i] for i in range(4)]))),
+        ]
+    module.comb += [
+        engine.wr_adr.eq(bus.adr),
+        engine.wr_stb.eq(write & ~wr_ack),
+    ]
+    module.sync += wr_ack.eq(write & ~wr_ack)
+    return wr_ack
+
+
+# A read command as sent by _read_fsm. cmd is loaded into the top cmd_bits
+# of the shift register, the phases take the given number of clocks. enter
+# and exit are the commands (lists of bytes, each list one transaction) which
+# switch the flash to the protocol of the mode and back, sent 1 and spi_width
+# bits wide respectively.
+_ReadMode = namedtuple("_ReadMode",
+    "cmd cmd_bits cmd_clocks addr_clocks dummy data_clocks dtr enter exit")
+
+
+def _read_fsm(module, bus, sr, i, div, cs_n, clk_en, dq_oe, spi_width, modes,
+        mode, continuous, mode_bits, release, released, dtr_in, dtr_out):
+    """Read logic used in place of the timeline for continuous reads and
+    flashes with several read modes.
+
+    modes maps READ_SPI, READ_QPI and READ_DTR to a _ReadMode, mode selects
+    one of them (others read as READ_SPI). The flash is switched to and from
+    the QPI protocol as needed, and back to SPI after reset and before
+    release.
+
+    With continuous the clock is stopped after a word with cs_n still low, a
+    read of the next address restarts it for just the data clocks. Any other
+    read, a change of mode or release ends the burst.
+
+    With mode_bits (dual / quad SPI reads only) they are sent after the
+    address, a value such as 0xa0 keeps the flash in continuous read mode so
+    later reads start with the address. All lines driven high through the
+    address and mode clocks take it out of that mode again.
+
+    released is set while the flash can be used for other commands, dtr_in
+    and dtr_out while data is clocked on both edges. Returns the ack of reads,
+    writes are left to the caller.
+    """
+    wbone_width = len(bus.dat_r)
+    addr_width = 24
+    z = Replicate(0, log2_int(wbone_width//8))
+    address = Cat(z, bus.adr)[:addr_width]
+    if mode_bits is None:
+        mode_clocks = 0
+    else:
+        mode_clocks = 8//spi_width
+        assert modes[READ_SPI].dummy >= mode_clocks, "The mode bits are part of the dummy clocks."
+    qpi = READ_QPI in modes
+
+    ack = Signal()
+    xip = Signal()
+    in_qpi = Signal(reset=qpi)
+    sel = Signal(2)
+    cur = Signal(2)
+    next_adr = Signal(len(bus.adr))
+    n = Signal(max=max(m.cmd_clocks + m.addr_clocks + mode_clocks + m.dummy + m.data_clocks
+        for m in modes.values())*div)
+    load = Signal()
+    load_value = Signal(len(sr))
+    read = bus.cyc & bus.stb & ~bus.we
+    edge = i == div - 1
+
+    module.sync += If(load, sr.eq(load_value))
+    module.comb += Case(mode, dict([(m, sel.eq(m)) for m in modes] + [
+        ("default", sel.eq(READ_SPI))]))
+
+    def top(value, bits):
+        return load_value.eq(value << (len(sr) - bits))
+
+    def per_mode(signal, f):
+        return Case(signal, {m: f(modes[m]) for m in modes})
+
+    fsm = FSM(reset_state="EXIT" if mode_bits is not None else "IDLE")
+    module.submodules.read_fsm = fsm
+    module.comb += released.eq(fsm.ongoing("IDLE") & ~xip & ~in_qpi)
+    if READ_DTR in modes:
+        module.comb += [
+            dtr_out.eq(fsm.ongoing("ADDR") & (cur == READ_DTR)),
+            dtr_in.eq(fsm.ongoing("DATA") & (cur == READ_DTR)),
+        ]
+
+    def send(name, transactions, width, done):
+        """States sending each transaction (a list of bytes) in turn, starting
+        at name."""
+        clocks = 8//width
+        bits = 8*spi_width if width == 1 else 8
+
+        def load_byte(byte):
+            return [
+                load.eq(1),
+                top(_format_cmd(byte, spi_width) if width == 1 else byte, bits),
+                NextValue(n, clocks*div - 1),
+            ]
+
+        for t, data in enumerate(transactions):
+            start = name if t == 0 else "{}_{}".format(name, t)
+            after = "{}_{}".format(name, t + 1) if t + 1 < len(transactions) else done
+            fsm.act(start,
+                If(edge,
+                    *load_byte(data[0]),
+                    NextValue(cs_n, 0),
+                    NextValue(dq_oe, 1),
+                    NextState("{}_{}_0".format(name, t))
+                )
+            )
+            for b in range(len(data)):
+                if b + 1 < len(data):
+                    last = [*load_byte(data[b + 1]), NextState("{}_{}_{}".format(name, t, b + 1))]
+                else:
+                    last = [NextValue(cs_n, 1), NextValue(dq_oe, 0), NextState(after)]
+                fsm.act("{}_{}_{}".format(name, t, b),
+                    NextValue(n, n - 1),
+                    If(n == 0, *last)
+                )
+
+    if qpi:
+        fsm.act("IDLE",
+            If(in_qpi & (release | (sel != READ_QPI)),
+                NextState("QPI_EXIT")
+            ).Elif(~in_qpi & ~xip & read & ~release & (sel == READ_QPI),
+                NextState("QPI_ENTER")
+            )
+        )
+        send("QPI_ENTER", modes[READ_QPI].enter, 1, "QPI_ENTERED")
+        fsm.act("QPI_ENTERED",
+            NextValue(in_qpi, 1),
+            NextValue(n, div - 1),
+            NextState("GAP")
+        )
+        send("QPI_EXIT", modes[READ_QPI].exit, spi_width, "QPI_EXITED")
+        fsm.act("QPI_EXITED",
+            NextValue(in_qpi, 0),
+            NextValue(n, div - 1),
+            NextState("GAP")
+        )
+        ready = in_qpi == (sel == READ_QPI)
+    else:
+        ready = 1
+    if mode_bits is not None:
+        fsm.act("IDLE",
+            If(xip & (release | (sel != READ_SPI)), NextState("EXIT"))
+        )
+    fsm.act("IDLE",
+        If(edge & read & ~release & ready & (~xip | (sel == READ_SPI)),
+            NextValue(cs_n, 0),
+            NextValue(dq_oe, 1),
+            NextValue(cur, sel),
+            NextValue(next_adr, bus.adr + 1),
+            load.eq(1),
+            If(xip,
+                top(Cat(Constant(mode_bits or 0, 8), address), addr_width + 8),
+                NextValue(n, modes[READ_SPI].addr_clocks*div - 1),
+                NextState("ADDR")
+            ).Else(
+                per_mode(sel, lambda m: [
+                    top(m.cmd, m.cmd_bits),
+                    NextValue(n, m.cmd_clocks*div - 1),
+                ]),
+                NextState("CMD")
+            )
+        )
+    )
+
+    def load_address(m):
+        if m.dtr:
+            # The first shift comes before the first rising edge.
+            return top(address, addr_width + spi_width)
+        elif mode_bits is not None and m is modes[READ_SPI]:
+            return top(Cat(Constant(mode_bits, 8), address), addr_width + 8)
+        else:
+            return top(address, addr_width)
+
+    fsm.act("CMD",
+        NextValue(n, n - 1),
+        If(n == 0,
+            load.eq(1),
+            per_mode(cur, lambda m: [
+                load_address(m),
+                NextValue(n, m.addr_clocks*div - 1),
+            ]),
+            NextState("ADDR")
+        )
+    )
+    if mode_bits is not None:
+        fsm.act("ADDR",
+            NextValue(n, n - 1),
+            If(n == 0,
+                If(cur == READ_SPI,
+                    NextValue(n, mode_clocks*div - 1),
+                    NextState("MODE")
+                ).Else(
+                    per_mode(cur, lambda m: NextValue(n, (m.dummy + m.data_clocks)*div - 1)),
+                    # DTR holds the address for a cycle after the last falling
+                    # edge.
+                    NextValue(dq_oe, dtr_out),
+                    NextState("DATA")
+                )
+            )
+        )
+        fsm.act("MODE",
+            NextValue(n, n - 1),
+            If(n == 0,
+                NextValue(n, (modes[READ_SPI].dummy - mode_clocks +
+                    modes[READ_SPI].data_clocks)*div - 1),
+                NextValue(dq_oe, 0),
+                NextValue(xip, (mode_bits & 0x30) == 0x20),
+                NextState("DATA")
+            )
+        )
+    else:
+        fsm.act("ADDR",
+            NextValue(n, n - 1),
+            If(n == 0,
+                per_mode(cur, lambda m: NextValue(n, (m.dummy + m.data_clocks)*div - 1)),
+                # DTR holds the address for a cycle after the last falling
+                # edge.
+                NextValue(dq_oe, dtr_out),
+                NextState("DATA")
+            )
+        )
+    fsm.act("DATA", NextValue(dq_oe, 0))
+    if continuous:
+        fsm.act("DATA",
+            NextValue(n, n - 1),
+            If(n == 0,
+                NextValue(ack, 1),
+                NextValue(clk_en, 0),
+                NextState("HOLD")
+            )
+        )
+    else:
+        fsm.act("DATA",
+            NextValue(n, n - 1),
+            If(n == 0,
+                NextValue(ack, 1),
+                NextValue(cs_n, 1),
+                NextValue(n, div),
+                NextState("GAP")
+            )
+        )
+    fsm.act("HOLD",
+        NextValue(ack, 0),
+        If(edge & ~ack,
+            If(read & (bus.adr == next_adr) & ~release & (sel == cur),
+                NextValue(next_adr, next_adr + 1),
+                NextValue(clk_en, 1),
+                per_mode(cur, lambda m: NextValue(n, m.data_clocks*div - 1)),
+                NextState("DATA")
+            ).Elif(read | release | (sel != cur),
+                NextValue(cs_n, 1),
+                NextValue(clk_en, 1),
+                NextValue(n, div - 1),
+                NextState("GAP")
+            )
+        )
+    )
+    fsm.act("GAP", # tSHSL!
+        NextValue(ack, 0),
+        NextValue(n, n - 1),
+        If(n == 0, NextState("IDLE"))
+    )
+    if mode_bits is not None:
+        fsm.act("EXIT",
+            If(edge,
+                load.eq(1),
+                load_value.eq(2**len(sr) - 1),
+                NextValue(cs_n, 0),
+                NextValue(dq_oe, 1),
+                NextValue(n, (modes[READ_SPI].addr_clocks + mode_clocks)*div - 1),
+                NextState("EXIT_WAIT")
+            )
+        )
+        fsm.act("EXIT_WAIT",
+            NextValue(n, n - 1),
+            If(n == 0,
+                NextValue(cs_n, 1),
+                NextValue(dq_oe, 0),
+                NextValue(xip, 0),
+                NextValue(n, div - 1),
+                NextState("GAP")
+            )
+        )
+    return ack
+
+
 class SpiFlashDualQuad(Module, AutoCSR):
-    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big"):
+    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big",
+            with_engine=False, page_size=256, erase_cmd=_SE,
+            continuous=False, mode_bits=None, model=None):
         """
         Simple SPI flash.
         Supports multi-bit pseudo-parallel reads (aka Dual or Quad I/O Fast
         Read). Only supports mode0 (cpol=0, cpha=0).
+        with_engine adds a page program / sector erase engine (SpiFlashEngine).
+        continuous keeps cs_n low between sequential reads, mode_bits also
+        keeps the flash in continuous read (XIP) mode between bursts, see
+        _read_fsm.
+        model is the platform's spiflash_model, the QPI and DTR reads it
+        supports (SPIFLASH_MODELS) can be selected with the read_mode CSR.
+        DTR needs div to be a multiple of 4.
         """
         self.bus = bus = wishbone.Interface()
         spi_width = len(pads.dq)
@@ -43,11 +621,16 @@ class SpiFlashDualQuad(Module, AutoCSR):
             self.miso = CSRStatus()
             self.bitbang_en = CSRStorage()
 
+        if with_engine:
+            self.submodules.engine = SpiFlashEngine(div, page_size, erase_cmd)
+
         # # #
 
         cs_n = Signal(reset=1)
         clk = Signal()
+        clk_en = Signal(reset=1)
         dq_oe = Signal()
+        released = Signal(reset=1)
         wbone_width = len(bus.dat_r)
 
 
@@ -58,6 +641,22 @@ class SpiFlashDualQuad(Module, AutoCSR):
         read_cmd, cmd_width = read_cmd_params[spi_width]
         addr_width = 24
 
+        modes = {
+            READ_SPI: _ReadMode(read_cmd, cmd_width, 8, addr_width//spi_width,
+                dummy, wbone_width//spi_width, False, [], []),
+        }
+        fast_modes = SPIFLASH_MODELS.get(model, {}) if spi_width == 4 else {}
+        if READ_QPI in fast_modes:
+            m = fast_modes[READ_QPI]
+            modes[READ_QPI] = _ReadMode(m["cmd"], 8, 2, addr_width//4,
+                m["dummy"], wbone_width//4, False, m["enter"], m["exit"])
+        if READ_DTR in fast_modes and div % 4 == 0:
+            m = fast_modes[READ_DTR]
+            modes[READ_DTR] = _ReadMode(_format_cmd(m["cmd"], 4), cmd_width, 8,
+                addr_width//8, m["dummy"], wbone_width//8, True, [], [])
+        if len(modes) > 1:
+            self.read_mode = CSRStorage(2)
+
         dq = TSTriple(spi_width)
         self.specials.dq = dq.get_tristate(pads.dq)
 
@@ -74,6 +673,22 @@ class SpiFlashDualQuad(Module, AutoCSR):
             dq.oe.eq(dq_oe)
         ]
 
+        if with_engine:
+            self.comb += [
+                self.engine.miso.eq(dq.i[1]),
+                self.engine.ready.eq(released),
+            ]
+            hw_read_logic = [
+                If(self.engine.active,
+                    pads.clk.eq(self.engine.clk),
+                    pads.cs_n.eq(self.engine.cs_n),
+                    dq.o.eq(Cat(self.engine.mosi, Replicate(1, spi_width-1))),
+                    dq.oe.eq(self.engine.oe)
+                ).Else(
+                    *hw_read_logic
+                )
+            ]
+
         if with_bitbang:
             bitbang_logic = [
                 pads.clk.eq(self.bitbang.storage[1]),
@@ -97,7 +712,7 @@ class SpiFlashDualQuad(Module, AutoCSR):
             ]
 
             self.comb += [
-                If(self.bitbang_en.storage,
+                If(self.bitbang_en.storage & released,
                     bitbang_logic
                 ).Else(
                     hw_read_logic
@@ -112,9 +727,11 @@ class SpiFlashDualQuad(Module, AutoCSR):
         else:
             i = Signal(max=div)
             dqi = Signal(spi_width)
+            dtr_in = Signal()
+            dtr_out = Signal()
             self.sync += [
                 If(i == div//2 - 1,
-                    clk.eq(1),
+                    clk.eq(clk_en),
                     dqi.eq(dq.i),
                 ),
                 If(i == div - 1,
@@ -125,9 +742,25 @@ class SpiFlashDualQuad(Module, AutoCSR):
                     i.eq(i + 1),
                 ),
             ]
+            if READ_DTR in modes:
+                # Double transfer rate: data in on both clock edges, data out
+                # a quarter of a clock after each edge.
+                self.sync += [
+                    If(dtr_in & ((i == div//2 - 1) | (i == div - 1)),
+                        sr.eq(Cat(dq.i, sr[:-spi_width]))
+                    ),
+                    If(dtr_out,
+                        If((i == div//4 - 1) | (i == div//2 + div//4 - 1),
+                            sr.eq(Cat(dq.i, sr[:-spi_width]))
+                        ).Elif(i == div - 1,
+                            sr.eq(sr)
+                        )
+                    ),
+                ]
 
         # spi is byte-addressed, prefix by zeros
         z = Replicate(0, log2_int(wbone_width//8))
+        ack = Signal()
 
         seq = [
             (cmd_width//spi_width*div,
@@ -137,9 +770,9 @@ class SpiFlashDualQuad(Module, AutoCSR):
             ((dummy + wbone_width//spi_width)*div,
                 [dq_oe.eq(0)]),
             (1,
-                [bus.ack.eq(1), cs_n.eq(1)]),
+                [ack.eq(1), cs_n.eq(1)]),
             (div, # tSHSL!
-                [bus.ack.eq(0)]),
+                [ack.eq(0)]),
             (0,
                 []),
         ]
@@ -150,14 +783,38 @@ class SpiFlashDualQuad(Module, AutoCSR):
             tseq.append((t, a))
             t += dt
 
-        self.sync += timeline(bus.cyc & bus.stb & (i == div - 1), tseq)
+        start = bus.cyc & bus.stb & (i == div - 1)
+        use_fsm = continuous or mode_bits is not None or len(modes) > 1
+        if use_fsm:
+            release = Signal()
+            if with_bitbang:
+                self.comb += If(self.bitbang_en.storage, release.eq(1))
+            if with_engine:
+                self.comb += If(self.engine.pending | self.engine.active, release.eq(1))
+            mode = self.read_mode.storage if len(modes) > 1 else READ_SPI
+            ack = _read_fsm(self, bus, sr, i, div, cs_n, clk_en, dq_oe, spi_width,
+                modes, mode, continuous, mode_bits, release, released, dtr_in, dtr_out)
+        if with_engine:
+            wr_ack = _connect_engine_bus(self, self.engine, bus, endianness)
+            self.comb += bus.ack.eq(ack | wr_ack)
+            start = start & ~bus.we & ~self.engine.active
+        else:
+            if use_fsm:
+                # Nothing takes writes, ack and drop them.
+                ack = ack | (bus.cyc & bus.stb & bus.we)
+            self.comb += bus.ack.eq(ack)
+        if not use_fsm:
+            self.sync += timeline(start, tseq)
 
 
 class SpiFlashSingle(Module, AutoCSR):
-    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big"):
+    def __init__(self, pads, dummy=15, div=2, with_bitbang=True, endianness="big",
+            with_engine=False, page_size=256, erase_cmd=_SE, continuous=False):
         """
         Simple SPI flash.
         Supports 1-bit reads. Only supports mode0 (cpol=0, cpha=0).
+        with_engine adds a page program / sector erase engine (SpiFlashEngine).
+        continuous keeps cs_n low between sequential reads, see _read_fsm.
         """
         self.bus = bus = wishbone.Interface()
 
@@ -166,6 +823,9 @@ class SpiFlashSingle(Module, AutoCSR):
             self.miso = CSRStatus()
             self.bitbang_en = CSRStorage()
 
+        if with_engine:
+            self.submodules.engine = SpiFlashEngine(div, page_size, erase_cmd)
+
         # # #
 
         if hasattr(pads, "wp"):
@@ -176,6 +836,8 @@ class SpiFlashSingle(Module, AutoCSR):
 
         cs_n = Signal(reset=1)
         clk = Signal()
+        clk_en = Signal(reset=1)
+        released = Signal(reset=1)
         wbone_width = len(bus.dat_r)
 
         read_cmd = _FAST_READ
@@ -194,6 +856,21 @@ class SpiFlashSingle(Module, AutoCSR):
             pads.mosi.eq(sr[-1:])
         ]
 
+        if with_engine:
+            self.comb += [
+                self.engine.miso.eq(pads.miso),
+                self.engine.ready.eq(released),
+            ]
+            hw_read_logic = [
+                If(self.engine.active,
+                    pads.clk.eq(self.engine.clk),
+                    pads.cs_n.eq(self.engine.cs_n),
+                    pads.mosi.eq(self.engine.mosi)
+                ).Else(
+                    *hw_read_logic
+                )
+            ]
+
         if with_bitbang:
             bitbang_logic = [
                 pads.clk.eq(self.bitbang.storage[1]),
@@ -205,7 +882,7 @@ class SpiFlashSingle(Module, AutoCSR):
             ]
 
             self.comb += [
-                If(self.bitbang_en.storage,
+                If(self.bitbang_en.storage & released,
                     bitbang_logic
                 ).Else(
                     hw_read_logic
@@ -222,7 +899,7 @@ class SpiFlashSingle(Module, AutoCSR):
             miso = Signal()
             self.sync += [
                 If(i == div//2 - 1,
-                    clk.eq(1),
+                    clk.eq(clk_en),
                     miso.eq(pads.miso),
                 ),
                 If(i == div - 1,
@@ -236,6 +913,7 @@ class SpiFlashSingle(Module, AutoCSR):
 
         # spi is byte-addressed, prefix by zeros
         z = Replicate(0, log2_int(wbone_width//8))
+        ack = Signal()
 
         seq = [
             (cmd_width*div,
@@ -245,9 +923,9 @@ class SpiFlashSingle(Module, AutoCSR):
             ((dummy + wbone_width)*div,
                 []),
             (1,
-                [bus.ack.eq(1), cs_n.eq(1)]),
+                [ack.eq(1), cs_n.eq(1)]),
             (div, # tSHSL!
-                [bus.ack.eq(0)]),
+                [ack.eq(0)]),
             (0,
                 []),
         ]
@@ -258,7 +936,30 @@ class SpiFlashSingle(Module, AutoCSR):
             tseq.append((t, a))
             t += dt
 
-        self.sync += timeline(bus.cyc & bus.stb & (i == div - 1), tseq)
+        start = bus.cyc & bus.stb & (i == div - 1)
+        if continuous:
+            release = Signal()
+            if with_bitbang:
+                self.comb += If(self.bitbang_en.storage, release.eq(1))
+            if with_engine:
+                self.comb += If(self.engine.pending | self.engine.active, release.eq(1))
+            modes = {
+                READ_SPI: _ReadMode(read_cmd, cmd_width, 8, addr_width, dummy,
+                    wbone_width, False, [], []),
+            }
+            ack = _read_fsm(self, bus, sr, i, div, cs_n, clk_en, Signal(), 1,
+                modes, READ_SPI, True, None, release, released, Signal(), Signal())
+        if with_engine:
+            wr_ack = _connect_engine_bus(self, self.engine, bus, endianness)
+            self.comb += bus.ack.eq(ack | wr_ack)
+            start = start & ~bus.we & ~self.engine.active
+        else:
+            if continuous:
+                # Nothing takes writes, ack and drop them.
+                ack = ack | (bus.cyc & bus.stb & bus.we)
+            self.comb += bus.ack.eq(ack)
+        if not continuous:
+            self.sync += timeline(start, tseq)
 
 
 def SpiFlash(pads, *args, **kw):
@@ -0,0 +1,434 @@
+"""
+Behavioural SPI flash model for migen simulation of gateware/spi_flash.py.
+
+Run `python -m gateware.spi_flash_sim` to check the SPI flash cores against
+the model, and to see how many cycles a word takes to read.
+"""
+
+import random
+import sys
+
+from migen import *
+from migen.fhdl.specials import Tristate
+
+from gateware import flash_cache
+from gateware import spi_flash
+
+
+_WIDTHS = {
+    spi_flash._FAST_READ: 1,
+    spi_flash._DIOFR: 2,
+    spi_flash._QIOFR: 4,
+}
+
+
+class SpiFlashModel:
+    """SPI flash, mode 0.
+
+    Supports write enable, read status, page program, sector erase, fast read
+    and dual / quad I/O fast read with continuous read mode (mode bits with
+    M5-4 = 10, as Winbond / Macronix parts). Writing the enhanced volatile
+    configuration register switches to QPI (4-4-4) commands, as N25Q parts,
+    which also have DTR quad I/O fast read.
+
+    dummy is the number of clocks between the address and the data, including
+    the mode bits, of SPI reads. Program / erase keep the flash busy for
+    busy_polls status reads, commands other than read status while busy are
+    recorded in errors. Transactions too short for a command are ignored.
+    """
+    def __init__(self, size=1 << 20, page_size=256, sector_size=1 << 16,
+            dummy=8, qpi_dummy=10, dtr_dummy=8, busy_polls=3):
+        self.data = bytearray(b"\xff"*size)
+        self.page_size = page_size
+        self.sector_size = sector_size
+        self.dummy = dummy
+        self.qpi_dummy = qpi_dummy
+        self.dtr_dummy = dtr_dummy
+        self.busy_polls = busy_polls
+        self.wel = False
+        self.busy = 0
+        self.xip = None
+        self.qpi = False
+        self.errors = []
+        self.commands = []
+
+    def status(self):
+        return (self.busy != 0) | (self.wel << 1)
+
+    @staticmethod
+    def _bits(samples, start, count, width):
+        value = 0
+        for s in samples[start:start + count]:
+            value = (value << width) | (s & (2**width - 1))
+        return value
+
+    def _decode(self, samples, xip, qpi):
+        """Command, width and clock the address starts at."""
+        if xip is not None:
+            return xip, _WIDTHS[xip], 0
+        if qpi:
+            if len(samples) < 2:
+                return None, 4, 2
+            return self._bits(samples, 0, 2, 4), 4, 2
+        if len(samples) < 8:
+            return None, 1, 8
+        cmd = self._bits(samples, 0, 8, 1)
+        return cmd, _WIDTHS.get(cmd, 1), 8
+
+    def _read_byte(self, address, bit, width):
+        byte = self.data[(address + bit//8) % len(self.data)]
+        return (byte >> (8 - width - bit % 8)) & (2**width - 1)
+
+    def _out(self, samples, edges, xip, qpi):
+        """The value to drive for the next clock edge, and its width."""
+        k = len(samples)
+        cmd, width, start = self._decode(samples, xip, qpi)
+        if cmd == spi_flash._DTRQIOFR and not qpi and xip is None:
+            # Address and data on both edges, edges[16] is the first address
+            # nibble.
+            data = 16 + 6 + 2*self.dtr_dummy
+            if len(edges) >= data:
+                address = self._bits(edges, 16, 6, 4)
+                return self._read_byte(address, (len(edges) - data)*4, 4), 4
+            return 1, 1
+        if cmd == spi_flash._RDSR and k >= start:
+            if (k - start) % 8 == 0 and k > start and self.busy:
+                # One status byte was read.
+                self.busy -= 1
+            return (self.status() >> (7 - (k - start) % 8)) & 1, 1
+        if cmd in _WIDTHS or (qpi and cmd in (spi_flash._FAST_READ, spi_flash._QIOFR)):
+            dummy = self.qpi_dummy if qpi else self.dummy
+            data = start + 24//width + dummy
+            if k >= data:
+                address = self._bits(samples, start, 24//width, width)
+                return self._read_byte(address, (k - data)*width, width), width
+        return 1, 1
+
+    def _execute(self, samples, xip, qpi):
+        cmd, width, start = self._decode(samples, xip, qpi)
+        if cmd is None:
+            return
+        self.commands.append(cmd)
+        if self.busy and cmd != spi_flash._RDSR:
+            self.errors.append("command 0x{:02x} while busy".format(cmd))
+            return
+        if not qpi and cmd in (spi_flash._DIOFR, spi_flash._QIOFR):
+            mode = start + 24//width
+            if len(samples) >= mode + 8//width:
+                mode_bits = self._bits(samples, mode, 8//width, width)
+                self.xip = cmd if (mode_bits & 0x30) == 0x20 else None
+            return
+        step = 8//width if qpi else 8
+        rx = bytes(self._bits(samples, i, step, 8//step)
+            for i in range(0, len(samples) - step + 1, step))
+        bits = len(rx)*8
+        if cmd == spi_flash._WREN and bits == 8:
+            self.wel = True
+        elif cmd == spi_flash._WEVCR and bits == 16:
+            if not self.wel:
+                self.errors.append("configuration write without write enable")
+                return
+            self.qpi = not rx[1] & 0x80
+            self.wel = False
+        elif cmd == spi_flash._PP and bits >= 40 and not qpi:
+            if not self.wel:
+                self.errors.append("page program without write enable")
+                return
+            address = int.from_bytes(rx[1:4], "big")
+            page = address - address % self.page_size
+            for i, b in enumerate(rx[4:]):
+                a = page + (address + i) % self.page_size
+                self.data[a] &= b
+            self.wel = False
+            self.busy = self.busy_polls
+        elif cmd == spi_flash._SE and bits == 32 and not qpi:
+            if not self.wel:
+                self.errors.append("sector erase without write enable")
+                return
+            address = int.from_bytes(rx[1:4], "big")
+            sector = address - address % self.sector_size
+            self.data[sector:sector + self.sector_size] = b"\xff"*self.sector_size
+            self.wel = False
+            self.busy = self.busy_polls
+        elif cmd == spi_flash._RDSR and not qpi:
+            pass
+        elif cmd in (spi_flash._FAST_READ, spi_flash._QIOFR) and qpi:
+            pass
+        elif cmd in (spi_flash._FAST_READ, spi_flash._DTRQIOFR, 0xff) and not qpi:
+            # 0xff is the continuous read mode reset.
+            pass
+        else:
+            self.errors.append("unexpected command 0x{:02x} ({} bits{})".format(
+                cmd, bits, ", QPI" if qpi else ""))
+
+    @passive
+    def generator(self, pads, dq=None):
+        """pads has clk and cs_n, with mosi / miso or dq. For dq pads the
+        Tristate of the core is passed in dq."""
+        prev_clk = 0
+        prev_cs_n = 1
+        samples = []
+        edges = []
+        xip = None
+        qpi = False
+        while True:
+            cs_n = yield pads.cs_n
+            clk = yield pads.clk
+            if cs_n:
+                if not prev_cs_n:
+                    self._execute(samples, xip, qpi)
+                samples = []
+                edges = []
+            else:
+                if prev_cs_n:
+                    xip = self.xip
+                    qpi = self.qpi
+                if clk != prev_clk and (clk or samples):
+                    if dq is None:
+                        value = yield pads.mosi
+                    else:
+                        value = (yield dq.o) if (yield dq.oe) else 0
+                    edges.append(value)
+                    if clk:
+                        samples.append(value)
+                    cmd = self._decode(samples, xip, qpi)[0]
+                    # The flash changes its output on the falling edge (on
+                    # both for DTR), but generator writes only show a cycle
+                    # later, so the next bit is driven straight after the
+                    # previous edge.
+                    if clk or (cmd == spi_flash._DTRQIOFR and not qpi and xip is None):
+                        value, width = self._out(samples, edges, xip, qpi)
+                        if dq is None:
+                            yield pads.miso.eq(value)
+                        elif width == 1:
+                            yield pads.dq.eq(value << 1)
+                        else:
+                            yield pads.dq.eq(value)
+            prev_clk = clk
+            prev_cs_n = cs_n
+            yield
+
+
+class _SimTristate:
+    """The model drives the pads directly, so just read them back."""
+    @staticmethod
+    def lower(dr):
+        m = Module()
+        m.comb += dr.i.eq(dr.target)
+        return m
+
+
+class _Bench(Module):
+    def __init__(self, width=1, cache=None, **kwargs):
+        if width == 1:
+            self.pads = Record([("clk", 1), ("cs_n", 1), ("mosi", 1), ("miso", 1)])
+        else:
+            self.pads = Record([("clk", 1), ("cs_n", 1), ("dq", width)])
+        self.submodules.flash = spi_flash.SpiFlash(self.pads, with_bitbang=False, **kwargs)
+        self.bus = self.flash.bus
+        self.cache = None
+        if cache is not None:
+            self.submodules.cache = flash_cache.FlashCache(self.flash.bus, **cache)
+            self.bus = self.cache.bus
+        self.cycles = Signal(32)
+        self.sync += self.cycles.eq(self.cycles + 1)
+
+    def tristate(self):
+        return getattr(self.flash, "dq", None)
+
+
+def _wait_idle(engine):
+    while (yield from engine.busy.read()):
+        yield
+
+
+def _check_engine(bench, model, errors):
+    bus = bench.bus
+    engine = bench.flash.engine
+    address = 0x10100
+    page = bytes(random.randrange(256) for i in range(256))
+
+    yield from engine.address.write(address)
+    yield from engine.command.write(spi_flash.COMMAND_ERASE)
+    yield
+    yield from _wait_idle(engine)
+    if model.data[0x10000:0x20000] != b"\xff"*0x10000:
+        errors.append("sector not erased")
+
+    for i in range(0, len(page), 4):
+        yield from bus.write(i//4, int.from_bytes(page[i:i+4], "big"))
+    yield from engine.command.write(spi_flash.COMMAND_PROGRAM)
+    yield
+    yield from _wait_idle(engine)
+    if model.data[address:address+len(page)] != page:
+        errors.append("page not programmed")
+
+    # Programming nothing must not touch the flash.
+    yield from bus.write(0, 0)
+    yield from engine.length.write(0)
+    yield from engine.command.write(spi_flash.COMMAND_PROGRAM)
+    yield
+    yield from _wait_idle(engine)
+    yield from engine.length.write(len(page))
+    if model.data[address:address+len(page)] != page:
+        errors.append("page programmed with a length of 0")
+    if bench.cache is not None:
+        yield from bench.cache.invalidate.write(1)
+
+    # Read it back through the memory mapped flash.
+    for i in range(0, len(page), 16):
+        word = yield from bus.read((address + i)//4)
+        if word != int.from_bytes(page[i:i+4], "big"):
+            errors.append("read 0x{:08x} at 0x{:x}".format(word, address + i))
+
+
+def _read(bench, model, addresses, errors):
+    """Reads the words at addresses, returns the cycles taken."""
+    start = yield bench.cycles
+    for adr in addresses:
+        word = yield from bench.bus.read(adr)
+        expected = int.from_bytes(model.data[adr*4:adr*4+4], "big")
+        if word != expected:
+            errors.append("read 0x{:08x} at 0x{:x}, expected 0x{:08x}".format(
+                word, adr*4, expected))
+    return (yield bench.cycles) - start
+
+
+def _check_modes(bench, model, errors):
+    """Switches between all read modes, and to the engine from QPI."""
+    for mode in (spi_flash.READ_QPI, spi_flash.READ_DTR, spi_flash.READ_QPI,
+            spi_flash.READ_SPI, spi_flash.READ_QPI):
+        yield from bench.flash.read_mode.write(mode)
+        yield from _read(bench, model, range(0x400, 0x408), errors)
+        if model.qpi != (mode == spi_flash.READ_QPI):
+            errors.append("flash {} QPI mode after reads in mode {}".format(
+                "in" if model.qpi else "not in", mode))
+    # The engine only sends SPI commands.
+    yield from _check_engine(bench, model, errors)
+    yield from _read(bench, model, range(0x200, 0x210), errors)
+
+
+def _write(bench, adr, data, errors, timeout=1024):
+    """A bus write which gives up after timeout cycles without an ack."""
+    bus = bench.bus
+    yield bus.adr.eq(adr)
+    yield bus.dat_w.eq(data)
+    yield bus.sel.eq(0xf)
+    yield bus.we.eq(1)
+    yield bus.cyc.eq(1)
+    yield bus.stb.eq(1)
+    yield
+    for i in range(timeout):
+        if (yield bus.ack):
+            break
+        yield
+    else:
+        errors.append("write at 0x{:x} not acked".format(adr*4))
+    yield bus.cyc.eq(0)
+    yield bus.stb.eq(0)
+    yield bus.we.eq(0)
+    yield
+
+
+def _run_no_engine(name, width, dummy, **kwargs):
+    """Without an engine writes to the flash window are acked and dropped."""
+    random.seed(0)
+    bench = _Bench(width, dummy=dummy, with_engine=False, **kwargs)
+    model = SpiFlashModel(dummy=dummy)
+    model.data[:] = bytes(random.randrange(256) for i in range(len(model.data)))
+    contents = bytes(model.data)
+    errors = []
+
+    def check():
+        yield from _read(bench, model, range(0x100, 0x108), errors)
+        # In the middle of a continuous read, and on their own.
+        yield from _write(bench, 0x108, 0x12345678, errors)
+        yield from _read(bench, model, range(0x108, 0x110), errors)
+        for adr in range(0x200, 0x204):
+            yield from _write(bench, adr, 0, errors)
+        yield from _read(bench, model, range(0x200, 0x204), errors)
+
+    run_simulation(bench, [check(), model.generator(bench.pads, bench.tristate())],
+        special_overrides={Tristate: _SimTristate})
+    errors += model.errors
+    if bytes(model.data) != contents:
+        errors.append("flash contents changed")
+    print("{:34} {}".format(name, "FAILED" if errors else "OK"))
+    for e in errors[:10]:
+        print("    {}".format(e))
+    return errors
+
+
+def _run(name, width, dummy, words=64, read_mode=None, **kwargs):
+    random.seed(0)
+    bench = _Bench(width, dummy=dummy, with_engine=True, **kwargs)
+    model = SpiFlashModel(dummy=dummy)
+    model.data[:] = bytes(random.randrange(256) for i in range(len(model.data)))
+    errors = []
+    cycles = {}
+
+    def check():
+        if read_mode is not None:
+            yield from bench.flash.read_mode.write(read_mode)
+        cycles["sequential"] = yield from _read(bench, model, range(0x100, 0x100 + words), errors)
+        addresses = [random.randrange(len(model.data)//4) for i in range(words)]
+        cycles["random"] = yield from _read(bench, model, addresses, errors)
+        # A loop over the same few words.
+        loop = list(range(0x300, 0x300 + words//4))*4
+        cycles["loop"] = yield from _read(bench, model, loop, errors)
+        if bench.cache is not None:
+            # The counters are updated the cycle after the ack.
+            yield
+            cycles["hits"] = yield from bench.cache.hits.read()
+            cycles["misses"] = yield from bench.cache.misses.read()
+        # Taking the flash away from the reads must leave continuous mode.
+        yield from _check_engine(bench, model, errors)
+        yield from _read(bench, model, range(0x200, 0x210), errors)
+        if hasattr(bench.flash, "read_mode"):
+            yield from _check_modes(bench, model, errors)
+
+    run_simulation(bench, [check(), model.generator(bench.pads, bench.tristate())],
+        special_overrides={Tristate: _SimTristate})
+    errors += model.errors
+    print("{:34} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(
+        name, cycles["sequential"]/words, cycles["random"]/words, cycles["loop"]/words,
+        "FAILED" if errors else "OK"))
+    if bench.cache is not None:
+        print("    {} hits, {} misses".format(cycles["hits"], cycles["misses"]))
+    for e in errors[:10]:
+        print("    {}".format(e))
+    return errors
+
+
+def main():
+    print("{:34} {:>10} {:>10} {:>10}".format("", "sequential", "random", "loop"))
+    print("cycles per word, div=2")
+    errors = []
+    errors += _run("single", 1, 8)
+    errors += _run("single, continuous", 1, 8, continuous=True)
+    errors += _run("quad", 4, 10)
+    errors += _run("quad, continuous", 4, 10, continuous=True)
+    errors += _run("quad, continuous, XIP", 4, 10, continuous=True, mode_bits=0xa0)
+    errors += _run("dual, continuous, XIP", 2, 8, continuous=True, mode_bits=0xa0)
+    errors += _run("single, continuous, 1KB cache", 1, 8, continuous=True,
+        cache=dict(size=1024))
+    errors += _run("quad, continuous, 1KB 2-way cache", 4, 10, continuous=True,
+        cache=dict(size=1024, ways=2))
+    # QPI and DTR reads, N25Q.
+    print("div=4")
+    n25q = dict(div=4, model="n25q128", continuous=True)
+    errors += _run("quad, continuous", 4, 10, **n25q)
+    errors += _run("quad, continuous, QPI", 4, 10, read_mode=spi_flash.READ_QPI, **n25q)
+    errors += _run("quad, continuous, DTR", 4, 10, read_mode=spi_flash.READ_DTR, **n25q)
+    print("writes without an engine")
+    errors += _run_no_engine("single", 1, 8)
+    errors += _run_no_engine("single, continuous", 1, 8, continuous=True)
+    errors += _run_no_engine("quad, continuous", 4, 10, continuous=True)
+    errors += _run_no_engine("single, continuous, 1KB cache", 1, 8, continuous=True,
+        cache=dict(size=1024))
+    print("FAILED" if errors else "OK")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,40 @@
 #!/usr/bin/env python3
 
 import argparse
+import importlib
+import json
 import os
+import sys
+import time
 
-from litex.build.tools import write_to_file
-from litex.soc.integration.soc_sdram import *
-from litex.soc.integration.builder import *
+from tools import bram_patch
+from tools import build_history
+from tools import daemon
+from tools import gateware_cache
+from tools import manifest
+from tools import registry
 
+# litex is only imported by the functions which need it, so things like
+# `--list` don't pay for importing it.
 
-def get_args(parser, platform='opsis', target='hdmi2usb'):
+
+def get_platform_args(parser, platform='opsis', target='hdmi2usb'):
     parser.add_argument("--platform", action="store", default=os.environ.get('PLATFORM', platform))
     parser.add_argument("--target", action="store", default=os.environ.get('TARGET', target))
 
+
+def get_args(parser, platform='opsis', target='hdmi2usb'):
+    # Check --platform / --target before importing litex, so a typo is
+    # reported as quickly as --list.
+    platform_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    get_platform_args(platform_parser, platform, target)
+    platform_args, _ = platform_parser.parse_known_args()
+    check_args(parser, platform_args)
+
+    from litex.soc.integration.soc_sdram import soc_sdram_args
+
+    get_platform_args(parser, platform, target)
+
     soc_sdram_args(parser)
     parser.set_defaults(cpu_type=os.environ.get('CPU', 'lm32'))
     parser.set_defaults(cpu_variant=os.environ.get('CPU_VARIANT', None) or None)
@@ -24,6 +47,8 @@ def get_args(parser, platform='opsis', target='hdmi2usb'):
 
     parser.add_argument("--no-compile-firmware", action="store_true", help="do not compile the firmware")
     parser.add_argument("--override-firmware", action="store", default=None, help="override firmware with file")
+    parser.add_argument("--compress-firmware", action="store_true", default=os.environ.get('COMPRESS_FIRMWARE', '0') == '1', help="store the firmware LZ4 compressed in the flash image, behind a loader which decompresses it at boot")
+    parser.add_argument("--firmware-slots", action="store_true", default=os.environ.get('FIRMWARE_SLOTS', '0') == '1', help="store the firmware in A/B slots in the flash image, behind a loader which boots the newest valid one")
 
 
 def get_builddir(args):
@@ -46,24 +71,89 @@ def get_testdir(args):
     return testdir
 
 
+def check_args(parser, args):
+    error = registry.check(args.platform, args.target)
+    if error:
+        parser.error(error)
+
+
+# Elaborated (platform, soc, git state) kept by the build daemon
+# (tools/daemon.py), and the arguments of the SoCs elaborated without it.
+_elaborated = {}
+_elaborated_misses = []
+
+
+def get_elaboration_key(args):
+    from litex.soc.integration.soc_sdram import soc_sdram_argdict
+
+    return json.dumps([
+        args.platform, sorted(args.platform_option),
+        args.target.lower(), sorted(args.target_option),
+        args.iprange, soc_sdram_argdict(args),
+    ], sort_keys=True, default=str)
+
+
 def get_platform(args):
     assert args.platform is not None
-    exec("from platforms.{} import Platform".format(args.platform), globals())
-    return Platform(**dict(args.platform_option))
+    if _elaborated:
+        from gateware.info import git
+
+        key = get_elaboration_key(args)
+        entry = _elaborated.get(key)
+        if entry and entry[2] != git.state():
+            # The repository changed since, the SoC has stale git information.
+            del _elaborated[key]
+        elif entry:
+            return entry[0]
+    module = importlib.import_module("platforms.{}".format(args.platform))
+    return module.Platform(**dict(args.platform_option))
 
 
 def get_soc(args, platform):
-    exec("from targets.{}.{} import SoC".format(args.platform, args.target.lower(), args.target), globals())
+    from litex.soc.integration.soc_sdram import soc_sdram_argdict
+
+    if _elaborated:
+        # A SoC can only be built once, so it is only handed out once.
+        entry = _elaborated.pop(get_elaboration_key(args), None)
+        if entry and entry[0] is platform:
+            return entry[1]
+    _elaborated_misses.append(args)
+
+    # Resolve the git information once per build directory.
+    from gateware.info import git
+    git.cache_file = os.path.join(get_builddir(args), "git-info.json")
+
+    module = importlib.import_module("targets.{}.{}".format(args.platform, args.target.lower()))
+    SoC = module.SoC
     soc = SoC(platform, ident=SoC.__name__, **soc_sdram_argdict(args), **dict(args.target_option))
     if hasattr(soc, 'configure_iprange'):
         soc.configure_iprange(args.iprange)
     return soc
 
 
+# OpenOCD command selecting the adapter by serial number, older OpenOCD
+# versions need "ftdi_serial {}" (set $OPENOCD_SERIAL_COMMAND).
+OPENOCD_SERIAL_COMMAND = os.environ.get("OPENOCD_SERIAL_COMMAND", "adapter serial {}")
+
+
 def get_prog(args, platform):
     assert platform is not None
     prog = platform.create_programmer()
     prog.set_flash_proxy_dir(os.path.join("third_party","flash_proxies"))
+    serial = getattr(args, "programmer_serial", None)
+    if serial:
+        from litex.build.openocd import OpenOCD
+        assert isinstance(prog, OpenOCD), (
+            "Only OpenOCD programmers can be selected by serial number.")
+        # Wrap the board config in one picking the adapter, and without the
+        # gdb / telnet / tcl servers so several OpenOCDs can run at once.
+        config = os.path.join(get_builddir(args), "openocd-{}.cfg".format(serial))
+        os.makedirs(os.path.dirname(config), exist_ok=True)
+        with open(config, "w") as f:
+            f.write(OPENOCD_SERIAL_COMMAND.format(serial) + "\n")
+            f.write("gdb_port disabled\ntelnet_port disabled\ntcl_port disabled\n")
+            f.write("source [find {}]\n".format(prog.config))
+        prog.config = os.path.abspath(config)
     return prog
 
 
@@ -110,17 +200,100 @@ def get_firmware(builddir, filetype="flash"):
         assert False, "Unknown file type %s" % filetype
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Opsis LiteX SoC", conflict_handler='resolve')
-    get_args(parser)
-    builder_args(parser)
-    soc_sdram_args(parser)
+def get_loader(builddir, filetype="flash"):
+    basedir = os.path.join(builddir, "software", "loader", "loader")
+    if filetype in ("flash",):
+        return basedir + ".fbi"
+    elif filetype in ("debug",):
+        return basedir + ".elf"
+    else:
+        assert False, "Unknown file type %s" % filetype
 
-    args = parser.parse_args()
 
-    platform = get_platform(args)
+def get_artifacts(builddir):
+    return {
+        "gateware_bit": get_gateware(builddir, "load"),
+        "gateware_bin": get_gateware(builddir, "flash"),
+        "bios": get_bios(builddir, "flash"),
+        "firmware_bin": get_firmware(builddir, "load"),
+        "firmware_fbi": get_firmware(builddir, "flash"),
+        "loader_fbi": get_loader(builddir, "flash"),
+    }
+
 
-    soc = get_soc(args, platform)
+def write_manifest(args, platform, soc):
+    builddir = get_builddir(args)
+    m = manifest.create(
+        args, platform, soc, get_artifacts(builddir), get_bios_maxsize(args, soc))
+    manifest.write(builddir, m)
+    return m
+
+
+def get_manifest(args):
+    """Get the build manifest, elaborating the SoC if it is missing or stale."""
+    m = manifest.load(get_builddir(args), args)
+    if m is None:
+        print("Build manifest missing or out of date, elaborating the SoC.")
+        platform = get_platform(args)
+        soc = get_soc(args, platform)
+        m = write_manifest(args, platform, soc)
+    return m
+
+
+class GatewareLookup:
+    """Looks the toolchain inputs up in the gateware cache.
+
+    It is passed to the platform toolchain as `run`, which the toolchain only
+    tests once the Verilog, memory contents and constraints are written. The
+    bitstream is restored (or patched) from the cache and the toolchain
+    skipped, or on a miss the toolchain runs on the inputs which were hashed.
+    """
+    def __init__(self, args, platform, gateware_dir, timer):
+        self.cwd = os.getcwd()
+        self.args = args
+        self.platform = platform
+        self.gateware_dir = gateware_dir
+        self.timer = timer
+        self.key = None
+        self.design_key = None
+        self.status = None
+        self.placeholders = False
+
+    def lookup(self):
+        self.key = gateware_cache.get_key(self.gateware_dir, self.platform, self.args.build_option)
+        # The same key without the memory contents (BIOS, firmware, ...).
+        self.design_key = gateware_cache.get_key(
+            self.gateware_dir, self.platform, self.args.build_option, ignore_extensions=(".init",))
+        if gateware_cache.restore(self.key, self.gateware_dir):
+            print("Gateware cache hit ({}), not running the FPGA toolchain.".format(self.key[:16]))
+            return "cached"
+        with self.timer.stage("bram-patch"):
+            patched = bram_patch.patch(self.gateware_dir, self.platform, self.design_key)
+        if patched:
+            gateware_cache.store(self.key, self.gateware_dir)
+            return "patched"
+        print("Gateware cache miss ({}), running the FPGA toolchain.".format(self.key[:16]))
+        # Build with random memory contents, so the real ones can be patched
+        # in now and on the next builds.
+        self.placeholders = bram_patch.prepare(self.gateware_dir, self.platform)
+        return "built"
+
+    def __bool__(self):
+        if self.status is None:
+            # Toolchains change into the gateware directory to write the
+            # inputs, the paths here are relative to the top of the tree.
+            cwd = os.getcwd()
+            os.chdir(self.cwd)
+            try:
+                self.status = self.lookup()
+            finally:
+                os.chdir(cwd)
+        return self.status == "built"
+
+
+def build(args, platform, soc, compile_gateware=True, compile_software=True, timer=None):
+    from litex.soc.integration.builder import builder_argdict
+    from tools.builder import Builder
 
     builddir = get_builddir(args)
     testdir = get_testdir(args)
@@ -128,12 +301,17 @@ def main():
     buildargs = builder_argdict(args)
     if not buildargs.get('output_dir', None):
         buildargs['output_dir'] = builddir
+    if compile_gateware is not True:
+        # False, or a GatewareLookup which decides once the inputs are written.
+        buildargs['compile_gateware'] = compile_gateware
+    if not compile_software:
+        buildargs['compile_software'] = False
 
     if hasattr(soc, 'cpu_type'):
         if not buildargs.get('csr_csv', None):
             buildargs['csr_csv'] = os.path.join(testdir, "csr.csv")
 
-        builder = Builder(soc, **buildargs)
+        builder = Builder(soc, timer=timer, jobs=args.jobs, **buildargs)
         if not args.no_compile_firmware or args.override_firmware:
             builder.add_software_package("uip", "{}/firmware/uip".format(os.getcwd()))
 
@@ -143,11 +321,107 @@ def main():
             # should be refined (perhaps soc attribute?).
             if "main_ram" in (m[0] for m in soc.get_memory_regions()):
                 builder.add_software_package("firmware", "{}/firmware".format(os.getcwd()))
+                if args.compress_firmware or args.firmware_slots:
+                    builder.add_software_package("loader", "{}/firmware/loader".format(os.getcwd()))
             else:
                 builder.add_software_package("stub", "{}/firmware/stub".format(os.getcwd()))
+        start = time.time()
         vns = builder.build(**dict(args.build_option))
+        if builder.software_end is not None:
+            start = builder.software_end
     else:
-        vns = platform.build(soc, build_dir=os.path.join(builddir, "gateware"))
+        start = time.time()
+        vns = platform.build(soc, build_dir=os.path.join(builddir, "gateware"),
+                             run=buildargs['compile_gateware'])
+    if timer is not None:
+        timer.add_gateware(platform, os.path.join(builddir, "gateware"), start, time.time(),
+                           run=buildargs['compile_gateware'])
+    return vns
+
+
+def profile_elaboration(args):
+    from tools.elaboration_profile import ElaborationProfiler
+
+    builddir = get_builddir(args)
+    os.makedirs(builddir, exist_ok=True)
+
+    with ElaborationProfiler() as profiler:
+        with profiler.phase("platform"):
+            platform = get_platform(args)
+        with profiler.phase("soc"):
+            soc = get_soc(args, platform)
+        with profiler.phase("finalize"):
+            fragment = soc.get_fragment()
+        with profiler.phase("verilog"):
+            platform.get_verilog(fragment)
+
+    profiler.report()
+    folded = os.path.join(builddir, "elaboration.folded")
+    profiler.write_folded(folded)
+    print("Flame graph data (folded stacks, microseconds) written to {}".format(folded))
+
+
+def main():
+    list_parser = argparse.ArgumentParser(add_help=False)
+    list_parser.add_argument("--list", action="store_true", help="list the available platforms and targets")
+
+    # Handle --list before anything imports litex.
+    args, _ = list_parser.parse_known_args()
+    if args.list:
+        registry.print_list(registry.load())
+        return
+
+    parser = argparse.ArgumentParser(description="Opsis LiteX SoC", conflict_handler='resolve', parents=[list_parser])
+    get_args(parser)
+
+    from litex.build.tools import write_to_file
+    from litex.soc.integration.soc_sdram import soc_sdram_args
+    from litex.soc.integration.builder import builder_args
+
+    builder_args(parser)
+    soc_sdram_args(parser)
+
+    parser.add_argument("--no-gateware-cache", action="store_true", help="always run the FPGA toolchain, even if the gateware cache has a matching bitstream")
+    parser.add_argument("--profile-elaboration", action="store_true", help="report the time and memory used elaborating the SoC, then exit")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of jobs used compiling the software packages (default: -j from MAKEFLAGS or the CPU count)")
+    parser.add_argument("--build-report", action="store_true", help="compare the stage times of the last build against previous builds, then exit")
+
+    args = parser.parse_args()
+    check_args(parser, args)
+
+    if args.profile_elaboration:
+        profile_elaboration(args)
+        return
+
+    if args.build_report:
+        return build_history.report(args)
+
+    timer = build_history.BuildTimer()
+
+    with timer.stage("elaboration"):
+        platform = get_platform(args)
+
+        soc = get_soc(args, platform)
+
+    builddir = get_builddir(args)
+    testdir = get_testdir(args)
+
+    if args.no_compile_gateware or args.no_gateware_cache:
+        vns = build(args, platform, soc, timer=timer)
+        timer.gateware = "skipped" if args.no_compile_gateware else "built"
+    else:
+        gateware_dir = os.path.join(builddir, "gateware")
+        lookup = GatewareLookup(args, platform, gateware_dir, timer)
+        vns = build(args, platform, soc, compile_gateware=lookup, timer=timer)
+        assert lookup.status is not None, "The toolchain never checked whether to run."
+        if lookup.status == "built":
+            if lookup.placeholders:
+                with timer.stage("bram-patch"):
+                    bram_patch.finish(gateware_dir, platform, lookup.design_key)
+            gateware_cache.store(lookup.key, gateware_dir)
+        timer.gateware = lookup.status
+
+    write_manifest(args, platform, soc)
 
     if hasattr(soc, 'pcie_phy'):
         from targets.common import cpu_interface
@@ -159,6 +433,9 @@ def main():
     if hasattr(soc, 'do_exit'):
         soc.do_exit(vns, filename="{}/analyzer.csv".format(testdir))
 
+    build_history.record(args, timer)
+
 
 if __name__ == "__main__":
-    main()
+    daemon.client("make")
+    sys.exit(main())
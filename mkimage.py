@@ -5,8 +5,82 @@ Flash image creation tool.
 
 import os
 import argparse
+import mmap
+import zlib
 
 import make
+from tools import daemon
+from tools import firmware_slots
+from tools import lz4
+from tools import region_table
+
+
+# Size of the chunks files are copied / the image padded in.
+COPY_CHUNK = 1024*1024
+PAD_CHUNK = 1024*1024
+
+
+def copy_region(image, pos, filename):
+    """Copy filename into the image at pos, returns the length and CRC32."""
+    length = 0
+    crc = 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+            image[pos+length:pos+length+len(chunk)] = chunk
+            crc = zlib.crc32(chunk, crc)
+            length += len(chunk)
+    return length, crc
+
+
+def read_firmware(firmware, compress=False):
+    """The firmware without its .fbi header, LZ4 compressed if compress."""
+    with open(firmware, "rb") as f:
+        # The loader checks the data itself, the .fbi header isn't needed.
+        data = f.read()[8:]
+    if compress:
+        return lz4.pack_firmware(data)
+    return data
+
+
+def compress_firmware(loader, firmware, output):
+    """Write the loader followed by the LZ4 compressed firmware to output."""
+    with open(loader, "rb") as f:
+        data = f.read()
+    data += b"\xff"*(-len(data) % 4)
+    data += read_firmware(firmware, compress=True)
+    with open(output, "wb") as f:
+        f.write(data)
+    print("Compressed {} to {} ({} bytes with the loader)".format(
+        firmware, output, len(data)))
+    return output
+
+
+def slot_firmware(loader, firmware, compress, flash, output_dir):
+    """Write the loader and the firmware in slot A, returns their regions."""
+    layout = firmware_slots.layout(flash)
+    files = {}
+
+    with open(loader, "rb") as f:
+        data = f.read()
+    data += b"\xff"*(-len(data) % 4)
+    files["selector"] = data + firmware_slots.pack_record(layout)
+
+    files["slot_a"] = read_firmware(firmware, compress)
+    header = firmware_slots.make_header("a", 1, files["slot_a"])
+    files["header_a"] = firmware_slots.pack_header(header)
+
+    regions = []
+    for name, label, desc in (
+            ("selector", "Selector", "Firmware loader picking the newest valid slot"),
+            ("header_a", "Header A", "Firmware slot A header (sequence 1)"),
+            ("slot_a", "  Slot A", "Firmware slot A{}".format(
+                ", LZ4 compressed" if compress else ""))):
+        filename = os.path.join(output_dir, "firmware-{}.bin".format(name.replace("_", "-")))
+        with open(filename, "wb") as f:
+            f.write(files[name])
+        pos, size = layout[name]
+        regions.append((name, label, pos, filename, size + 1, desc))
+    return regions
 
 
 def main():
@@ -20,6 +94,7 @@ def main():
     parser.add_argument("--force-image-size")
 
     args = parser.parse_args()
+    make.check_args(parser, args)
 
     builddir = make.get_builddir(args)
     if os.path.sep not in args.output_file:
@@ -67,86 +142,115 @@ def main():
         assert firmware.endswith('.fbi'), (
             "Firmware must be a MiSoC .fbi image.")
 
-    platform = make.get_platform(args)
-    soc = make.get_soc(args, platform)
-    bios_size = make.get_bios_maxsize(args, soc)
+    loader = None
+    if firmware and (args.compress_firmware or args.firmware_slots):
+        loader = make.get_loader(builddir, "flash")
+        assert os.path.exists(loader), (
+            "Loader %r not found! "
+            "Build with --compress-firmware or --firmware-slots to compile it." % loader)
 
-    gateware_pos = 0
-    bios_pos = platform.gateware_size
-    firmware_pos = platform.gateware_size + bios_size
+    flash = make.get_manifest(args)["flash"]
+    gateware_size = flash["gateware_size"]
+    bios_size = flash["bios_maxsize"]
+    spiflash_total_size = flash["total_size"]
 
-    print()
-    with open(output_file, "wb") as f:
-        # FPGA gateware
-        if gateware:
-            gateware_data = open(gateware, "rb").read()
-        else:
-            gateware_data = b""
-            gateware = "Skipped"
-
-        print(("Gateware @ 0x{:08x} ({:10} bytes) {:60}"
-               " - Xilinx FPGA Bitstream"
-               ).format(gateware_pos, len(gateware_data), gateware))
-        print(" ".join("{:02x}".format(i) for i in gateware_data[:64]))
-        assert len(gateware_data) < platform.gateware_size
-        f.seek(0)
-        f.write(gateware_data)
-
-        if bios:
-            bios_data = open(bios, "rb").read()
-        else:
-            bios_data = b""
-            bios = "Skipped"
-
-        # LiteX BIOS
-        assert len(bios_data) < bios_size
-        f.seek(bios_pos)
-        f.write(bios_data)
-        print(("    BIOS @ 0x{:08x} ({:10} bytes) {:60}"
-               " - LiteX BIOS with CRC"
-               ).format(bios_pos, len(bios_data), bios))
-        print(" ".join("{:02x}".format(i) for i in bios_data[:64]))
-
-        if firmware:
-            firmware_data = open(firmware, "rb").read()
+    gateware_pos = flash["gateware_offset"]
+    bios_pos = flash["bios_offset"]
+    firmware_pos = flash["firmware_offset"]
+
+    # (name, label, position, file, maximum size, description)
+    regions = [
+        ("gateware", "Gateware", gateware_pos, gateware,
+         gateware_size - region_table.TABLE_SIZE, "Xilinx FPGA Bitstream"),
+        ("bios", "    BIOS", bios_pos, bios,
+         bios_size, "LiteX BIOS with CRC"),
+    ]
+    if loader and args.firmware_slots:
+        regions += slot_firmware(
+            loader, firmware, args.compress_firmware, flash, output_dir)
+    else:
+        if loader:
+            firmware = compress_firmware(
+                loader, firmware, os.path.join(output_dir, "firmware-lz4.fbi"))
+        regions.append(
+            ("firmware", "Firmware", firmware_pos, firmware,
+             spiflash_total_size - firmware_pos + 1,
+             "{} Firmware in FBI format (loaded into DRAM){}".format(
+                 args.firmware_name, ", LZ4 compressed" if loader else "")))
+
+    table_pos = region_table.table_offset(flash)
+    image_size = table_pos + region_table.TABLE_SIZE
+    firmware_end = firmware_pos
+    for name, label, pos, filename, maxsize, desc in regions:
+        if not filename:
+            continue
+        size = os.path.getsize(filename)
+        assert size < maxsize, "{} is too big! {} bytes doesn't fit in {} bytes.".format(
+            filename, size, maxsize - 1)
+        image_size = max(image_size, pos + size)
+        if name == "firmware":
+            firmware_end = pos + size
+        elif name == "slot_a":
+            # Space left for the firmware in each slot.
+            firmware_end = spiflash_total_size - maxsize + 1 + size
+
+    flash_size = None
+    if args.force_image_size:
+        if args.force_image_size.lower() in ("true", "1"):
+            flash_size = spiflash_total_size
         else:
-            firmware_data = b""
-            firmware = "Skipped"
-
-        # SoftCPU firmware
-        print(("Firmware @ 0x{:08x} ({:10} bytes) {:60}"
-               " - {} Firmware in FBI format (loaded into DRAM)"
-               ).format(
-                   firmware_pos, len(firmware_data), firmware,
-                   args.firmware_name))
-        print(" ".join("{:02x}".format(i) for i in firmware_data[:64]))
-        f.seek(firmware_pos)
-        f.write(firmware_data)
-
-        # Result
-        remain = platform.spiflash_total_size - (
-            firmware_pos+len(firmware_data))
-        print("-"*40)
-        print(("       Remaining space {:10} bytes"
-               " ({} Megabits, {:.2f} Megabytes)"
-               ).format(remain, int(remain*8/1024/1024), remain/1024/1024))
-        total = platform.spiflash_total_size
-        print(("           Total space {:10} bytes"
-               " ({} Megabits, {:.2f} Megabytes)"
-               ).format(total, int(total*8/1024/1024), total/1024/1024))
-
-        if args.force_image_size:
-            if args.force_image_size.lower() in ("true", "1"):
-                flash_size = platform.spiflash_total_size
-            else:
-                flash_size = int(args.force_image_size)
-            f.write(b'\xff' * (flash_size - f.tell()))
+            flash_size = int(args.force_image_size)
+        assert flash_size >= image_size, "Image is bigger than --force-image-size"
+
+    # The output file is created at its final size and only the regions are
+    # written, the ranges between them stay sparse.
+    print()
+    with open(output_file, "w+b") as f:
+        f.truncate(image_size)
+        with mmap.mmap(f.fileno(), image_size) as image:
+            table = []
+            for name, label, pos, filename, maxsize, desc in regions:
+                if filename:
+                    length, crc = copy_region(image, pos, filename)
+                    table.append(region_table.Region(name, pos, length, crc))
+                else:
+                    length = 0
+                    filename = "Skipped"
+                print("{} @ 0x{:08x} ({:10} bytes) {:60} - {}".format(
+                    label, pos, length, filename, desc))
+                print(" ".join("{:02x}".format(i) for i in image[pos:pos+min(length, 64)]))
+
+            image[table_pos:table_pos+region_table.TABLE_SIZE] = region_table.pack(table)
+            print(("  Region table @ 0x{:08x} ({:6} bytes, {} regions)"
+                   ).format(table_pos, region_table.TABLE_SIZE, len(table)))
+
+            first_bytes = image[:64]
+
+        if flash_size is not None:
+            # Pad to the flash size with erased (0xff) bytes.
+            f.seek(image_size)
+            padding = b"\xff"*PAD_CHUNK
+            remain = flash_size - image_size
+            while remain > 0:
+                f.write(padding[:remain])
+                remain -= PAD_CHUNK
+
+    # Result
+    remain = spiflash_total_size - firmware_end
+    print("-"*40)
+    print(("       Remaining space {:10} bytes"
+           " ({} Megabits, {:.2f} Megabytes)"
+           ).format(remain, int(remain*8/1024/1024), remain/1024/1024))
+    total = spiflash_total_size
+    print(("           Total space {:10} bytes"
+           " ({} Megabits, {:.2f} Megabytes)"
+           ).format(total, int(total*8/1024/1024), total/1024/1024))
 
     print()
     print("Flash image: {}".format(output_file))
-    flash_image_data = open(output_file, "rb").read()
-    print(" ".join("{:02x}".format(i) for i in flash_image_data[:64]))
+    print(" ".join("{:02x}".format(i) for i in first_bytes))
 
 
 if __name__ == "__main__":
+    daemon.client("mkimage")
     main()
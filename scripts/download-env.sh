@@ -382,6 +382,12 @@ echo "Installing colorama (python module)"
 pip install --upgrade colorama
 check_import colorama
 
+# numpy for comparing flash contents and pattern frames in test/
+echo
+echo "Installing numpy (python module)"
+conda install -y $CONDA_FLAGS numpy
+check_import numpy
+
 # hexfile for embedding the Cypress FX2 firmware.
 echo
 echo "Installing hexfile (python module)"
@@ -374,6 +374,12 @@ check_import progressbar || return 1
 
 check_import colorama || return 1
 
+# numpy for comparing flash contents and pattern frames in test/
+
+
+
+check_import numpy || return 1
+
 # hexfile for embedding the Cypress FX2 firmware.
 
 
@@ -109,6 +109,7 @@ class BaseSoC(SoCSDRAM):
         "cas",
 #        "leds",
 #        "rgb_leds",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -150,7 +151,8 @@ class BaseSoC(SoCSDRAM):
                 spiflash_pads,
                 dummy=spiflash_dummy[spiflash],
                 div=platform.spiflash_clock_div,
-                endianness=self.cpu.endianness)
+                endianness=self.cpu.endianness,
+                with_engine=True)
         self.add_constant("SPIFLASH_PAGE_SIZE", 256)
         self.add_constant("SPIFLASH_SECTOR_SIZE", 0x10000)
         self.add_wb_slave(mem_decoder(self.mem_map["spiflash"]), self.spiflash.bus)
@@ -182,6 +182,7 @@ class BaseSoC(SoCSDRAM):
 #        "cas",
         "ddrphy",
         "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -207,7 +208,8 @@ class BaseSoC(SoCSDRAM):
         self.submodules.spiflash = spi_flash.SpiFlash(
             platform.request("spiflash4x"),
             dummy=platform.spiflash_read_dummy_bits,
-            div=platform.spiflash_clock_div)
+            div=platform.spiflash_clock_div,
+            model=platform.spiflash_model)
         self.add_constant("SPIFLASH_PAGE_SIZE", platform.spiflash_page_size)
         self.add_constant("SPIFLASH_SECTOR_SIZE", platform.spiflash_sector_size)
         self.register_mem("spiflash", self.mem_map["spiflash"],
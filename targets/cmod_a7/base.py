@@ -28,6 +28,7 @@ class BaseSoC(SoCCore):
     csr_peripherals = (
         "spiflash",
         "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCCore.csr_map, csr_peripherals)
 
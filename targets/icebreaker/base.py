@@ -12,6 +12,8 @@ from litex.soc.integration.builder import *
 
 from gateware import up5kspram
 from gateware import cas
+from gateware import flash_cache
+from gateware import info
 from gateware import spi_flash
 
 from targets.utils import csr_map_update
@@ -61,6 +63,9 @@ class BaseSoC(SoCCore):
     csr_peripherals = (
         "spiflash",
         "cas",
+        "spiflash_cache",
+        "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCCore.csr_map, csr_peripherals)
 
@@ -91,6 +96,11 @@ class BaseSoC(SoCCore):
         # Control and Status
         self.submodules.cas = cas.ControlAndStatus(platform, clk_freq)
 
+        # Info. The git information ROM is the one memory whose contents change
+        # from build to build, they are patched into the previous bitstream
+        # (tools/bram_patch.py) when nothing else changed.
+        self.submodules.info = info.Info(platform, self.__class__.__name__)
+
         # SPI flash peripheral
         # TODO: Inferred tristate not currently supported by nextpnr; upgrade
         # to spiflash4x when possible.
@@ -98,11 +108,14 @@ class BaseSoC(SoCCore):
             platform.request("spiflash"),
             dummy=platform.spiflash_read_dummy_bits,
             div=platform.spiflash_clock_div,
-            endianness=self.cpu.endianness)
+            endianness=self.cpu.endianness,
+            continuous=True)
         self.add_constant("SPIFLASH_PAGE_SIZE", platform.spiflash_page_size)
         self.add_constant("SPIFLASH_SECTOR_SIZE", platform.spiflash_sector_size)
+        self.submodules.spiflash_cache = flash_cache.FlashCache(
+            self.spiflash.bus, size=4096, line_words=8, ways=2)
         self.register_mem("spiflash", self.mem_map["spiflash"],
-            self.spiflash.bus, size=platform.spiflash_total_size)
+            self.spiflash_cache.bus, size=platform.spiflash_total_size)
 
         bios_size = 0x8000
         self.add_constant("ROM_DISABLE", 1)
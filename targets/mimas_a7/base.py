@@ -85,6 +85,7 @@ class BaseSoC(SoCSDRAM):
         "spiflash",
         "ddrphy",
         "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
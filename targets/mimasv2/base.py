@@ -16,6 +16,7 @@ from litedram.core import ControllerSettings
 
 from gateware import info
 from gateware import cas
+from gateware import flash_cache
 from gateware import spi_flash
 
 from targets.utils import csr_map_update
@@ -180,6 +181,8 @@ class BaseSoC(SoCSDRAM):
         "ddrphy",
         "info",
         "cas",
+        "info_git_extradata",
+        "spiflash_cache",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -214,11 +217,14 @@ class BaseSoC(SoCSDRAM):
         self.submodules.spiflash = spi_flash.SpiFlashSingle(
             platform.request("spiflash"),
             dummy=platform.spiflash_read_dummy_bits,
-            div=platform.spiflash_clock_div)
+            div=platform.spiflash_clock_div,
+            continuous=True)
         self.add_constant("SPIFLASH_PAGE_SIZE", platform.spiflash_page_size)
         self.add_constant("SPIFLASH_SECTOR_SIZE", platform.spiflash_sector_size)
+        self.submodules.spiflash_cache = flash_cache.FlashCache(
+            self.spiflash.bus, size=4096, line_words=8, ways=2)
         self.register_mem("spiflash", self.mem_map["spiflash"],
-            self.spiflash.bus, size=platform.spiflash_total_size)
+            self.spiflash_cache.bus, size=platform.spiflash_total_size)
 
         bios_size = 0x8000
         self.add_constant("ROM_DISABLE", 1)
@@ -75,6 +75,7 @@ class BaseSoC(SoCSDRAM):
         "cas",
         "ddrphy",
         "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -86,6 +86,7 @@ class BaseSoC(SoCSDRAM):
         "generator",
         "checker",
         "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -87,6 +87,7 @@ class BaseSoC(SoCSDRAM):
         "ddrphy",
         "info",
         "oled",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
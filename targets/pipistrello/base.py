@@ -178,6 +178,7 @@ class BaseSoC(SoCSDRAM):
         "front_panel",
         "ddrphy",
         "info",
+        "info_git_extradata",
     )
     csr_map_update(SoCSDRAM.csr_map, csr_peripherals)
 
@@ -3,6 +3,7 @@ import argparse
 import os
 import sys
 import threading
+import time
 
 from litex.soc.tools.remote import RemoteServer
 from litex.soc.tools.remote import RemoteClient
@@ -12,6 +13,7 @@ TOP_DIR=os.path.join(os.path.dirname(__file__), "..")
 
 sys.path.append(TOP_DIR)
 from make import get_args, get_testdir
+from gateware.info.git import INFO_SIZE, decode_info
 
 
 class ServerProxy(threading.Thread):
@@ -57,8 +59,16 @@ def connect(desc, *args, add_args=None, **kw):
     wb.open()
     print()
     print("Device DNA: {}".format(get_dna(wb)))
-    print("   Git Rev: {}".format(get_git(wb)))
-    print("  Platform: {}".format(get_platform(wb)))
+    info = get_build_info(wb)
+    if info:
+        print("   Git Rev: {} ({})".format(info.get("describe"), info.get("commit")))
+        print("  Platform: {} on {}".format(info.get("target"), info.get("platform")))
+        print("     Built: {} on {} with {}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(info.get("time", 0)))),
+            info.get("host"), info.get("toolchain")))
+    else:
+        print("   Git Rev: {}".format(get_git(wb)))
+        print("  Platform: {}".format(get_platform(wb)))
     print("  Analyzer: {}".format(["No", "Yes"][hasattr(wb.regs, "analyzer")]))
     print("      XADC: {}".format(get_xadc(wb)))
     print()
@@ -86,6 +96,15 @@ def get_dna(wb):
         return 'Unknown'
 
 
+def get_build_info(wb):
+    """Read the build information ROM in one burst, None if there isn't one."""
+    try:
+        base = wb.bases.info_git_extradata
+    except (KeyError, AttributeError) as e:
+        return None
+    return decode_info(d & 0xff for d in wb.read(base, INFO_SIZE))
+
+
 def get_git(wb):
     try:
         commit = wb.regs.info_git_commit.read()
@@ -150,26 +169,68 @@ def memdump(wb, start, length):
             print("{:02x}".format(b), end=' ')
 
 
+import collections
 import struct
 
-BLOCK_SIZE=64
+# An Etherbone record holds at most 255 reads.
+MAX_BURST = 255
+
+
+def read_bytes(wb, start, length, inflight=8):
+    """Read length bytes from start with the biggest Etherbone bursts, keeping
+    inflight requests outstanding so the link isn't idle waiting for replies."""
+    from litex.soc.tools.remote.etherbone import EtherbonePacket, EtherboneRecord, EtherboneReads
+
+    assert start % 4 == 0
+    base = getattr(wb, "base_address", 0) + start
+    count = (length + 3) // 4
+    data = bytearray()
+    pending = collections.deque()
+    pos = 0
+    while pos < count or pending:
+        while pos < count and len(pending) < inflight:
+            n = min(MAX_BURST, count - pos)
+            record = EtherboneRecord()
+            record.reads = EtherboneReads(addrs=[base + 4*(pos + j) for j in range(n)])
+            record.rcount = len(record.reads)
+            packet = EtherbonePacket()
+            packet.records = [record]
+            packet.encode()
+            wb.send_packet(wb.socket, packet)
+            pending.append(n)
+            pos += n
+        n = pending.popleft()
+        packet = EtherbonePacket(wb.receive_packet(wb.socket))
+        packet.decode()
+        words = packet.records.pop().writes.get_datas()
+        assert len(words) == n, "Expected {} words, got {}".format(n, len(words))
+        data += struct.pack(">{}I".format(n), *words)
+    return bytes(data[:length])
+
+
+def mismatches(expected, actual):
+    """The (start, end) byte ranges where expected and actual differ."""
+    import numpy
+
+    differ = numpy.frombuffer(expected, numpy.uint8) != numpy.frombuffer(actual, numpy.uint8)
+    idx = numpy.flatnonzero(differ)
+    if not len(idx):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(idx) > 1)
+    starts = numpy.concatenate(([idx[0]], idx[breaks + 1]))
+    ends = numpy.concatenate((idx[breaks], [idx[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
 def cmpflash(wb, start, filename, skip=0, max=1024):
     assert skip%4==0
     with open(filename, 'rb') as f:
-        local_data=f.read()[:skip+max]
-    j = skip
-    while j < len(local_data):
-        mem_data_len = min(BLOCK_SIZE, len(local_data)-j)
-        mem_data = b"".join(struct.pack('>I', k) for k in wb.read(start+j, mem_data_len))
-        for i in range(0, mem_data_len):
-            addr, expected, actual = j+i+start, local_data[j+i], mem_data[i]
-            if addr % 8 == 0:
-                print()
-                print("0x{:08x} ".format(addr), sep=' ', end='')
-            if expected != actual:
-                print()
-                print("{:08x} {:02x} != {:02x}".format(addr, expected, actual))
-            else:
-                print(".", end="", flush=True)
-        j += BLOCK_SIZE
-
+        local_data=f.read()[skip:skip+max]
+    mem_data = read_bytes(wb, start+skip, len(local_data))
+    ranges = mismatches(local_data, mem_data)
+    for begin, end in ranges:
+        print("0x{:08x}-0x{:08x} ({} bytes) differ, first {:02x} != {:02x}".format(
+            start+skip+begin, start+skip+end, end-begin, local_data[begin], mem_data[begin]))
+    if not ranges:
+        print("0x{:08x}-0x{:08x} match".format(start+skip, start+skip+len(local_data)))
+    return ranges
@@ -0,0 +1,171 @@
+"""
+Batched CSR accesses over Etherbone.
+
+Each wb.regs.X.write() or read() is an Etherbone packet of its own, and a
+read waits for its reply before anything else is sent. Within a CSRBatch
+the accesses are queued instead, and sent together when the batch ends (or
+when the result of one of its reads is needed):
+
+    with CSRBatch(wb) as batch:
+        batch.regs.hdmi_out0_core_initiator_hres.write(1920)
+        ...
+        phase = batch.regs.hdmi_in0_data0_cap_phase.read()
+    print(phase.result())
+
+Writes to consecutive addresses, and the reads which follow them, share an
+Etherbone record (the writes of a record are done before its reads, so the
+order of the accesses is kept). litex_server takes one record per packet,
+so the records are sent back to back, the replies are only read once all of
+them went out: a batch costs a single round trip.
+"""
+
+from litex.soc.tools.remote.etherbone import EtherbonePacket, EtherboneRecord
+from litex.soc.tools.remote.etherbone import EtherboneReads, EtherboneWrites
+
+
+# An Etherbone record holds at most 255 reads and 255 writes.
+MAX_BURST = 255
+
+
+class CSRFuture:
+    """The value of a queued read, result() sends the batch if needed."""
+    def __init__(self, batch, combine):
+        self._batch = batch
+        self._combine = combine
+        self._done = False
+        self._value = None
+
+    def done(self):
+        return self._done
+
+    def set_datas(self, datas):
+        self._value = self._combine(datas)
+        self._done = True
+
+    def result(self):
+        if not self._done:
+            self._batch.flush()
+        assert self._done, "Read was not sent"
+        return self._value
+
+
+class _Record:
+    def __init__(self):
+        self.base = None
+        self.writes = []
+        self.reads = []
+        # (future, number of words) of each read, in order.
+        self.futures = []
+
+
+class _BatchRegister:
+    def __init__(self, batch, reg):
+        self._batch = batch
+        self._reg = reg
+
+    def read(self):
+        reg = self._reg
+        if reg.mode not in ["rw", "ro"]:
+            raise KeyError(reg.name + " register not readable")
+
+        def combine(datas):
+            value = 0
+            for data in datas:
+                value = (value << reg.data_width) | data
+            return value
+        return self._batch.read(reg.addr, reg.length, combine)
+
+    def write(self, value):
+        reg = self._reg
+        if reg.mode not in ["rw", "wo"]:
+            raise KeyError(reg.name + " register not writable")
+        datas = []
+        for i in range(reg.length):
+            datas.append((value >> ((reg.length-1-i)*reg.data_width)) & (2**reg.data_width-1))
+        self._batch.write(reg.addr, datas)
+
+
+class _BatchRegisters:
+    def __init__(self, batch, regs):
+        self._batch = batch
+        self._regs = regs
+
+    def __getattr__(self, name):
+        return _BatchRegister(self._batch, getattr(self._regs, name))
+
+
+class CSRBatch:
+    def __init__(self, wb):
+        self.wb = wb
+        self.regs = _BatchRegisters(self, wb.regs)
+        self.base_address = getattr(wb, "base_address", 0)
+        self.records = []
+        self.packets = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def _record(self):
+        if not self.records:
+            self.records.append(_Record())
+        return self.records[-1]
+
+    def write(self, addr, datas):
+        """Queue writes of datas to consecutive words from addr."""
+        datas = datas if isinstance(datas, list) else [datas]
+        addr = self.base_address + addr
+        record = self._record()
+        if (record.reads or (record.writes and addr != record.base + 4*len(record.writes)) or
+                len(record.writes) + len(datas) > MAX_BURST):
+            record = _Record()
+            self.records.append(record)
+        if not record.writes:
+            record.base = addr
+        record.writes += datas
+
+    def read(self, addr, length=1, combine=None):
+        """Queue reads of length words from addr, returns a CSRFuture of the
+        list of words (or of what combine makes of it)."""
+        assert length <= MAX_BURST
+        addr = self.base_address + addr
+        future = CSRFuture(self, combine or (lambda datas: datas))
+        record = self._record()
+        if len(record.reads) + length > MAX_BURST:
+            record = _Record()
+            self.records.append(record)
+        record.reads += [addr + 4*i for i in range(length)]
+        record.futures.append((future, length))
+        return future
+
+    def flush(self):
+        """Send the queued accesses, and wait for the reads."""
+        wb = self.wb
+        records, self.records = self.records, []
+        for r in records:
+            record = EtherboneRecord()
+            if r.writes:
+                record.writes = EtherboneWrites(base_addr=r.base, datas=r.writes)
+                record.wcount = len(record.writes)
+            if r.reads:
+                record.reads = EtherboneReads(addrs=r.reads)
+                record.rcount = len(record.reads)
+            packet = EtherbonePacket()
+            packet.records = [record]
+            packet.encode()
+            wb.send_packet(wb.socket, packet)
+            self.packets += 1
+        for r in records:
+            if not r.reads:
+                continue
+            packet = EtherbonePacket(wb.receive_packet(wb.socket))
+            packet.decode()
+            datas = packet.records.pop().writes.get_datas()
+            assert len(datas) == len(r.reads), "Expected {} words, got {}".format(
+                len(r.reads), len(datas))
+            for future, length in r.futures:
+                future.set_datas(datas[:length])
+                datas = datas[length:]
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Pipelined Etherbone client for bulk memory transfers.
+
+RemoteClient sends a request and waits for its reply before the next one.
+This client keeps up to `window` records in flight, each as big as Etherbone
+allows (255 words), so large transfers are limited by the link rather than
+by the round trip time.
+
+It connects to litex_server over TCP (as RemoteClient does), or with udp=True
+straight to the Etherbone core of the board. Replies are matched to their
+request by the return address of the record, which the board echoes back.
+litex_server replies in order with a return address of 0, those replies go
+to the oldest request. Over UDP, requests without a reply are sent again,
+over TCP the connection is closed.
+
+Each write record also reads back its last word, so every write is
+acknowledged. write_block is meant for memory, not for CSRs with read side
+effects.
+
+    async with EtherboneClient(host) as eb:
+        await eb.write_block(base, frame)
+        data = await eb.read_block(base, len(frame))
+
+Run it to measure the read (and with --write, write) bandwidth to main_ram.
+"""
+
+import asyncio
+import collections
+import struct
+import sys
+import time
+
+import numpy
+
+
+# An Etherbone record holds at most 255 reads or writes.
+MAX_BURST = 255
+
+# Magic, version 1, no flags, 32 bit addresses and data.
+_HEADER = bytes([0x4e, 0x6f, 0x10, 0x44, 0, 0, 0, 0])
+# Flags, byte enable, write count, read count, then the first address.
+_record = struct.Struct(">BBBBI")
+_word = struct.Struct(">I")
+
+
+class EtherboneError(IOError):
+    pass
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client._reply(data)
+
+    def error_received(self, exc):
+        self.client._fail(exc)
+
+
+class EtherboneClient:
+    def __init__(self, host, port=1234, udp=False, window=16, timeout=1.0,
+            retries=3, base_address=0):
+        self.host = host
+        self.port = port
+        self.udp = udp
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries if udp else 0
+        self.base_address = base_address
+        # Return address -> future of the reply, oldest first.
+        self._pending = collections.OrderedDict()
+        self._tag = 0
+        self._transport = None
+        self._writer = None
+        self._receiver = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.window)
+        if self.udp:
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UDPProtocol(self), remote_addr=(self.host, self.port))
+        else:
+            reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self._receiver = loop.create_task(self._receive(reader))
+
+    async def close(self):
+        self._disconnect(EtherboneError("Connection closed"))
+
+    def _disconnect(self, exc):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        self._fail(exc)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _receive(self, reader):
+        # litex_server sends one record per packet.
+        try:
+            while True:
+                header = await reader.readexactly(len(_HEADER) + 4)
+                wcount, rcount = header[-2], header[-1]
+                size = 0
+                if wcount:
+                    size += 4 + 4*wcount
+                if rcount:
+                    size += 4 + 4*rcount
+                self._reply(header + await reader.readexactly(size))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            self._fail(EtherboneError("Connection lost: {}".format(e)))
+
+    def _reply(self, packet):
+        offset = len(_HEADER)
+        if len(packet) < offset + _record.size or packet[:2] != _HEADER[:2]:
+            return
+        _, _, wcount, _, tag = _record.unpack_from(packet, offset)
+        if tag in self._pending:
+            future = self._pending.pop(tag)
+        elif tag == 0 and self._pending:
+            future = self._pending.popitem(last=False)[1]
+        else:
+            # The reply to a request which was already answered.
+            return
+        if not future.done():
+            start = offset + _record.size
+            future.set_result(memoryview(packet)[start:start + 4*wcount])
+
+    def _fail(self, exc):
+        pending, self._pending = self._pending, collections.OrderedDict()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def _next_tag(self):
+        # 0 is what litex_server returns, never use it.
+        while True:
+            self._tag = self._tag % 0xffff + 1
+            if self._tag not in self._pending:
+                return self._tag
+
+    def _send(self, data):
+        if self._transport is None and self._writer is None:
+            raise EtherboneError("Connection closed")
+        if self.udp:
+            self._transport.sendto(data)
+        else:
+            self._writer.write(data)
+
+    async def _request(self, make_packet, count):
+        """Sends the packet make_packet(tag) returns, and waits for a reply of
+        count words."""
+        async with self._slots:
+            tag = self._next_tag()
+            packet = make_packet(tag)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[tag] = future
+            try:
+                for attempt in range(self.retries + 1):
+                    self._send(packet)
+                    try:
+                        data = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    error = EtherboneError("No reply from {}:{} after {} attempts".format(
+                        self.host, self.port, self.retries + 1))
+                    if not self.udp:
+                        self._pending.pop(tag, None)
+                        # litex_server replies in order with a return address
+                        # of 0, a late reply would be taken for the one to the
+                        # next request. Drop the connection instead.
+                        self._disconnect(error)
+                    raise error
+            finally:
+                self._pending.pop(tag, None)
+        if len(data) != 4*count:
+            raise EtherboneError("Expected {} words, got {}".format(count, len(data)//4))
+        return data
+
+    async def read_block(self, addr, length, out=None):
+        """Reads length words from addr, into out if given (an array of
+        length words). Returns the words as a numpy array."""
+        if out is None:
+            out = numpy.empty(length, numpy.uint32)
+        assert len(out) == length
+        base = self.base_address + addr
+
+        async def burst(pos):
+            n = min(MAX_BURST, length - pos)
+            addrs = (base + 4*numpy.arange(pos, pos + n, dtype=numpy.uint64)).astype(">u4")
+
+            def make_packet(tag):
+                return b"".join([_HEADER, _record.pack(0, 0x0f, 0, n, tag), addrs])
+
+            data = await self._request(make_packet, n)
+            out[pos:pos + n] = numpy.frombuffer(data, ">u4")
+
+        await asyncio.gather(*[burst(pos) for pos in range(0, length, MAX_BURST)])
+        return out
+
+    async def write_block(self, addr, data):
+        """Writes data from addr. data is a numpy array of words, or a bytes-like
+        object already holding big endian words."""
+        if isinstance(data, numpy.ndarray):
+            data = numpy.ascontiguousarray(data, ">u4")
+        buf = memoryview(data).cast("B")
+        assert len(buf) % 4 == 0
+        length = len(buf)//4
+        base = self.base_address + addr
+
+        async def burst(pos):
+            n = min(MAX_BURST, length - pos)
+            start = base + 4*pos
+            # Read back the last word, the reply acknowledges the write.
+            tail = _word.pack(start + 4*(n - 1))
+
+            def make_packet(tag):
+                return b"".join([_HEADER, _record.pack(0, 0x0f, n, 1, start),
+                    buf[4*pos:4*(pos + n)], _word.pack(tag), tail])
+
+            await self._request(make_packet, 1)
+
+        await asyncio.gather(*[burst(pos) for pos in range(0, length, MAX_BURST)])
+
+
+def add_args(parser):
+    parser.add_argument("--offset", type=lambda x: int(x, 0), default=0, help="main_ram offset to read from")
+    parser.add_argument("--length", type=lambda x: int(x, 0), default=4*1024*1024, help="bytes to transfer")
+    parser.add_argument("--window", type=int, default=16, help="Etherbone records in flight")
+    parser.add_argument("--udp", action="store_true", help="talk to the board directly rather than to litex_server")
+    parser.add_argument("--write", action="store_true", help="also write the data read back to the board")
+
+
+def main():
+    from common import connect
+
+    args, wb = connect(__doc__, add_args=add_args)
+    base = wb.mems.main_ram.base + args.offset
+    length = args.length//4
+    wb.close()
+
+    async def run():
+        async with EtherboneClient(args.ipaddress, udp=args.udp, window=args.window) as eb:
+            start = time.time()
+            data = await eb.read_block(base, length)
+            elapsed = time.time() - start
+            print("Read {} bytes at 0x{:08x} in {:.2f}s, {:.2f} MB/s".format(
+                4*length, base, elapsed, 4*length/elapsed/1e6))
+            if args.write:
+                start = time.time()
+                await eb.write_block(base, data)
+                elapsed = time.time() - start
+                print("Wrote {} bytes at 0x{:08x} in {:.2f}s, {:.2f} MB/s".format(
+                    4*length, base, elapsed, 4*length/elapsed/1e6))
+
+    asyncio.run(run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
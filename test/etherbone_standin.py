@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Stand-in for a board, serving Etherbone on localhost from a build's csr.csv.
+
+The CSR registers and the memory regions of the build (main_ram, rom,
+spiflash...) are modelled as sparse buffers, so the host tools run without
+hardware:
+
+    ./test/etherbone_standin.py --latency 0.5 --bandwidth 100 \\
+        --set hdmi_out0_core_initiator_hres=1280 \\
+        --set hdmi_out0_core_initiator_vres=720 &
+    ./test/load_pattern.py --ipaddress 127.0.0.1 --stream
+
+It listens on TCP (as litex_server, which RemoteClient and connect() use)
+and on UDP (as the Etherbone core of a board, for EtherboneClient --udp) on
+the same port. --latency (ms) is added to every reply, and --bandwidth
+(Mbit/s) limits the rate requests and replies are handled at, so the effect
+of pipelining and batching on the host side can be measured.
+
+Registers read as 0 until they are written or --set, status registers
+ignore writes. spiflash reads as erased unless a file is loaded into it with
+--load.
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import struct
+import sys
+
+TOP_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+sys.path.append(TOP_DIR)
+from make import get_args, get_testdir
+
+
+PAGE_SIZE = 4096
+
+# The bus ignores the top address bit, the uncached shadow of the CPU.
+ADDRESS_MASK = 0x7fffffff
+
+_HEADER_SIZE = 8
+_record = struct.Struct(">BBBB")
+_word = struct.Struct(">I")
+
+
+class SparseMemory:
+    """size bytes which read as fill until written, stored in pages."""
+    def __init__(self, size, fill=0):
+        self.size = size
+        self.fill = fill
+        self.pages = {}
+
+    def read(self, offset, length):
+        data = bytearray()
+        while length:
+            page, start = divmod(offset, PAGE_SIZE)
+            n = min(length, PAGE_SIZE - start)
+            if page in self.pages:
+                data += self.pages[page][start:start + n]
+            else:
+                data += bytes([self.fill])*n
+            offset += n
+            length -= n
+        return data
+
+    def write(self, offset, data):
+        pos = 0
+        while pos < len(data):
+            page, start = divmod(offset + pos, PAGE_SIZE)
+            n = min(len(data) - pos, PAGE_SIZE - start)
+            if page not in self.pages:
+                self.pages[page] = bytearray([self.fill])*PAGE_SIZE
+            self.pages[page][start:start + n] = data[pos:pos + n]
+            pos += n
+
+
+class Target:
+    def __init__(self, csr_csv, csr_data_width=None):
+        self.regions = []
+        self.registers = {}
+        # Word address -> value, for everything outside the memory regions.
+        self.csrs = {}
+        self.readonly = set()
+        constants = {}
+        with open(csr_csv) as f:
+            for row in csv.reader(line for line in f if not line.startswith("#")):
+                if row[0] == "memory_region":
+                    name, base, size = row[1], int(row[2], 0), int(row[3])
+                    fill = 0xff if name == "spiflash" else 0
+                    self.regions.append((base & ADDRESS_MASK, size, name, SparseMemory(size, fill)))
+                elif row[0] == "csr_register":
+                    name, addr, length, mode = row[1], int(row[2], 0), int(row[3]), row[4]
+                    self.registers[name] = (addr & ADDRESS_MASK, length)
+                    if mode == "ro":
+                        self.readonly.update((addr & ADDRESS_MASK) + 4*i for i in range(length))
+                elif row[0] == "constant":
+                    constants[row[1]] = row[2]
+        self.csr_data_width = csr_data_width or int(constants.get("config_csr_data_width", 8))
+        self.words_read = 0
+        self.words_written = 0
+
+    def region(self, name):
+        for base, size, region_name, memory in self.regions:
+            if region_name == name:
+                return memory
+        raise KeyError("No memory region {}".format(name))
+
+    def set_register(self, name, value):
+        addr, length = self.registers[name]
+        width = self.csr_data_width
+        for i in range(length):
+            self.csrs[addr + 4*i] = (value >> ((length-1-i)*width)) & (2**width-1)
+
+    def _find(self, addr, length):
+        for base, size, name, memory in self.regions:
+            if base <= addr and addr + length <= base + size:
+                return memory, addr - base
+        return None, None
+
+    def read(self, addrs):
+        words = []
+        # Bursts to consecutive words of memory are read at once.
+        first = addrs[0] & ADDRESS_MASK
+        memory, offset = self._find(first, 4*len(addrs))
+        if memory is not None and list(addrs) == list(range(addrs[0], addrs[0] + 4*len(addrs), 4)):
+            self.words_read += len(addrs)
+            return list(struct.unpack(">{}I".format(len(addrs)), memory.read(offset, 4*len(addrs))))
+        for addr in addrs:
+            addr &= ADDRESS_MASK
+            memory, offset = self._find(addr, 4)
+            if memory is not None:
+                words.append(_word.unpack(memory.read(offset, 4))[0])
+            else:
+                words.append(self.csrs.get(addr, 0))
+        self.words_read += len(addrs)
+        return words
+
+    def write(self, base, data):
+        """Write data (big endian words) from base."""
+        base &= ADDRESS_MASK
+        memory, offset = self._find(base, len(data))
+        if memory is not None:
+            memory.write(offset, data)
+        else:
+            for i in range(0, len(data), 4):
+                addr = base + i
+                if addr not in self.readonly:
+                    self.csrs[addr] = _word.unpack_from(data, i)[0]
+        self.words_written += len(data)//4
+
+    def handle(self, packet):
+        """Do the records of an Etherbone packet, returns the reply (None if
+        there is nothing to reply)."""
+        if len(packet) < _HEADER_SIZE or packet[:2] != b"\x4e\x6f":
+            return None
+        if packet[2] & 1:
+            # Probe, reply with the probe reply flag set.
+            return packet[:2] + bytes([0x12]) + packet[3:_HEADER_SIZE]
+        reply = bytearray()
+        offset = _HEADER_SIZE
+        while offset + _record.size <= len(packet):
+            _, _, wcount, rcount = _record.unpack_from(packet, offset)
+            offset += _record.size
+            if wcount:
+                base = _word.unpack_from(packet, offset)[0]
+                self.write(base, packet[offset + 4:offset + 4 + 4*wcount])
+                offset += 4 + 4*wcount
+            if rcount:
+                ret = _word.unpack_from(packet, offset)[0]
+                addrs = struct.unpack_from(">{}I".format(rcount), packet, offset + 4)
+                offset += 4 + 4*rcount
+                # The reads come back as writes to the return address.
+                reply += _record.pack(0, 0x0f, rcount, 0) + _word.pack(ret)
+                reply += struct.pack(">{}I".format(rcount), *self.read(addrs))
+        if not reply:
+            return None
+        return packet[:_HEADER_SIZE] + reply
+
+
+class Link:
+    """When replies go out: after latency seconds, and with bandwidth
+    (bits per second, 0 is unlimited) shared by requests and replies."""
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.free = 0
+
+    def reply_time(self, loop, size):
+        now = loop.time()
+        start = max(now, self.free)
+        self.free = start + (size*8/self.bandwidth if self.bandwidth else 0)
+        return self.free + self.latency
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, target, link):
+        self.target = target
+        self.link = link
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = self.target.handle(data)
+        loop = asyncio.get_event_loop()
+        when = self.link.reply_time(loop, len(data) + len(reply or b""))
+        if reply:
+            loop.call_at(when, self.transport.sendto, reply, addr)
+
+
+async def _send_replies(queue, writer):
+    loop = asyncio.get_event_loop()
+    while True:
+        when, reply = await queue.get()
+        delay = when - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        writer.write(reply)
+
+
+def _tcp_handler(target, link):
+    async def serve(reader, writer):
+        # As litex_server: one record per packet, replies in order.
+        print("Connected with {}".format(writer.get_extra_info("peername")))
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        sender = loop.create_task(_send_replies(queue, writer))
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER_SIZE + _record.size)
+                wcount, rcount = header[-2], header[-1]
+                size = 0
+                if wcount:
+                    size += 4 + 4*wcount
+                if rcount:
+                    size += 4 + 4*rcount
+                packet = header + await reader.readexactly(size)
+                reply = target.handle(packet)
+                when = link.reply_time(loop, len(packet) + len(reply or b""))
+                if reply:
+                    queue.put_nowait((when, reply))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+            print("Disconnected, {} words read and {} written so far".format(
+                target.words_read, target.words_written))
+    return serve
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    get_args(parser)
+    parser.add_argument("--csr-csv", default=None, help="csr.csv to model (default: the one of the build)")
+    parser.add_argument("--bind", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=1234, help="TCP and UDP port to listen on")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every reply")
+    parser.add_argument("--bandwidth", type=float, default=0, help="link speed in Mbit/s (default: unlimited)")
+    parser.add_argument("--set", default=[], action="append", metavar="REGISTER=VALUE", help="initial value of a register")
+    parser.add_argument("--load", default=[], action="append", metavar="REGION=FILE[@OFFSET]", help="load a file into a memory region")
+    args = parser.parse_args()
+
+    csr_csv = args.csr_csv or os.path.join(TOP_DIR, get_testdir(args), "csr.csv")
+    target = Target(csr_csv)
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        target.set_register(name, int(value, 0))
+    for load in args.load:
+        name, _, filename = load.partition("=")
+        filename, _, offset = filename.partition("@")
+        with open(filename, "rb") as f:
+            target.region(name).write(int(offset or "0", 0), f.read())
+
+    print("Serving {} on {}:{}".format(csr_csv, args.bind, args.port))
+    for base, size, name, memory in sorted(target.regions):
+        print("{:20} @ 0x{:08x} -- {: 12} kbytes".format(name, base, size//1024))
+    link = Link(args.latency/1000, args.bandwidth*1e6)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(asyncio.start_server(
+        _tcp_handler(target, link), args.bind, args.port))
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: _UDPProtocol(target, link), local_addr=(args.bind, args.port)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
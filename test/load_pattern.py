@@ -4,29 +4,97 @@
 Script for loading an image into the pattern buffer via Etherbone.
 """
 
+import asyncio
 import shutil
 import subprocess
 import tempfile
 import time
 
 import numpy
-import progressbar
 
 from common import *
-
-
-def send_int32_data(wb, base, data, b=128):
-    l = len(data)
-    batches = l/b
-    print("Data is {} bytes (need {} batches)".format(l*4, batches))
-
-    bar = progressbar.ProgressBar(max_value=l).start()
-    for pos in range(0, l, b):
-        mem_loc = base+pos*4
-        wb.write(mem_loc, [int(x) for x in data[pos:pos+b]])
-        bar.update(pos)
-
-    bar.finish()
+from etherbone_async import EtherboneClient
+
+
+def changed_runs(frame, previous, block):
+    """The (start, end) word ranges of frame to send. frame is compared with
+    previous in blocks of block words, adjacent blocks which differ are
+    joined."""
+    if previous is None:
+        return [(0, len(frame))]
+    count = -(-len(frame) // block)
+    differ = numpy.zeros(count*block, bool)
+    differ[:len(frame)] = frame != previous
+    changed = differ.reshape(count, block).any(axis=1)
+    idx = numpy.flatnonzero(changed)
+    if not len(idx):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(idx) > 1)
+    starts = numpy.concatenate(([idx[0]], idx[breaks + 1]))*block
+    ends = numpy.minimum(numpy.concatenate((idx[breaks], [idx[-1]]))*block + block, len(frame))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def read_frames(pipe, frame_size, buffers=3):
+    """Yield each frame read from pipe, read straight into one of a few
+    preallocated buffers. A frame stays valid until buffers-1 more frames
+    were read: the frame being sent, the previous one it is compared with
+    and the next one being read."""
+    frames = [numpy.empty(frame_size//4, '>u4') for i in range(buffers)]
+    i = 0
+    while True:
+        frame = frames[i % buffers]
+        view = memoryview(frame).cast("B")
+        pos = 0
+        while pos < frame_size:
+            n = pipe.readinto(view[pos:])
+            if not n:
+                if pos:
+                    print("Dropped the last {} bytes, not a whole frame".format(pos))
+                return
+            pos += n
+        yield frame
+        i += 1
+
+
+def read_files(filenames):
+    for filename in filenames:
+        print("Sending {}".format(filename))
+        yield numpy.fromfile(filename, '>u4')
+
+
+async def send_frames(args, base, frames):
+    """Send each frame as it arrives, the next one is read while the
+    current one is sent. Unless args.full, only the blocks which changed
+    since the previous frame are sent."""
+    loop = asyncio.get_running_loop()
+    total = sent = 0
+    async with EtherboneClient(args.ipaddress, udp=args.udp, window=args.window) as eb:
+        frame = await loop.run_in_executor(None, next, frames, None)
+        previous = None
+        i = 0
+        while frame is not None:
+            pending = loop.run_in_executor(None, next, frames, None)
+            start = time.time()
+            runs = changed_runs(frame, None if args.full else previous, args.block)
+            await asyncio.gather(*[
+                eb.write_block(base + 4*begin, frame[begin:end]) for begin, end in runs])
+            elapsed = time.time() - start
+            words = sum(end - begin for begin, end in runs)
+            total += len(frame)
+            sent += words
+            print("Frame {}: sent {} of {} bytes ({:.1f}% skipped) in {:.2f}s, {:.2f} MB/s effective".format(
+                i, words*4, len(frame)*4, 100.0*(len(frame) - words)/len(frame), elapsed,
+                len(frame)*4/max(elapsed, 1e-9)/1e6))
+            previous = frame
+            frame = await pending
+            i += 1
+            if frame is not None and args.delay:
+                print("Sleeping for {} seconds".format(args.delay))
+                await asyncio.sleep(args.delay)
+    if total:
+        print("Sent {} of {} bytes, {:.1f}% skipped".format(
+            sent*4, total*4, 100.0*(total - sent)/total))
 
 
 def add_args(parser):
@@ -52,6 +120,33 @@ def add_args(parser):
         default=None,
         help="Send a gstreamer pattern, use 'gst-inspect-1.0 videotestsrc' to see possible options.")
 
+    parser.add_argument(
+        "--window",
+        default=16,
+        type=int,
+        help="Number of Etherbone records in flight.")
+
+    parser.add_argument(
+        "--udp",
+        action="store_true",
+        help="Send to the board directly rather than through litex_server.")
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Send the frames as gstreamer outputs them, rather than through temporary files.")
+
+    parser.add_argument(
+        "--block",
+        default=256,
+        type=int,
+        help="Number of words compared at a time, only blocks which changed since the previous frame are sent.")
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Send every frame in full.")
+
 
 def main():
     args, wb = connect(__doc__, add_args=add_args)
@@ -83,6 +178,8 @@ def main():
     print("     Size: {}x{}".format(width, height))
     print("-"*75)
     print()
+    # The frames are sent over a connection of their own.
+    wb.close()
 
     if args.pattern:
         src = "videotestsrc pattern={} num-buffers=5".format(args.pattern)
@@ -91,6 +188,19 @@ def main():
         assert os.path.exists(infile), "{} ({}) does not exist!".format(infile, args.file)
         src = "filesrc location={} ! decodebin ! videoscale".format(infile)
 
+    caps = "video/x-raw,format=UYVY,height={},width={},colorimetry=1:4:0:0".format(height, width)
+    if args.stream:
+        # -q, the frames go to stdout.
+        pipeline = "gst-launch-1.0 -q {} ! videoconvert ! {} ! fdsink fd=1".format(src, caps)
+        print(pipeline)
+        p = subprocess.Popen(pipeline, shell=True, stdout=subprocess.PIPE, bufsize=0)
+        try:
+            asyncio.run(send_frames(args, pattern_mem, read_frames(p.stdout, width*height*2)))
+        finally:
+            p.stdout.close()
+            p.wait()
+        return
+
     # Use gstreamer to convert input
     tempdir = None
     try:
@@ -104,18 +214,17 @@ def main():
 gst-launch-1.0 -v \
     {src} ! \
     videoconvert ! \
-    video/x-raw,format=UYVY,height={height},width={width},colorimetry=1:4:0:0 ! \
+    {caps} ! \
     multifilesink location="{tempdir}/%05d.yuv422.raw" max-files={max}
 """.format(src=src,
-           width=width,
-           height=height,
+           caps=caps,
            tempdir=tempdir,
            max=1024)
         print(pipeline)
         subprocess.check_call(pipeline, shell=True)
         print("-"*75)
 
-        files = os.listdir(tempdir)
+        files = sorted(os.listdir(tempdir))
         assert len(files) > 0, "gstreamer generated no files!"
 
         print()
@@ -126,15 +235,8 @@ gst-launch-1.0 -v \
         print("-"*75)
         print()
 
-        for i, fn in enumerate(files):
-            pn = os.path.join(tempdir, fn)
-            print("Sending {}".format(pn))
-            data = numpy.fromfile(open(pn, 'rb'), '>4I')
-            send_int32_data(wb, pattern_mem, data.flat)
-
-            if i != len(files)-1:
-                print("Sleeping for {} seconds".format(args.delay))
-                time.sleep(args.delay)
+        asyncio.run(send_frames(args, pattern_mem,
+            read_files(os.path.join(tempdir, fn) for fn in files)))
 
     finally:
         if tempdir:
@@ -4,6 +4,8 @@ import time
 from litex.soc.tools.remote import RemoteClient
 from litescope.software.driver.analyzer import LiteScopeAnalyzerDriver
 
+from csr_batch import CSRBatch
+
 wb = RemoteClient()
 wb.open()
 
@@ -16,19 +18,19 @@ DVISAMPLER_DELAY_DEC = 0x4
 DVISAMPLER_TOO_LATE  = 0x1
 DVISAMPLER_TOO_EARLY = 0x2
 
-def configure_delay(channel, delay):
+def configure_delay(channel, delay, regs=wb.regs):
     if channel == 0:
-        wb.regs.hdmi_in0_data0_cap_dly_ctl.write(DVISAMPLER_DELAY_RST)
+        regs.hdmi_in0_data0_cap_dly_ctl.write(DVISAMPLER_DELAY_RST)
         for i in range(delay):
-            wb.regs.hdmi_in0_data0_cap_dly_ctl.write(DVISAMPLER_DELAY_INC)
+            regs.hdmi_in0_data0_cap_dly_ctl.write(DVISAMPLER_DELAY_INC)
     elif channel == 1:
-        wb.regs.hdmi_in0_data1_cap_dly_ctl.write(DVISAMPLER_DELAY_RST)
+        regs.hdmi_in0_data1_cap_dly_ctl.write(DVISAMPLER_DELAY_RST)
         for i in range(delay):
-            wb.regs.hdmi_in0_data1_cap_dly_ctl.write(DVISAMPLER_DELAY_INC)
+            regs.hdmi_in0_data1_cap_dly_ctl.write(DVISAMPLER_DELAY_INC)
     elif channel == 2:
-        wb.regs.hdmi_in0_data2_cap_dly_ctl.write(DVISAMPLER_DELAY_RST)
+        regs.hdmi_in0_data2_cap_dly_ctl.write(DVISAMPLER_DELAY_RST)
         for i in range(delay):
-            wb.regs.hdmi_in0_data2_cap_dly_ctl.write(DVISAMPLER_DELAY_INC)
+            regs.hdmi_in0_data2_cap_dly_ctl.write(DVISAMPLER_DELAY_INC)
     else:
         ValueError
 
@@ -54,7 +56,9 @@ def get_phase_status(channel, measure_time=1):
 
 for channel in range(3):
     for delay in range(32):
-        configure_delay(channel, delay)
+        # The delay is stepped with one write per tap, send them together.
+        with CSRBatch(wb) as batch:
+            configure_delay(channel, delay, batch.regs)
         too_late, too_early = get_phase_status(channel)
         print("CHAN: {:d} / DELAY: {:d} / TOO_LATE: {:d} / TOO_EARLY: {:d}".format(
             channel, delay, too_late, too_early))
@@ -2,54 +2,62 @@ import time
 
 from litex.soc.tools.remote import RemoteClient
 
+from csr_batch import CSRBatch
+
 wb = RemoteClient(debug=True)
 wb.open()
 regs = wb.regs
 
 
 def config_1080p60(bpp):
-    write_mmcm_reg(0x8, 0x1000 + (2 << 6) + 3)
-    write_mmcm_reg(0xa, 0x1000 + (1 << 6) + 1)
+    # One Etherbone round trip rather than one per register.
+    with CSRBatch(wb) as batch:
+        regs = batch.regs
+        write_mmcm_reg(0x8, 0x1000 + (2 << 6) + 3, regs)
+        write_mmcm_reg(0xa, 0x1000 + (1 << 6) + 1, regs)
 
-    regs.hdmi_out0_core_initiator_hres.write(1920)
-    regs.hdmi_out0_core_initiator_hsync_start.write(1920+88)
-    regs.hdmi_out0_core_initiator_hsync_end.write(1920+88+44)
-    regs.hdmi_out0_core_initiator_hscan.write(2200)
+        regs.hdmi_out0_core_initiator_hres.write(1920)
+        regs.hdmi_out0_core_initiator_hsync_start.write(1920+88)
+        regs.hdmi_out0_core_initiator_hsync_end.write(1920+88+44)
+        regs.hdmi_out0_core_initiator_hscan.write(2200)
 
-    regs.hdmi_out0_core_initiator_vres.write(1080)
-    regs.hdmi_out0_core_initiator_vsync_start.write(1080+4)
-    regs.hdmi_out0_core_initiator_vsync_end.write(1080+4+5)
-    regs.hdmi_out0_core_initiator_vscan.write(1125)
+        regs.hdmi_out0_core_initiator_vres.write(1080)
+        regs.hdmi_out0_core_initiator_vsync_start.write(1080+4)
+        regs.hdmi_out0_core_initiator_vsync_end.write(1080+4+5)
+        regs.hdmi_out0_core_initiator_vscan.write(1125)
 
-    regs.hdmi_out0_core_initiator_enable.write(0)
-    regs.hdmi_out0_core_initiator_base.write(0)
-    regs.hdmi_out0_core_initiator_length.write(1920*1080*bpp)
-    regs.hdmi_out0_core_initiator_enable.write(1)
+        regs.hdmi_out0_core_initiator_enable.write(0)
+        regs.hdmi_out0_core_initiator_base.write(0)
+        regs.hdmi_out0_core_initiator_length.write(1920*1080*bpp)
+        regs.hdmi_out0_core_initiator_enable.write(1)
 
 
 def config_720p60(bpp):
-    write_mmcm_reg(0x8, 0x1000 + (4 << 6)  + 6)
-    write_mmcm_reg(0xa, 0x1000 + (2  << 6) + 2)
+    # One Etherbone round trip rather than one per register.
+    with CSRBatch(wb) as batch:
+        regs = batch.regs
+        write_mmcm_reg(0x8, 0x1000 + (4 << 6)  + 6, regs)
+        write_mmcm_reg(0xa, 0x1000 + (2  << 6) + 2, regs)
 
-    regs.hdmi_out0_core_initiator_hres.write(1280)
-    regs.hdmi_out0_core_initiator_hsync_start.write(1390)
-    regs.hdmi_out0_core_initiator_hsync_end.write(1430)
-    regs.hdmi_out0_core_initiator_hscan.write(1650)
+        regs.hdmi_out0_core_initiator_hres.write(1280)
+        regs.hdmi_out0_core_initiator_hsync_start.write(1390)
+        regs.hdmi_out0_core_initiator_hsync_end.write(1430)
+        regs.hdmi_out0_core_initiator_hscan.write(1650)
 
-    regs.hdmi_out0_core_initiator_vres.write(720)
-    regs.hdmi_out0_core_initiator_vsync_start.write(725)
-    regs.hdmi_out0_core_initiator_vsync_end.write(730)
-    regs.hdmi_out0_core_initiator_vscan.write(750)
+        regs.hdmi_out0_core_initiator_vres.write(720)
+        regs.hdmi_out0_core_initiator_vsync_start.write(725)
+        regs.hdmi_out0_core_initiator_vsync_end.write(730)
+        regs.hdmi_out0_core_initiator_vscan.write(750)
 
-    regs.hdmi_out0_core_initiator_enable.write(0)
-    regs.hdmi_out0_core_initiator_base.write(0)
-    regs.hdmi_out0_core_initiator_length.write(1280*720*bpp)
-    regs.hdmi_out0_core_initiator_enable.write(1)
+        regs.hdmi_out0_core_initiator_enable.write(0)
+        regs.hdmi_out0_core_initiator_base.write(0)
+        regs.hdmi_out0_core_initiator_length.write(1280*720*bpp)
+        regs.hdmi_out0_core_initiator_enable.write(1)
 
-    #regs.hdmi_out0_core_initiator_base.write(0x02000000)
-    #regs.hdmi_out0_core_initiator_length.write(1280*720*bpp)
-    #time.sleep(1)
-    #regs.hdmi_out0_core_initiator_enable.write(1)
+        #regs.hdmi_out0_core_initiator_base.write(0x02000000)
+        #regs.hdmi_out0_core_initiator_length.write(1280*720*bpp)
+        #time.sleep(1)
+        #regs.hdmi_out0_core_initiator_enable.write(1)
 
 
 def read_mmcm_reg(address):
@@ -59,7 +67,7 @@ def read_mmcm_reg(address):
     return regs.hdmi_out0_driver_clocking_drp_do.read()
 
 
-def write_mmcm_reg(address, data):
+def write_mmcm_reg(address, data, regs=regs):
     regs.hdmi_out0_driver_clocking_drp_addr.write(address)
     regs.hdmi_out0_driver_clocking_drp_di.write(data)
     regs.hdmi_out0_driver_clocking_drp_dwe.write(1)
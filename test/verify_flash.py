@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Compare the SPI flash of a running board with a local file, over Etherbone.
+
+The memory mapped flash is read in full size bursts with several requests in
+flight, and only the address ranges which differ are reported.
+"""
+
+import sys
+import time
+
+from common import *
+from make import get_builddir, get_image
+
+
+# Bytes read and compared at a time.
+CHUNK_SIZE = 1024*1024
+MAX_REPORTED = 50
+
+
+def add_args(parser):
+    parser.add_argument("--file", default=None, help="file to compare with (default: the flash image of the build)")
+    parser.add_argument("--offset", type=lambda x: int(x, 0), default=0, help="flash offset the file was written at")
+    parser.add_argument("--length", type=lambda x: int(x, 0), default=None, help="only compare this many bytes")
+    parser.add_argument("--inflight", type=int, default=8, help="Etherbone requests outstanding at once")
+
+
+def main():
+    args, wb = connect(__doc__, add_args=add_args)
+
+    filename = args.file or get_image(get_builddir(args), "flash")
+    with open(filename, "rb") as f:
+        data = f.read()
+    if args.length is not None:
+        data = data[:args.length]
+    base = wb.mems.spiflash.base + args.offset
+    print("Comparing {} ({} bytes) with the flash at 0x{:08x}".format(filename, len(data), base))
+
+    ranges = []
+    start = time.time()
+    for pos in range(0, len(data), CHUNK_SIZE):
+        expected = data[pos:pos+CHUNK_SIZE]
+        actual = read_bytes(wb, base + pos, len(expected), args.inflight)
+        for begin, end in mismatches(expected, actual):
+            begin += pos
+            end += pos
+            # Join ranges split by the chunks.
+            if ranges and ranges[-1][1] == begin:
+                begin = ranges.pop()[0]
+            ranges.append((begin, end))
+        elapsed = time.time() - start
+        done = pos + len(expected)
+        print("\r{:5.1f}% {:6.2f} MB/s".format(100.0*done/len(data), done/elapsed/1e6), end="", flush=True)
+    elapsed = time.time() - start
+    print()
+
+    for begin, end in ranges[:MAX_REPORTED]:
+        print("0x{:08x}-0x{:08x} ({} bytes) differ".format(
+            args.offset + begin, args.offset + end, end - begin))
+    if len(ranges) > MAX_REPORTED:
+        print("... and {} more ranges".format(len(ranges) - MAX_REPORTED))
+    bad = sum(end - begin for begin, end in ranges)
+    print("{} of {} bytes differ in {} ranges, read at {:.2f} MB/s ({:.1f}s)".format(
+        bad, len(data), len(ranges), len(data)/elapsed/1e6, elapsed))
+
+    wb.close()
+    return 1 if ranges else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Update the memory contents of an already placed and routed design.
+
+When the only thing which changed since the last build is the contents of
+memories (the BIOS in the integrated ROM, firmware in a FirmwareROM, the git
+information ROM, ...) the new contents are written straight into the
+existing design instead of running synthesis and place and route again.
+
+icebram finds a memory in the placed design by its current contents, which
+have to be unique: zero filled (or otherwise repeated) block RAMs would be
+ambiguous. So when the toolchain runs, every memory is given random contents
+(icebram -g) instead of its real ones, and the real contents are patched in
+afterwards. The random contents and the design placed with them are kept in
+gateware/.bram-patch/, the next build with the same design patches its own
+contents into them.
+
+Only icestorm (iCE40) designs are supported. The Xilinx tools (data2mem /
+updatemem) need a BMM / MMI file describing where each memory was placed,
+which isn't generated for the block RAMs inferred from migen.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+
+STATE_DIR = ".bram-patch"
+STATE_FILE = "state.json"
+
+# The real contents of the memories while the toolchain runs.
+REAL_DIR = os.path.join(STATE_DIR, "real")
+
+
+def _toolchain(platform):
+    module = type(platform.toolchain).__module__
+    if "icestorm" in module:
+        return "icestorm"
+    return None
+
+
+def _placed_design(build_name):
+    # icestorm's ASCII bitstream from nextpnr / arachne-pnr
+    return build_name + ".txt"
+
+
+def _build_script(build_name):
+    # Written by the icestorm toolchain before it runs it.
+    return "build_{}.sh".format(build_name)
+
+
+def _init_files(gateware_dir):
+    return [f for f in sorted(os.listdir(gateware_dir)) if f.endswith(".init")]
+
+
+def _memories(gateware_dir, build_name):
+    """(width, depth) of the memory each .init file is loaded into, from the
+    declarations in the generated Verilog."""
+    with open(os.path.join(gateware_dir, build_name + ".v")) as f:
+        verilog = f.read()
+    memories = {}
+    for filename, name in re.findall(r'\$readmemh\("([^"]+)",\s*([^\s)]+)\)', verilog):
+        m = re.search(r"reg\s+(?:\[(\d+):0\]\s+)?{}\s*\[0:(\d+)\];".format(re.escape(name)), verilog)
+        if m is None:
+            continue
+        width = int(m.group(1) or 0) + 1
+        memories[os.path.basename(filename)] = (width, int(m.group(2)) + 1)
+    return memories
+
+
+def _load_state(gateware_dir):
+    try:
+        with open(os.path.join(gateware_dir, STATE_DIR, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_hex(filename):
+    with open(filename) as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+def _write_padded_hex(filename, words, length, width):
+    digits = (width + 3)//4
+    with open(filename, "w") as f:
+        for w in words + ["0"]*(length - len(words)):
+            f.write(w.zfill(digits) + "\n")
+
+
+def prepare(gateware_dir, platform, build_name="top"):
+    """Give every memory random contents for the toolchain run about to
+    start, the real ones are put back by finish(). Returns False if the
+    design can't be patched later (and nothing was changed)."""
+    state_dir = os.path.join(gateware_dir, STATE_DIR)
+    shutil.rmtree(state_dir, ignore_errors=True)
+    if _toolchain(platform) is None or shutil.which("icebram") is None:
+        return False
+    inits = _init_files(gateware_dir)
+    memories = _memories(gateware_dir, build_name)
+    if not inits or set(inits) - set(memories):
+        return False
+
+    real_dir = os.path.join(gateware_dir, REAL_DIR)
+    os.makedirs(real_dir)
+    placeholders = {}
+    for seed, filename in enumerate(inits, 1):
+        width, depth = memories[filename]
+        init = os.path.join(gateware_dir, filename)
+        shutil.copy2(init, os.path.join(real_dir, filename))
+        with open(init, "w") as f:
+            subprocess.check_call(
+                ["icebram", "-g", "-s", str(seed), str(width), str(depth)], stdout=f)
+        placeholders[filename] = [width, depth]
+    with open(os.path.join(state_dir, STATE_FILE), "w") as f:
+        json.dump({"design_key": None, "memories": placeholders}, f, indent=2, sort_keys=True)
+    return True
+
+
+def _patch_icestorm(gateware_dir, state, build_name):
+    """Write the contents of the .init files in gateware_dir into the design
+    placed with the random contents."""
+    state_dir = os.path.join(gateware_dir, STATE_DIR)
+    placed = _placed_design(build_name)
+    with tempfile.TemporaryDirectory(prefix="bram-patch.") as tmpdir:
+        asc = os.path.join(state_dir, placed)
+        for filename, (width, depth) in sorted(state["memories"].items()):
+            new_words = _read_hex(os.path.join(gateware_dir, filename))
+            assert len(new_words) <= depth, "{} is bigger than its memory".format(filename)
+            # Memory beyond the init data is zero, icebram needs both files to
+            # be the same size.
+            new_hex = os.path.join(tmpdir, "new-" + filename)
+            _write_padded_hex(new_hex, new_words, depth, width)
+
+            out = os.path.join(tmpdir, "{}.{}".format(placed, filename))
+            with open(asc, "rb") as fin, open(out, "wb") as fout:
+                subprocess.check_call(
+                    ["icebram", os.path.join(state_dir, filename), new_hex], stdin=fin, stdout=fout)
+            asc = out
+
+        shutil.copy(asc, os.path.join(gateware_dir, placed))
+        subprocess.check_call(
+            ["icepack", placed, build_name + ".bin"], cwd=gateware_dir)
+
+
+def finish(gateware_dir, platform, design_key, build_name="top"):
+    """After a toolchain run on the contents from prepare(): keep the random
+    contents and the design placed with them, and patch the real contents
+    into the bitstream."""
+    state_dir = os.path.join(gateware_dir, STATE_DIR)
+    real_dir = os.path.join(gateware_dir, REAL_DIR)
+    state = _load_state(gateware_dir)
+    assert state is not None, "bram_patch.finish() without prepare()"
+
+    placed = _placed_design(build_name)
+    shutil.copy2(os.path.join(gateware_dir, placed), os.path.join(state_dir, placed))
+    for filename in state["memories"]:
+        os.replace(os.path.join(gateware_dir, filename), os.path.join(state_dir, filename))
+        os.replace(os.path.join(real_dir, filename), os.path.join(gateware_dir, filename))
+    os.rmdir(real_dir)
+
+    try:
+        _patch_icestorm(gateware_dir, state, build_name)
+    except (OSError, subprocess.CalledProcessError) as e:
+        # Synthesis didn't keep a memory as block RAM, build it for real.
+        print("Patching the memory contents failed ({}), running the FPGA toolchain again.".format(e))
+        shutil.rmtree(state_dir, ignore_errors=True)
+        subprocess.check_call(["bash", _build_script(build_name)], cwd=gateware_dir)
+        return False
+
+    state["design_key"] = design_key
+    with open(os.path.join(state_dir, STATE_FILE), "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    return True
+
+
+def patch(gateware_dir, platform, design_key, build_name="top"):
+    """Try to patch the memory contents into the previous design.
+
+    design_key is the gateware cache key ignoring memory contents, the patch
+    is only done if it matches the previous build. Returns True on success.
+    """
+    state = _load_state(gateware_dir)
+    if state is None or state["design_key"] != design_key:
+        return False
+    if set(_init_files(gateware_dir)) != set(state["memories"]):
+        return False
+    if _toolchain(platform) is None:
+        return False
+
+    print("Only memory contents changed, patching them into the existing design.")
+    try:
+        _patch_icestorm(gateware_dir, state, build_name)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("Patching failed ({}), running the full FPGA toolchain.".format(e))
+        return False
+    return True
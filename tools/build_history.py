@@ -0,0 +1,216 @@
+"""
+Per stage timing of make.py runs.
+
+Every run appends a record to build/build-history.jsonl with the wall time of
+each build stage (elaboration, Verilog generation, the FPGA toolchain steps,
+each software package, ...) so slow downs can be found later with
+`make.py --build-report`.
+
+The FPGA toolchain is run as a single build script, so its steps are timed
+from the modification times of the files each step produces.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+HISTORY_FILE = os.path.join("build", "build-history.jsonl")
+HISTORY_VERSION = 1
+
+# Output file (after the build name) of each toolchain step, in the order they
+# are run.
+TOOLCHAIN_STEPS = {
+    "ise": (
+        ("synthesis", ".ngc"),
+        ("translate", ".ngd"),
+        ("map", "_map.ncd"),
+        ("par", ".ncd"),
+        ("bitgen", ".bit"),
+    ),
+    "vivado": (
+        ("vivado", ".bit"),
+    ),
+    "icestorm": (
+        ("synthesis", ".json"),
+        ("synthesis", ".blif"),
+        ("par", ".txt"),
+        ("bitgen", ".bin"),
+    ),
+}
+
+# Number of previous runs the latest run is compared against.
+REPORT_WINDOW = 10
+# A stage is flagged if it is this much slower than the median...
+REPORT_SLOWER = 1.2
+# ... and by at least this many seconds.
+REPORT_MIN_SECONDS = 2.0
+
+
+def _toolchain_name(platform):
+    module = type(platform.toolchain).__module__
+    for name in TOOLCHAIN_STEPS:
+        if name in module:
+            return name
+    return None
+
+
+class BuildTimer:
+    def __init__(self):
+        self.start = time.time()
+        # stage name -> seconds, the time of repeated stages is added up
+        self.stages = OrderedDict()
+        self.gateware = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + max(seconds, 0.0)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add_gateware(self, platform, gateware_dir, start, end, run=True, build_name="top"):
+        """Split the time spent in platform.build() into its steps.
+
+        start / end are the (wall clock) times platform.build() started and
+        finished.
+        """
+        verilog = os.path.join(gateware_dir, build_name + ".v")
+        if not os.path.exists(verilog) or os.path.getmtime(verilog) < start:
+            self.add("gateware", end - start)
+            return
+        last = os.path.getmtime(verilog)
+        self.add("verilog", last - start)
+        if not run:
+            return
+
+        toolchain = _toolchain_name(platform)
+        for name, ext in TOOLCHAIN_STEPS.get(toolchain, ()):
+            output = os.path.join(gateware_dir, build_name + ext)
+            if not os.path.exists(output):
+                continue
+            mtime = os.path.getmtime(output)
+            if mtime < last:
+                continue
+            self.add("toolchain/" + name, mtime - last)
+            last = mtime
+        # Whatever the steps above don't cover.
+        if end - last >= 0.5:
+            self.add("toolchain/other", end - last)
+
+
+def _git_commit():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("ascii").strip()
+        dirty = subprocess.call(
+            ["git", "diff-index", "--quiet", "HEAD", "--"], stderr=subprocess.DEVNULL) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def _config(args):
+    return {
+        "platform": args.platform,
+        "target": args.target,
+        "cpu_type": args.cpu_type,
+        "cpu_variant": args.cpu_variant,
+    }
+
+
+def record(args, timer):
+    """Append the stage times of this run to the history file."""
+    entry = OrderedDict()
+    entry["version"] = HISTORY_VERSION
+    entry["time"] = int(timer.start)
+    entry["git"] = _git_commit()
+    entry.update(_config(args))
+    entry["gateware"] = timer.gateware
+    entry["total"] = round(time.time() - timer.start, 3)
+    entry["stages"] = OrderedDict((k, round(v, 3)) for k, v in timer.stages.items())
+
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    # A single write of a single line, so concurrent builds don't interleave.
+    with open(HISTORY_FILE, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def load(args=None):
+    """Read the history, only the runs matching args if given."""
+    entries = []
+    try:
+        with open(HISTORY_FILE) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("version") != HISTORY_VERSION:
+                    continue
+                entries.append(entry)
+    except FileNotFoundError:
+        pass
+
+    if args is not None:
+        config = _config(args)
+        entries = [e for e in entries if all(e.get(k) == v for k, v in config.items())]
+    return entries
+
+
+def report(args):
+    entries = load(args)
+    if not entries:
+        print("No builds of {platform}/{target}/{cpu_type} in {}.".format(
+            HISTORY_FILE, **_config(args)))
+        return 1
+
+    latest = entries[-1]
+    # A cached or patched build skips the FPGA toolchain, only compare like
+    # with like.
+    previous = [e for e in entries[:-1] if e.get("gateware") == latest["gateware"]]
+    previous = previous[-REPORT_WINDOW:]
+
+    print("Latest build: {} (git {}), gateware {}".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(latest["time"])),
+        latest["git"], latest["gateware"]))
+    print("Compared against the median of the {} previous build(s) with gateware {}.".format(
+        len(previous), latest["gateware"]))
+    print()
+    print("{:30} {:>10} {:>10} {:>8}".format("Stage", "Latest", "Median", "Change"))
+    print("-"*75)
+
+    stages = list(latest["stages"].items()) + [("total", latest["total"])]
+    slower = []
+    for name, seconds in stages:
+        if name == "total":
+            history = [e["total"] for e in previous]
+        else:
+            history = [e["stages"][name] for e in previous if name in e["stages"]]
+        if not history:
+            print("{:30} {:>9.1f}s {:>10} {:>8}".format(name, seconds, "-", "-"))
+            continue
+        median = statistics.median(history)
+        change = "{:+.0f}%".format((seconds/median - 1)*100) if median else "-"
+        flag = ""
+        if seconds > median*REPORT_SLOWER and seconds - median >= REPORT_MIN_SECONDS:
+            flag = "  SLOWER"
+            slower.append(name)
+        print("{:30} {:>9.1f}s {:>9.1f}s {:>8}{}".format(name, seconds, median, change, flag))
+    print("-"*75)
+
+    if slower:
+        print("Slower than usual: {}".format(", ".join(slower)))
+    else:
+        print("No stage slower than usual.")
+    return 0
@@ -0,0 +1,171 @@
+"""
+LiteX Builder which compiles the software packages concurrently.
+
+The packages are compiled in dependency order (the libraries, then the
+programs linking against them), with independent packages compiled at the
+same time. All the make processes share one GNU make jobserver so the total
+number of jobs stays within the limit. Output lines are prefixed with the
+package name.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from litex.soc.integration import builder
+
+
+# Packages other packages link against, they only need the generated headers.
+LIBRARIES = ("libcompiler_rt", "libbase", "libnet", "uip")
+
+# Libraries each program needs on top of the litex ones.
+DEPENDENCIES = {
+    "firmware": ("uip",),
+}
+
+
+def dependencies(name, names):
+    """Packages in names which have to be compiled before name."""
+    if name in LIBRARIES:
+        return []
+    deps = [n for n in names if n.startswith("lib")]
+    deps += [n for n in DEPENDENCIES.get(name, ()) if n in names]
+    return deps
+
+
+def _makeflags():
+    # The top level Makefile exports MAKEFLAGS with the quotes included.
+    return os.environ.get("MAKEFLAGS", "").replace('"', "")
+
+
+def default_jobs():
+    """The -j given to make (the top level Makefile exports it), or the CPU count."""
+    m = re.search(r"(?:^|\s)-j\s*(\d+)", _makeflags())
+    if m:
+        return int(m.group(1))
+    return os.cpu_count() or 1
+
+
+class Jobserver:
+    """A GNU make jobserver, a pipe holding one token per job slot."""
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.r, self.w = os.pipe()
+        os.write(self.w, b"+"*self.jobs)
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+    def acquire(self):
+        return os.read(self.r, 1)
+
+    def release(self, token):
+        os.write(self.w, token)
+
+    def environ(self):
+        # Command line variables come after "--", the options go before it.
+        options, _, variables = (" " + _makeflags()).partition(" -- ")
+        # Drop any -j / jobserver options inherited from a parent make.
+        flags = re.sub(r"(?:^|\s)(?:-j\s*\d*|--jobserver-\S+)", " ", options).split()
+        # The single letter flags come first, without a dash.
+        if flags and not flags[0].startswith("-"):
+            flags[0] = "-" + flags[0]
+        # make < 4.2 only knows --jobserver-fds.
+        version = subprocess.check_output(["make", "--version"]).decode("utf-8", "replace")
+        m = re.search(r"(\d+)\.(\d+)", version)
+        if m and (int(m.group(1)), int(m.group(2))) >= (4, 2):
+            flags.append("--jobserver-auth={},{}".format(self.r, self.w))
+        else:
+            flags.append("--jobserver-fds={},{}".format(self.r, self.w))
+        if variables:
+            flags += ["--", variables]
+        env = dict(os.environ)
+        env["MAKEFLAGS"] = " ".join(["-j"] + flags)
+        return env
+
+
+class Builder(builder.Builder):
+    def __init__(self, soc, timer=None, jobs=None, **kwargs):
+        builder.Builder.__init__(self, soc, **kwargs)
+        self.timer = timer
+        self.jobs = jobs or default_jobs()
+        self.software_end = None
+        self._output_lock = threading.Lock()
+
+    def _generate_software(self):
+        # Let litex set up the build directories, then compile them here.
+        compile_software = self.compile_software
+        self.compile_software = False
+        try:
+            builder.Builder._generate_software(self)
+        finally:
+            self.compile_software = compile_software
+
+        if compile_software and self.software_packages:
+            start = time.time()
+            self._compile_software()
+            if self.timer is not None:
+                self.timer.add("software", time.time() - start)
+        self.software_end = time.time()
+
+    def _print(self, name, line):
+        with self._output_lock:
+            sys.stdout.write("[{}] {}".format(name, line))
+            sys.stdout.flush()
+
+    def _make(self, name, env, jobserver):
+        dst_dir = os.path.join(self.output_dir, "software", name)
+        token = jobserver.acquire()
+        try:
+            start = time.time()
+            p = subprocess.Popen(
+                ["make", "-C", dst_dir], env=env, pass_fds=(jobserver.r, jobserver.w),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+            for line in p.stdout:
+                self._print(name, line.decode("utf-8", "replace"))
+            returncode = p.wait()
+            if self.timer is not None:
+                self.timer.add("software/" + name, time.time() - start)
+        finally:
+            jobserver.release(token)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, p.args)
+
+    def _compile_software(self):
+        names = [name for name, _ in self.software_packages]
+        done = dict((name, threading.Event()) for name in names)
+        errors = {}
+
+        jobserver = Jobserver(self.jobs)
+        env = jobserver.environ()
+
+        def compile(name):
+            try:
+                for dep in dependencies(name, names):
+                    done[dep].wait()
+                    if dep in errors:
+                        self._print(name, "Not compiled, {} failed.\n".format(dep))
+                        errors[name] = errors[dep]
+                        return
+                self._make(name, env, jobserver)
+            except Exception as e:
+                errors[name] = e
+            finally:
+                done[name].set()
+
+        threads = [threading.Thread(target=compile, args=(name,)) for name in names]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            jobserver.close()
+
+        for name in names:
+            if name in errors:
+                raise errors[name]
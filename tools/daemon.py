@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+Build daemon keeping migen / litex imported and SoCs elaborated.
+
+Start it from the top of the tree with:
+    python -m tools.daemon
+
+While it is running make.py, mkimage.py and flash.py hand their command line,
+environment and stdin / stdout / stderr to the daemon over a Unix socket
+(build/daemon.sock). The daemon forks a child which runs the script, so
+nothing has to be imported again. After a script has elaborated a SoC the
+daemon elaborates the same SoC again in the background, the next run with the
+same options gets it straight away. That happens in a worker thread, the
+daemon keeps accepting requests meanwhile and forks their children once the
+SoC is done.
+
+Whenever a file under platforms/, targets/, gateware/, tools/ or firmware/
+(or the scripts themselves, migen / litex and the litex cores, or the git
+HEAD) changes the daemon restarts itself, the request which noticed the
+change is run without the daemon. On Linux the directories are watched with
+inotify, so they are only looked at again after something in them changed.
+
+Set LITEX_DAEMON=0 to not use a running daemon.
+"""
+
+import argparse
+import array
+import ctypes
+import ctypes.util
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+import pickle
+import queue
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+
+TOP_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+SOCKET_PATH = os.path.join(TOP_DIR, "build", "daemon.sock")
+
+SCRIPTS = ("make", "mkimage", "flash")
+SOURCE_DIRS = ("platforms", "targets", "gateware", "tools", "firmware")
+# Installed packages the SoCs are made of.
+LIBRARIES = ("migen", "litex", "litedram", "liteeth", "litepcie", "litescope", "litevideo")
+
+# Modules imported when the daemon starts.
+PRELOAD = (
+    "migen",
+    "litex.soc.integration.soc_sdram",
+    "litex.soc.integration.builder",
+) + SCRIPTS
+
+_header = struct.Struct("!I")
+
+# struct inotify_event, followed by the name.
+_event = struct.Struct("iIII")
+_IN_CHANGES = (
+    0x00000002 |    # IN_MODIFY
+    0x00000004 |    # IN_ATTRIB
+    0x00000040 |    # IN_MOVED_FROM
+    0x00000080 |    # IN_MOVED_TO
+    0x00000100 |    # IN_CREATE
+    0x00000200 |    # IN_DELETE
+    0x00000400 |    # IN_DELETE_SELF
+    0x00000800      # IN_MOVE_SELF
+)
+
+
+def _send(sock, message, fds=None):
+    data = json.dumps(message).encode("utf-8")
+    data = _header.pack(len(data)) + data
+    if fds:
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        sock.sendall(data)
+
+
+def _recv(sock, maxfds=0):
+    fds = array.array("i")
+    data = b""
+    while len(data) < _header.size or len(data) < _header.size + _header.unpack_from(data)[0]:
+        if maxfds:
+            chunk, ancdata, _, _ = sock.recvmsg(65536, socket.CMSG_LEN(maxfds*fds.itemsize))
+            for level, type, cmsg in ancdata:
+                if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg[:len(cmsg) - (len(cmsg) % fds.itemsize)])
+            maxfds = 0
+        else:
+            chunk = sock.recv(65536)
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return json.loads(data[_header.size:].decode("utf-8")), list(fds)
+
+
+def client(script):
+    """Run script's main() in the daemon if one is running.
+
+    Exits with the exit code of the script if it was run, returns if it
+    wasn't (no daemon, or the daemon wants the script run locally).
+    """
+    if os.environ.get("LITEX_DAEMON", "1") == "0" or not os.path.exists(SOCKET_PATH):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send(sock, {
+            "script": script,
+            "argv": sys.argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }, fds=[0, 1, 2])
+        reply, _ = _recv(sock)
+    except KeyboardInterrupt:
+        # Closing the connection interrupts the script in the daemon.
+        sock.close()
+        sys.exit(130)
+    except (OSError, EOFError, ValueError):
+        sock.close()
+        return
+    sock.close()
+
+    if reply.get("exit") is None:
+        return
+    sys.exit(reply["exit"])
+
+
+def _git_head():
+    try:
+        with open(os.path.join(TOP_DIR, ".git", "HEAD")) as f:
+            head = f.read().strip()
+        if head.startswith("ref: "):
+            ref = os.path.join(TOP_DIR, ".git", head[5:])
+            if os.path.exists(ref):
+                with open(ref) as f:
+                    head += " " + f.read().strip()
+            else:
+                head += " {}".format(os.stat(os.path.join(TOP_DIR, ".git", "packed-refs")).st_mtime_ns)
+        return head
+    except OSError:
+        return ""
+
+
+def _library_dirs():
+    dirs = []
+    for name in LIBRARIES:
+        try:
+            spec = importlib.util.find_spec(name)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is not None and spec.submodule_search_locations:
+            dirs.extend(spec.submodule_search_locations)
+    return dirs
+
+
+class Watcher:
+    """Tells whether the directories fingerprint() walks may have changed,
+    using inotify. Where there is no inotify it always says they may have."""
+    def __init__(self):
+        self.fd = -1
+        # Watch descriptor -> the names which count (None for all of them).
+        self.names = {}
+        self.changed = False
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            pass
+
+    def watch(self, path, names=None):
+        if self.fd < 0:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), _IN_CHANGES)
+        if wd >= 0:
+            self.names[wd] = names
+
+    def _counts(self, wd, name):
+        if wd not in self.names:
+            # Queue overflow (-1), or a directory which went away.
+            return True
+        if self.names[wd] is not None:
+            return name in self.names[wd]
+        return name != "__pycache__" and not name.endswith(".pyc")
+
+    def poll(self):
+        """True if anything changed since the last call."""
+        if self.fd < 0:
+            return True
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _event.unpack_from(data, offset)
+                offset += _event.size
+                name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+                offset += length
+                if self._counts(wd, name):
+                    self.changed = True
+        changed, self.changed = self.changed, False
+        return changed
+
+
+def fingerprint(watcher=None):
+    """Names, sizes and mtimes of everything the daemon has loaded or
+    elaborated. The directories are added to watcher."""
+    h = hashlib.sha1()
+    filenames = [os.path.join(TOP_DIR, s + ".py") for s in SCRIPTS]
+    if watcher is not None:
+        watcher.watch(TOP_DIR, set(os.path.basename(f) for f in filenames))
+    dirs = [os.path.join(TOP_DIR, d) for d in SOURCE_DIRS] + _library_dirs()
+    for d in dirs:
+        for dirpath, dirnames, files in os.walk(d):
+            dirnames[:] = sorted(n for n in dirnames if n != "__pycache__")
+            filenames.extend(os.path.join(dirpath, f) for f in files if not f.endswith(".pyc"))
+            if watcher is not None:
+                watcher.watch(dirpath)
+    for filename in sorted(filenames):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        h.update("{}:{}:{}\n".format(filename, st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+class Daemon:
+    def __init__(self):
+        self.watcher = Watcher()
+        self.fingerprint = fingerprint(self.watcher)
+        self.git_head = _git_head()
+        self.selector = selectors.DefaultSelector()
+        self.children = {}
+        # read end of each child's pipe -> (data so far, environment)
+        self.pipes = {}
+        self.running = True
+        self.restart = False
+        # SoCs to elaborate, done one after the other by the worker thread.
+        # The worker holds fork_lock for the whole of an elaboration, a child
+        # forked half way through could inherit a held import lock or a half
+        # imported target. Requests arriving meanwhile wait in pending, the
+        # worker wakes the main loop up when it is done.
+        self.elaborations = queue.Queue()
+        self.fork_lock = threading.Lock()
+        self.pending = []
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, self._wake)
+        self.worker = threading.Thread(target=self._worker, daemon=True)
+        self.worker.start()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(SOCKET_PATH)
+        self.sock.listen(16)
+        self.selector.register(self.sock, selectors.EVENT_READ, self._accept)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(SOCKET_PATH)
+        except FileNotFoundError:
+            pass
+
+    def serve(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=1):
+                key.data(key.fileobj)
+            self._reap()
+
+    def _reap(self):
+        for pid in list(self.children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                del self.children[pid]
+
+    def _accept(self, sock):
+        conn, _ = sock.accept()
+        try:
+            request, fds = _recv(conn, maxfds=3)
+        except (OSError, EOFError, ValueError):
+            conn.close()
+            return
+
+        try:
+            if request.get("command") == "stop":
+                self.running = False
+                _send(conn, {"exit": 0})
+            elif self._can_run(request, fds):
+                self.pending.append((conn, request, fds))
+                self._fork_pending()
+                return
+            else:
+                _send(conn, {"exit": None})
+        except OSError:
+            pass
+        _close(conn, fds)
+
+    def _wake(self, r):
+        try:
+            os.read(r, 64)
+        except BlockingIOError:
+            pass
+        self._fork_pending()
+
+    def _fork_pending(self):
+        # Not while the worker is elaborating, it wakes us up when done.
+        if not self.pending or not self.fork_lock.acquire(blocking=False):
+            return
+        try:
+            pending, self.pending = self.pending, []
+            for conn, request, fds in pending:
+                try:
+                    self._fork(conn, request, fds)
+                except OSError:
+                    pass
+                finally:
+                    _close(conn, fds)
+        finally:
+            self.fork_lock.release()
+
+    def _can_run(self, request, fds):
+        if request.get("script") not in SCRIPTS or len(fds) != 3:
+            return False
+        if os.path.realpath(request["cwd"]) != TOP_DIR:
+            return False
+        # The Verilog output (and so the gateware cache) depends on the hash seed.
+        if request["env"].get("PYTHONHASHSEED") != os.environ.get("PYTHONHASHSEED"):
+            return False
+        if (_git_head() != self.git_head or
+                (self.watcher.poll() and fingerprint(self.watcher) != self.fingerprint)):
+            print("Sources changed, restarting.")
+            self.running = False
+            self.restart = True
+            return False
+        return True
+
+    def _fork(self, conn, request, fds):
+        """Called with fork_lock held."""
+        r, w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            if self.watcher.fd >= 0:
+                os.close(self.watcher.fd)
+            code = 1
+            try:
+                self.sock.close()
+                code = _run_child(conn, request, fds, w)
+            finally:
+                os._exit(code)
+
+        os.close(w)
+        self.children[pid] = request
+        self.selector.register(r, selectors.EVENT_READ, self._child_done)
+        self.pipes[r] = (b"", request["env"])
+
+    def _child_done(self, r):
+        data, env = self.pipes[r]
+        chunk = os.read(r, 65536)
+        if chunk:
+            self.pipes[r] = (data + chunk, env)
+            return
+        self.selector.unregister(r)
+        os.close(r)
+        del self.pipes[r]
+        try:
+            misses = pickle.loads(data)
+        except Exception:
+            return
+        for args in misses:
+            self.elaborations.put((args, env))
+
+    def _worker(self):
+        while True:
+            args, env = self.elaborations.get()
+            with self.fork_lock:
+                self._elaborate(args, env)
+            os.write(self.wake_w, b"\0")
+
+    def _elaborate(self, args, env):
+        import make
+
+        key = make.get_elaboration_key(args)
+        if key in make._elaborated:
+            return
+        from gateware.info import git
+
+        print("Elaborating {}/{}/{}".format(args.platform, args.target, args.cpu_type))
+        environ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(env)
+        try:
+            # The SoC holds the git information of the time it is elaborated,
+            # make.get_platform() drops it once that changed.
+            state = git.state()
+            platform = make.get_platform(args)
+            soc = make.get_soc(args, platform)
+            # Children forked from now on get the SoC.
+            if git.state() == state:
+                make._elaborated[key] = (platform, soc, state)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            del make._elaborated_misses[:]
+
+
+def _close(conn, fds):
+    conn.close()
+    for fd in fds:
+        os.close(fd)
+
+
+def _run_child(conn, request, fds, pipe):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    for i, fd in enumerate(fds):
+        os.dup2(fd, i)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    sys.argv = request["argv"]
+
+    # The client going away (Ctrl-C) interrupts the script.
+    def watch():
+        try:
+            conn.recv(1)
+        except OSError:
+            pass
+        os.kill(os.getpid(), signal.SIGINT)
+    threading.Thread(target=watch, daemon=True).start()
+
+    import make
+    code = 0
+    try:
+        result = importlib.import_module(request["script"]).main()
+        if isinstance(result, int):
+            code = result
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except KeyboardInterrupt:
+        code = 130
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send(conn, {"exit": code})
+    except OSError:
+        pass
+    try:
+        with os.fdopen(pipe, "wb") as f:
+            f.write(pickle.dumps(make._elaborated_misses))
+    except Exception:
+        pass
+    return code
+
+
+def stop():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+        _send(sock, {"command": "stop"})
+        _recv(sock)
+    except (OSError, EOFError):
+        print("No daemon running.")
+        return 1
+    finally:
+        sock.close()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stop", action="store_true", help="stop the running daemon")
+    args = parser.parse_args()
+
+    if args.stop:
+        return stop()
+
+    # Match the Makefile, so the generated Verilog is the same as without the
+    # daemon.
+    if "PYTHONHASHSEED" not in os.environ:
+        os.environ["PYTHONHASHSEED"] = "0"
+        os.execv(sys.executable, [sys.executable, "-m", "tools.daemon"] + sys.argv[1:])
+
+    os.chdir(TOP_DIR)
+    sys.path.insert(0, TOP_DIR)
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+    if os.path.exists(SOCKET_PATH):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(SOCKET_PATH)
+            print("A daemon is already running ({}).".format(SOCKET_PATH))
+            return 1
+        except OSError:
+            os.unlink(SOCKET_PATH)
+        finally:
+            sock.close()
+
+    for module in PRELOAD:
+        importlib.import_module(module)
+
+    daemon = Daemon()
+    print("Listening on {}".format(SOCKET_PATH))
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+    if daemon.restart:
+        os.execv(sys.executable, [sys.executable, "-m", "tools.daemon"] + sys.argv[1:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Profiler for the elaboration of a SoC (the python side of a build).
+
+Time and memory are attributed to each `self.submodules.X = ...` assignment
+(the time since the previous assignment, which is mostly spent constructing
+X), grouped by the chain of Module __init__ methods the assignment was made
+from. The result can be written in the "folded stacks" format used by
+flamegraph.pl and speedscope.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from migen.fhdl import module as migen_module
+
+
+def _frame_label(frame):
+    obj = frame.f_locals.get("self")
+    for cls in type(obj).__mro__:
+        init = cls.__dict__.get("__init__")
+        if getattr(init, "__code__", None) is frame.f_code:
+            return "{}.__init__".format(cls.__name__)
+    return "{}.__init__".format(type(obj).__name__)
+
+
+def _module_stack(frame):
+    """Labels of the Module constructors on the stack, outermost first."""
+    stack = []
+    while frame is not None:
+        if (frame.f_code.co_name == "__init__"
+                and isinstance(frame.f_locals.get("self"), migen_module.Module)):
+            stack.append(_frame_label(frame))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+class ElaborationProfiler:
+    def __init__(self):
+        # (stack, seconds, peak bytes)
+        self.samples = []
+        # name -> (seconds, peak bytes)
+        self.phases = OrderedDict()
+
+        self._phase = None
+        self._last = None
+        self._hooks = None
+
+    def __enter__(self):
+        tracemalloc.start()
+
+        profiler = self
+        submodules = migen_module._ModuleSubmodules
+        orig_setattr = submodules.__setattr__
+        orig_iadd = submodules.__iadd__
+
+        def __setattr__(self, name, value):
+            profiler._sample(name, sys._getframe(1))
+            orig_setattr(self, name, value)
+
+        def __iadd__(self, other):
+            profiler._sample(type(other).__name__, sys._getframe(1))
+            return orig_iadd(self, other)
+
+        self._hooks = (orig_setattr, orig_iadd)
+        submodules.__setattr__ = __setattr__
+        submodules.__iadd__ = __iadd__
+        return self
+
+    def __exit__(self, *exc):
+        submodules = migen_module._ModuleSubmodules
+        submodules.__setattr__, submodules.__iadd__ = self._hooks
+        tracemalloc.stop()
+
+    def _peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        # Python 3.9+, older versions report the peak since the start.
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        return peak
+
+    def _sample(self, name, frame):
+        if self._phase is None:
+            return
+        now = time.perf_counter()
+        stack = (self._phase,) + _module_stack(frame) + (name,)
+        self.samples.append((stack, now - self._last, self._peak()))
+        self._last = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        self._phase = name
+        first = len(self.samples)
+        self._peak()
+        start = self._last = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            # Whatever happened after the last submodule was added.
+            self.samples.append(((name,), end - self._last, self._peak()))
+            peak = max(s[2] for s in self.samples[first:])
+            self.phases[name] = (end - start, peak)
+            self._phase = None
+
+    def write_folded(self, filename):
+        """Write the samples as folded stacks, values in microseconds."""
+        totals = OrderedDict()
+        for stack, seconds, _ in self.samples:
+            key = ";".join(stack)
+            totals[key] = totals.get(key, 0) + seconds
+        with open(filename, "w") as f:
+            for key, seconds in totals.items():
+                f.write("{} {}\n".format(key, int(seconds*1e6)))
+
+    def report(self, top=25):
+        print()
+        print("Elaboration phases")
+        print("-"*75)
+        print("{:40} {:>12} {:>14}".format("Phase", "Wall time", "Peak memory"))
+        for name, (seconds, peak) in self.phases.items():
+            print("{:40} {:>11.2f}s {:>11.1f} MB".format(name, seconds, peak/1e6))
+        print("-"*75)
+
+        print()
+        print("Slowest submodules (time since the previous submodule was added)")
+        print("-"*75)
+        print("{:>9} {:>10}  {}".format("Time", "Peak", "Submodule"))
+        for stack, seconds, peak in sorted(self.samples, key=lambda s: -s[1])[:top]:
+            print("{:>8.2f}s {:>7.1f} MB  {}".format(seconds, peak/1e6, " > ".join(stack)))
+        print("-"*75)
@@ -0,0 +1,152 @@
+"""
+A/B firmware slots in the SPI flash.
+
+With mkimage.py --firmware-slots the firmware area of the flash holds
+
+    selector   firmware/loader (.fbi), followed by a "FWAB" record giving where
+               the slot headers and the slot data are
+    header A   one sector each, so a slot is switched to with a single sector
+    header B   write
+    slot A     the firmware (.bin, or LZ4 compressed, see tools/lz4.py)
+    slot B
+
+The loader boots the valid slot with the highest sequence number. A header is
+valid when its own CRC matches, nothing else is read until the slot is copied
+into main_ram, where each block is checked against the CRC table in the
+header (compressed slots are checked once decompressed). If the data doesn't
+match the loader falls back to the other slot.
+
+flash.py --mode=slot writes the slot which isn't in use, and then its header,
+over Etherbone with the flash engine of the gateware (tools/flash_engine.py).
+
+All values are big endian.
+
+    record:  magic "FWAB", then for each slot the offset of the header and of
+             the data from the start of the selector (u32 each)
+    header:  magic "FWSL", format version (u16), slot (u16), sequence (u32),
+             data length (u32), block size (u32), block count (u32),
+             CRC32 of each block (u32 each), CRC32 of the header (u32)
+"""
+
+import struct
+import zlib
+
+
+SLOTS = ("a", "b")
+
+# Space kept for the loader, so the slots don't move when it changes size.
+SELECTOR_SIZE = 64*1024
+BLOCK_SIZE = 64*1024
+
+RECORD_MAGIC = b"FWAB"
+HEADER_MAGIC = b"FWSL"
+FORMAT_VERSION = 1
+
+_record = struct.Struct(">4sIIII")
+_header = struct.Struct(">4sHHIIII")
+
+# The header (with its CRC table) has to fit in the smallest sector size.
+MAX_HEADER_SIZE = 4096
+MAX_BLOCKS = (MAX_HEADER_SIZE - _header.size - 4) // 4
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class Header:
+    def __init__(self, slot, sequence, length, crcs, block_size=BLOCK_SIZE):
+        self.slot = slot
+        self.sequence = sequence
+        self.length = length
+        self.crcs = crcs
+        self.block_size = block_size
+
+    def __repr__(self):
+        return "Header({!r}, {}, {}, {} blocks)".format(
+            SLOTS[self.slot], self.sequence, self.length, len(self.crcs))
+
+
+def layout(flash):
+    """Where the selector, headers and slots go.
+
+    flash is the "flash" part of the build manifest. Returns a dict of
+    name -> (offset, size), the names are "selector", "header_a", "header_b",
+    "slot_a" and "slot_b".
+    """
+    sector_size = flash["sector_size"]
+    assert sector_size, "Firmware slots need the flash sector size of the platform."
+    start = flash["firmware_offset"]
+    end = flash["total_size"]
+
+    pos = _align(start + SELECTOR_SIZE, sector_size)
+    regions = {"selector": (start, pos - start)}
+    for slot in SLOTS:
+        regions["header_" + slot] = (pos, sector_size)
+        pos += sector_size
+    slot_size = (end - pos) // len(SLOTS) // sector_size * sector_size
+    assert slot_size > 0, "No space left in the flash for the firmware slots."
+    for slot in SLOTS:
+        regions["slot_" + slot] = (pos, slot_size)
+        pos += slot_size
+    return regions
+
+
+def pack_record(regions):
+    start = regions["selector"][0]
+    offsets = []
+    for slot in SLOTS:
+        offsets.append(regions["header_" + slot][0] - start)
+        offsets.append(regions["slot_" + slot][0] - start)
+    return _record.pack(RECORD_MAGIC, *offsets)
+
+
+def make_header(slot, sequence, data):
+    crcs = [zlib.crc32(data[i:i+BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+    assert len(crcs) <= MAX_BLOCKS, "Firmware too big for the slot header CRC table."
+    return Header(SLOTS.index(slot), sequence, len(data), crcs)
+
+
+def pack_header(header):
+    data = _header.pack(
+        HEADER_MAGIC, FORMAT_VERSION, header.slot, header.sequence, header.length,
+        header.block_size, len(header.crcs))
+    data += b"".join(struct.pack(">I", crc) for crc in header.crcs)
+    return data + struct.pack(">I", zlib.crc32(data))
+
+
+def unpack_header(data):
+    """Parse a slot header, returns None if data doesn't hold a valid one."""
+    data = bytes(data)
+    if len(data) < _header.size:
+        return None
+    magic, version, slot, sequence, length, block_size, count = _header.unpack_from(data)
+    if magic != HEADER_MAGIC or version != FORMAT_VERSION or slot >= len(SLOTS):
+        return None
+    if sequence == 0:
+        return None
+    if count > MAX_BLOCKS or block_size == 0 or count != -(-length // block_size):
+        return None
+    end = _header.size + count*4
+    if len(data) < end + 4:
+        return None
+    if struct.unpack_from(">I", data, end)[0] != zlib.crc32(data[:end]):
+        return None
+    crcs = list(struct.unpack_from(">{}I".format(count), data, _header.size))
+    return Header(slot, sequence, length, crcs, block_size)
+
+
+def active(headers):
+    """The header the loader boots first, from a list of valid headers."""
+    headers = [h for h in headers if h is not None]
+    if not headers:
+        return None
+    return max(headers, key=lambda h: h.sequence)
+
+
+def next_update(headers):
+    """The slot name and sequence number the next update should be written to."""
+    current = active(headers)
+    if current is None:
+        return SLOTS[0], 1
+    return SLOTS[(current.slot + 1) % len(SLOTS)], current.sequence + 1
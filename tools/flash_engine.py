@@ -0,0 +1,91 @@
+"""
+Program the SPI flash of a running board over Etherbone.
+
+SoCs built with the program / erase engine of the SpiFlash core (with_engine,
+see SpiFlashEngine in gateware/spi_flash.py) can write their own flash: writes
+to the flash window fill the page buffer of the engine, and the engine_* CSRs
+of the spiflash bank erase a sector or program the buffer. Unlike the JTAG
+programmers nothing is loaded into the FPGA, the board keeps running.
+"""
+
+# SpiFlashEngine commands.
+COMMAND_PROGRAM = 1
+COMMAND_ERASE = 2
+
+# Etherbone reads / writes at most 255 words at a time.
+MAX_BURST = 255
+
+
+class EngineProgrammer:
+    """Has the flash(address, filename) method of the litex programmers, so it
+    can be used in their place."""
+    def __init__(self, wb, spiflash_base, sector_size, page_size=256):
+        assert hasattr(wb.regs, "spiflash_engine_command"), (
+            "The gateware on the board has no SPI flash program / erase engine.")
+        assert sector_size, "Programming over Etherbone needs the flash sector size."
+        self.wb = wb
+        self.base = spiflash_base
+        self.sector_size = sector_size
+        self.page_size = page_size
+
+    def _command(self, address, command):
+        regs = self.wb.regs
+        regs.spiflash_engine_address.write(address)
+        regs.spiflash_engine_command.write(command)
+        while regs.spiflash_engine_busy.read():
+            pass
+
+    def _invalidate(self):
+        # The flash cache still holds what was there before.
+        if hasattr(self.wb.regs, "spiflash_cache_invalidate"):
+            self.wb.regs.spiflash_cache_invalidate.write(1)
+
+    def read(self, address, length):
+        """Read length bytes from address of the flash."""
+        count = (length + 3)//4
+        words = []
+        for i in range(0, count, MAX_BURST):
+            words += self.wb.read(self.base + address + 4*i, min(MAX_BURST, count - i))
+        return b"".join(w.to_bytes(4, "big") for w in words)[:length]
+
+    def _program(self, address, data):
+        # Erased bytes don't need programming.
+        data = data.rstrip(b"\xff")
+        if not data:
+            return
+        padded = data + b"\xff"*(-len(data) % 4)
+        words = [int.from_bytes(padded[i:i+4], "big") for i in range(0, len(padded), 4)]
+        self.wb.write(self.base + address, words)
+        self.wb.regs.spiflash_engine_length.write(len(data))
+        self._command(address, COMMAND_PROGRAM)
+
+    def write(self, address, data):
+        """Write data at address. The engine erases whole sectors, the rest of
+        a sector data only covers part of is read first and written back."""
+        assert address % 4 == 0, "Flash writes over Etherbone must be word aligned."
+        end = address + len(data)
+        sector = address // self.sector_size * self.sector_size
+        self._invalidate()
+        while sector < end:
+            start = max(address, sector)
+            stop = min(end, sector + self.sector_size)
+            contents = data[start - address:stop - address]
+            if (start, stop) != (sector, sector + self.sector_size):
+                old = bytearray(self.read(sector, self.sector_size))
+                old[start - sector:stop - sector] = contents
+                contents = bytes(old)
+            self._command(sector, COMMAND_ERASE)
+            for page in range(0, self.sector_size, self.page_size):
+                self._program(sector + page, contents[page:page + self.page_size])
+            sector += self.sector_size
+        self._invalidate()
+
+    def flash(self, address, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        print("Programming 0x{:08x}-0x{:08x} over Etherbone".format(address, address + len(data)))
+        self.write(address, data)
+        if self.read(address, len(data)) != data:
+            raise IOError("Flash contents at 0x{:08x}-0x{:08x} don't match after programming.".format(
+                address, address + len(data)))
+        print("Flash contents verified.")
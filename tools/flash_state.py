@@ -0,0 +1,156 @@
+"""
+Record of what was last written to the SPI flash of each board.
+
+The hash of every sector written by flash.py is kept in
+build/flash-state/<board id>.json, so `flash.py --delta` only has to erase and
+program the sectors which changed since then. The region table (see
+tools/region_table.py) and the firmware slot headers written are kept too.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from tools.region_table import Region
+
+
+STATE_DIR = os.path.join("build", "flash-state")
+
+# Unchanged sectors between two changed ones are programmed anyway if there are
+# this few of them, each programmer run has a fixed cost (loading the flash
+# proxy bitstream, ...).
+MERGE_GAP = 4
+
+
+def _state_file(board_id):
+    return os.path.join(STATE_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", board_id) + ".json")
+
+
+def sector_hashes(data, address, sector_size):
+    """Hash of the part of each sector data covers when written at address.
+
+    Returns a dict of sector address -> hash.
+    """
+    hashes = {}
+    pos = 0
+    while pos < len(data):
+        sector = (address + pos) // sector_size * sector_size
+        end = min(len(data), sector + sector_size - address)
+        h = hashlib.sha1()
+        # The offset in the sector matters as much as the data.
+        h.update("{}:".format(address + pos - sector).encode("ascii"))
+        h.update(data[pos:end])
+        hashes[sector] = h.hexdigest()
+        pos = end
+    return hashes
+
+
+def _load_state(board_id):
+    try:
+        with open(_state_file(board_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load(board_id, sector_size):
+    """The sector hashes last written to board_id."""
+    state = _load_state(board_id)
+    try:
+        if state["sector_size"] != sector_size:
+            return {}
+        return dict((int(k), v) for k, v in state["sectors"].items())
+    except (KeyError, ValueError):
+        return {}
+
+
+def _save(board_id, sector_size, sectors):
+    state = _load_state(board_id)
+    state.update({
+        "board_id": board_id,
+        "sector_size": sector_size,
+        "sectors": dict((str(k), v) for k, v in sorted(sectors.items())),
+    })
+    _save_state(board_id, state)
+
+
+def _save_state(board_id, state):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    filename = _state_file(board_id)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+
+def update(board_id, sector_size, hashes):
+    """Record that the sectors in hashes were written to board_id."""
+    sectors = load(board_id, sector_size)
+    sectors.update(hashes)
+    _save(board_id, sector_size, sectors)
+
+
+def invalidate(board_id, sector_size, hashes):
+    """Forget the sectors in hashes, before they are written to board_id.
+
+    If programming fails part way through their contents are unknown.
+    """
+    sectors = load(board_id, sector_size)
+    for sector in hashes:
+        sectors.pop(sector, None)
+    _save(board_id, sector_size, sectors)
+
+
+def changed_runs(hashes, previous, sector_size):
+    """Group the sectors which differ from previous into (start, end) ranges."""
+    changed = sorted(s for s, h in hashes.items() if previous.get(s) != h)
+    runs = []
+    for sector in changed:
+        if runs and sector - runs[-1][1] <= MERGE_GAP*sector_size:
+            runs[-1][1] = sector + sector_size
+        else:
+            runs.append([sector, sector + sector_size])
+    return [tuple(r) for r in runs]
+
+
+def region_table(board_id):
+    """The region table last written to board_id, a list of Region ([] if
+    there is none). None if it isn't known, because a write was interrupted.
+    """
+    table = _load_state(board_id).get("region_table", [])
+    if table is None:
+        return None
+    return [Region(*entry) for entry in table]
+
+
+def update_region_table(board_id, regions):
+    """Record the region table of board_id, None while it is being written."""
+    state = _load_state(board_id)
+    if regions is None:
+        state["region_table"] = None
+    else:
+        state["region_table"] = [[r.name, r.offset, r.length, r.crc, r.version] for r in regions]
+    state["board_id"] = board_id
+    _save_state(board_id, state)
+
+
+def slot_headers(board_id):
+    """The firmware slot headers (see tools/firmware_slots.py) last written to
+    board_id, a dict of slot name -> header bytes."""
+    slots = _load_state(board_id).get("slots", {})
+    return dict((name, bytes.fromhex(header)) for name, header in slots.items())
+
+
+def update_slot_header(board_id, slot, header):
+    """Record that header was written to firmware slot slot of board_id.
+
+    header is None while the slot is being written.
+    """
+    state = _load_state(board_id)
+    slots = state.setdefault("slots", {})
+    if header is None:
+        slots.pop(slot, None)
+    else:
+        slots[slot] = header.hex()
+    state["board_id"] = board_id
+    _save_state(board_id, state)
@@ -0,0 +1,144 @@
+"""
+Content addressed cache for FPGA toolchain output.
+
+The key is a hash of everything the FPGA toolchain consumes: the generated
+Verilog and memory init files, the constraints and project files, any extra
+HDL sources added by the platform, the toolchain settings and the build
+options. If two builds produce the same key the toolchain would produce the
+same bitstream, so it is restored from the cache instead.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+CACHE_DIR = os.path.join("build", "gateware-cache")
+
+# Files written by the platform *before* the toolchain is run. Build scripts
+# (.sh / .bat) are not included as some toolchains only write them when run.
+INPUT_EXTENSIONS = (
+    ".v", ".vhd", ".vhdl", ".init",                 # HDL + memory contents
+    ".ucf", ".xdc", ".pcf", ".lpf",                 # Constraints
+    ".prj", ".xst", ".tcl", ".ys",                  # Project / tool scripts
+)
+
+# Files produced by the toolchain which are kept in the cache, the bitstreams
+# and icestorm's placed and routed design (.txt).
+OUTPUT_EXTENSIONS = (".bit", ".bin", ".txt")
+
+# Toolchain binaries used to identify the installed toolchain version.
+TOOLCHAIN_BINARIES = (
+    "xst", "map", "par", "bitgen",
+    "vivado",
+    "yosys", "nextpnr-ice40", "arachne-pnr", "icepack",
+)
+TOOLCHAIN_ENVIRONMENT = ("XILINX", "XILINX_VIVADO", "LITEX_ENV_ISE", "LITEX_ENV_VIVADO")
+
+
+def _hash_file(h, filename):
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+
+
+def _toolchain_identity(toolchain):
+    """Settings of the toolchain object which end up in the build scripts."""
+    ident = ["{}.{}".format(type(toolchain).__module__, type(toolchain).__name__)]
+    for name, value in sorted(vars(toolchain).items()):
+        if isinstance(value, (list, tuple)):
+            if not all(isinstance(v, (str, int, float, bool)) for v in value):
+                continue
+        elif not isinstance(value, (str, int, float, bool)):
+            continue
+        ident.append("{}={!r}".format(name, value))
+
+    for binary in TOOLCHAIN_BINARIES:
+        path = shutil.which(binary)
+        if path is None:
+            continue
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        ident.append("{}={}:{}:{}".format(binary, path, st.st_size, int(st.st_mtime)))
+
+    for name in TOOLCHAIN_ENVIRONMENT:
+        if name in os.environ:
+            ident.append("${}={}".format(name, os.environ[name]))
+    return ident
+
+
+def get_key(gateware_dir, platform, build_options=(), ignore_extensions=()):
+    """Hash the toolchain inputs found in gateware_dir.
+
+    Files ending in ignore_extensions are left out, ignoring ".init" gives a
+    key for the design without its memory contents.
+    """
+    h = hashlib.sha256()
+
+    h.update(platform.device.encode("utf-8"))
+    for line in _toolchain_identity(platform.toolchain):
+        h.update(b"\0" + line.encode("utf-8"))
+    for name, value in sorted(build_options):
+        h.update("\0{}={}".format(name, value).encode("utf-8"))
+
+    for filename in sorted(os.listdir(gateware_dir)):
+        if not filename.endswith(INPUT_EXTENSIONS):
+            continue
+        if ignore_extensions and filename.endswith(tuple(ignore_extensions)):
+            continue
+        h.update(b"\0" + filename.encode("utf-8") + b"\0")
+        _hash_file(h, os.path.join(gateware_dir, filename))
+
+    # Extra sources are referenced by absolute path from the project files, so
+    # their contents need hashing too.
+    for source in sorted(platform.sources):
+        h.update(b"\0" + os.path.basename(source[0]).encode("utf-8") + b"\0")
+        _hash_file(h, source[0])
+
+    return h.hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(CACHE_DIR, key)
+
+
+def restore(key, gateware_dir):
+    """Copy the cached toolchain output into gateware_dir.
+
+    Returns False if the key isn't in the cache.
+    """
+    entry = _entry_dir(key)
+    if not os.path.isdir(entry):
+        return False
+    for filename in sorted(os.listdir(entry)):
+        # shutil.copy (rather than copy2) so the restored files are newer than
+        # their inputs as far as make is concerned.
+        shutil.copy(os.path.join(entry, filename), os.path.join(gateware_dir, filename))
+    return True
+
+
+def store(key, gateware_dir, build_name="top"):
+    """Save the toolchain output in gateware_dir under key."""
+    outputs = [build_name + ext for ext in OUTPUT_EXTENSIONS
+               if os.path.exists(os.path.join(gateware_dir, build_name + ext))]
+    if not outputs:
+        return False
+
+    entry = _entry_dir(key)
+    if os.path.isdir(entry):
+        return True
+
+    # Populate a temporary directory first so a half written entry is never
+    # visible to a concurrent build.
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix=".{}.".format(key[:12]), dir=CACHE_DIR)
+    try:
+        for filename in outputs:
+            shutil.copy2(os.path.join(gateware_dir, filename), os.path.join(tmpdir, filename))
+        os.rename(tmpdir, entry)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.isdir(entry):
+            raise
+    return True
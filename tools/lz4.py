@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+LZ4 block compression of the firmware stored in the flash image.
+
+A compressed firmware image is a header followed by a single LZ4 block (see
+https://github.com/lz4/lz4/blob/dev/doc/lz4_Block_format.md). The header
+values are big endian.
+
+    magic "FWLZ", uncompressed length (u32), compressed length (u32),
+    CRC32 of the uncompressed data (u32), CRC32 of the compressed data (u32)
+
+firmware/loader decompresses it into main_ram at boot.
+
+Run as `python -m tools.lz4 [FILE...]` to check each file (or a few built in
+samples) survives a round trip through the compressor and both decompressors:
+the one below, and firmware/loader/lz4.c built for the host with $CC.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+
+
+MAGIC = b"FWLZ"
+HEADER = struct.Struct(">4sIIII")
+
+MIN_MATCH = 4
+MAX_OFFSET = 0xffff
+# The last match has to start at least 12 bytes before the end of the block,
+# and the last 5 bytes are always literals.
+MF_LIMIT = 12
+LAST_LITERALS = 5
+
+
+def _length(out, n):
+    while n >= 255:
+        out.append(255)
+        n -= 255
+    out.append(n)
+
+
+def _sequence(out, literals, offset=None, match_length=None):
+    token = min(len(literals), 15) << 4
+    if offset is not None:
+        token |= min(match_length - MIN_MATCH, 15)
+    out.append(token)
+    if len(literals) >= 15:
+        _length(out, len(literals) - 15)
+    out += literals
+    if offset is not None:
+        out += struct.pack("<H", offset)
+        if match_length - MIN_MATCH >= 15:
+            _length(out, match_length - MIN_MATCH - 15)
+
+
+def compress(data):
+    """Compress data into a single LZ4 block."""
+    data = bytes(data)
+    n = len(data)
+    out = bytearray()
+    table = {}
+    anchor = 0
+    i = 0
+    while i < n - MF_LIMIT:
+        key = data[i:i+MIN_MATCH]
+        ref = table.get(key)
+        table[key] = i
+        if ref is None or i - ref > MAX_OFFSET:
+            i += 1
+            continue
+
+        length = MIN_MATCH
+        max_length = n - LAST_LITERALS - i
+        while length < max_length and data[ref+length] == data[i+length]:
+            length += 1
+
+        _sequence(out, data[anchor:i], i - ref, length)
+        i += length
+        anchor = i
+    _sequence(out, data[anchor:])
+    return bytes(out)
+
+
+def _read_length(block, i):
+    n = 0
+    while True:
+        b = block[i]
+        i += 1
+        n += b
+        if b != 255:
+            return n, i
+
+
+def decompress(block, size):
+    """Decompress a single LZ4 block which decompresses to size bytes."""
+    out = bytearray()
+    i = 0
+    while i < len(block):
+        token = block[i]
+        i += 1
+
+        literals = token >> 4
+        if literals == 15:
+            extra, i = _read_length(block, i)
+            literals += extra
+        out += block[i:i+literals]
+        i += literals
+        if i >= len(block):
+            break
+
+        offset = block[i] | (block[i+1] << 8)
+        i += 2
+        match_length = token & 0xf
+        if match_length == 15:
+            extra, i = _read_length(block, i)
+            match_length += extra
+        match_length += MIN_MATCH
+        if offset == 0 or offset > len(out):
+            raise ValueError("Invalid match offset {} at {}".format(offset, i))
+
+        start = len(out) - offset
+        if offset >= match_length:
+            out += out[start:start+match_length]
+        else:
+            # Overlapping match, repeats the last offset bytes.
+            for j in range(match_length):
+                out.append(out[start+j])
+
+    if len(out) != size:
+        raise ValueError("Decompressed to {} bytes, expected {}".format(len(out), size))
+    return bytes(out)
+
+
+def pack_firmware(data):
+    """Compress data into a compressed firmware image."""
+    block = compress(data)
+    return HEADER.pack(MAGIC, len(data), len(block), zlib.crc32(data), zlib.crc32(block)) + block
+
+
+def unpack_firmware(image):
+    """Decompress and check a compressed firmware image."""
+    magic, size, block_size, crc, block_crc = HEADER.unpack_from(image)
+    if magic != MAGIC:
+        raise ValueError("Not a compressed firmware image")
+    block = image[HEADER.size:HEADER.size+block_size]
+    if len(block) != block_size or zlib.crc32(block) != block_crc:
+        raise ValueError("Compressed data CRC mismatch")
+    data = decompress(block, size)
+    if zlib.crc32(data) != crc:
+        raise ValueError("Decompressed data CRC mismatch")
+    return data
+
+
+LOADER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "firmware", "loader")
+
+# Reads a compressed firmware image on stdin and writes the data to stdout,
+# checking it the same way firmware/loader does.
+_HOST_MAIN = r"""
+#include <stdio.h>
+#include <string.h>
+#include "lz4.h"
+
+static unsigned char image[32 << 20], out[32 << 20];
+
+static unsigned int read_be32(const unsigned char *p)
+{
+	return ((unsigned int)p[0] << 24) | (p[1] << 16) | (p[2] << 8) | p[3];
+}
+
+int main(void)
+{
+	size_t len = fread(image, 1, sizeof(image), stdin);
+	unsigned int size, block_size;
+
+	if(len < 20 || memcmp(image, "FWLZ", 4) != 0)
+		return 2;
+	size = read_be32(image + 4);
+	block_size = read_be32(image + 8);
+	if(block_size > len - 20 || size > sizeof(out))
+		return 2;
+	if(lz4_crc32(image + 20, block_size) != read_be32(image + 16))
+		return 3;
+	if(lz4_decompress(image + 20, block_size, out, size) != (int)size)
+		return 4;
+	if(lz4_crc32(out, size) != read_be32(image + 12))
+		return 5;
+	fwrite(out, 1, size, stdout);
+	return 0;
+}
+"""
+
+
+def build_host_decompressor(builddir):
+    """Builds firmware/loader/lz4.c for the host, returns the program."""
+    main_c = os.path.join(builddir, "lz4_host.c")
+    program = os.path.join(builddir, "lz4_host")
+    with open(main_c, "w") as f:
+        f.write(_HOST_MAIN)
+    cc = os.environ.get("CC", "cc")
+    subprocess.check_call([cc, "-O2", "-Wall", "-I", LOADER_DIR, "-o", program,
+        main_c, os.path.join(LOADER_DIR, "lz4.c")])
+    return program
+
+
+def _samples():
+    rand = random.Random(0)
+    noise = bytes(rand.randrange(256) for i in range(4096))
+    return [
+        ("empty", b""),
+        ("short", b"abc"),
+        ("zeros", bytes(100000)),
+        ("noise", noise),
+        # Matches longer than 15 + 255 bytes, and overlapping ones.
+        ("repeats", (b"firmware" + noise[:300])*50 + b"ab"*1000),
+        ("text", open(__file__, "rb").read()),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="files to round trip (default: built in samples)")
+    args = parser.parse_args()
+
+    if args.files:
+        inputs = []
+        for filename in args.files:
+            with open(filename, "rb") as f:
+                inputs.append((filename, f.read()))
+    else:
+        inputs = _samples()
+
+    builddir = tempfile.mkdtemp(prefix="lz4_host")
+    try:
+        try:
+            program = build_host_decompressor(builddir)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Could not build {} for the host: {}".format(os.path.join(LOADER_DIR, "lz4.c"), e))
+            return 1
+
+        failed = 0
+        for name, data in inputs:
+            image = pack_firmware(data)
+            errors = []
+            try:
+                if unpack_firmware(image) != data:
+                    errors.append("python decompressor: wrong data")
+            except (ValueError, IndexError) as e:
+                errors.append("python decompressor: {}".format(e))
+            p = subprocess.run([program], input=image, stdout=subprocess.PIPE)
+            if p.returncode != 0:
+                errors.append("lz4.c: exit code {}".format(p.returncode))
+            elif p.stdout != data:
+                errors.append("lz4.c: wrong data")
+            print("{}: {:10} -> {:10} bytes ({:.1f}%) {}".format(
+                name, len(data), len(image), 100.0*len(image)/max(len(data), 1),
+                "; ".join(errors) or "ok"))
+            failed += bool(errors)
+    finally:
+        shutil.rmtree(builddir)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
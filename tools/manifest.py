@@ -0,0 +1,127 @@
+"""
+Build manifest written by make.py into the build directory.
+
+It records what the host tools (mkimage.py, flash.py, ...) would otherwise
+need to elaborate the SoC to find out; the memory regions, the flash layout
+and the build artifacts.
+"""
+
+import hashlib
+import json
+import os
+
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+# Changes to any of these files can change the memory map or flash layout.
+SOURCE_DIRS = ("platforms", "targets", "gateware")
+SOURCE_FILES = ("make.py",)
+
+
+def source_fingerprint(topdir="."):
+    """Cheap fingerprint (names, sizes and mtimes) of the SoC python sources."""
+    h = hashlib.sha1()
+    filenames = [os.path.join(topdir, f) for f in SOURCE_FILES]
+    for d in SOURCE_DIRS:
+        for dirpath, dirnames, files in os.walk(os.path.join(topdir, d)):
+            dirnames[:] = sorted(n for n in dirnames if n != "__pycache__")
+            filenames.extend(os.path.join(dirpath, f) for f in files if f.endswith(".py"))
+    for filename in sorted(filenames):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        h.update("{}:{}:{}\n".format(filename, st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _args_key(args):
+    return {
+        "platform": args.platform,
+        "target": args.target,
+        "cpu_type": args.cpu_type,
+        "cpu_variant": args.cpu_variant,
+        "platform_option": sorted(list(o) for o in args.platform_option),
+        "target_option": sorted(list(o) for o in args.target_option),
+    }
+
+
+def _artifact(filename):
+    if not os.path.exists(filename):
+        return None
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+    return {
+        "path": filename,
+        "size": os.path.getsize(filename),
+        "sha256": h.hexdigest(),
+    }
+
+
+def create(args, platform, soc, artifacts, bios_maxsize):
+    """Describe an elaborated SoC.
+
+    artifacts is a dict of name -> filename, missing files are recorded as
+    None.
+    """
+    regions = {}
+    for region in soc.get_memory_regions():
+        name, origin, length = region[:3]
+        regions[name] = {"origin": origin, "length": length}
+
+    gateware_size = getattr(platform, "gateware_size", None)
+    flash = {
+        "total_size": getattr(platform, "spiflash_total_size", None),
+        "page_size": getattr(platform, "spiflash_page_size", None),
+        "sector_size": getattr(platform, "spiflash_sector_size", None),
+        "model": getattr(platform, "spiflash_model", None),
+        "gateware_size": gateware_size,
+        "bios_maxsize": bios_maxsize,
+        "gateware_offset": None,
+        "bios_offset": None,
+        "firmware_offset": None,
+    }
+    if gateware_size is not None:
+        flash["gateware_offset"] = 0
+        flash["bios_offset"] = gateware_size
+        flash["firmware_offset"] = gateware_size + bios_maxsize
+
+    return {
+        "version": MANIFEST_VERSION,
+        "args": _args_key(args),
+        "sources": source_fingerprint(),
+        "memory_regions": regions,
+        "flash": flash,
+        "artifacts": dict((name, _artifact(filename)) for name, filename in artifacts.items()),
+    }
+
+
+def write(builddir, manifest):
+    filename = os.path.join(builddir, MANIFEST_NAME)
+    os.makedirs(builddir, exist_ok=True)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+
+def load(builddir, args):
+    """Load the manifest, returns None if it is missing or stale."""
+    filename = os.path.join(builddir, MANIFEST_NAME)
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    if manifest.get("args") != _args_key(args):
+        return None
+    if manifest.get("sources") != source_fingerprint():
+        return None
+    return manifest
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Build a matrix of PLATFORM/TARGET/CPU[.VARIANT] combinations in parallel.
+
+Each combination is built by running make.py in its own build directory,
+with the output going to a log file in that directory.
+
+Example:
+    python -m tools.matrix -j 4 opsis/hdmi2usb arty/net/vexriscv.lite -- --no-compile-firmware
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+TOP_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class Job:
+    def __init__(self, spec, default_cpu):
+        parts = spec.split("/")
+        if len(parts) not in (2, 3) or not all(parts):
+            raise ValueError("Invalid matrix entry {!r}, expected PLATFORM/TARGET[/CPU[.VARIANT]]".format(spec))
+        if len(parts) == 2:
+            parts.append(default_cpu)
+        self.platform, self.target, full_cpu = parts
+        self.cpu_type, _, self.cpu_variant = full_cpu.partition(".")
+
+        self.target_option = []
+        self.returncode = None
+        self.walltime = None
+
+    @property
+    def name(self):
+        cpu = self.cpu_type
+        if self.cpu_variant:
+            cpu += "." + self.cpu_variant
+        return "{}/{}/{}".format(self.platform, self.target, cpu)
+
+    @property
+    def builddir(self):
+        # make.py only imports litex in the functions which need it.
+        from make import get_builddir
+        args = argparse.Namespace(
+            platform=self.platform,
+            target=self.target,
+            cpu_type=self.cpu_type,
+            cpu_variant=self.cpu_variant or None,
+            target_option=self.target_option)
+        return os.path.normpath(os.path.join(TOP_DIR, get_builddir(args)))
+
+    @property
+    def logfile(self):
+        return os.path.join(self.builddir, "output.matrix.log")
+
+    def command(self, extra_args):
+        cmd = [
+            sys.executable, "-u", "make.py",
+            "--platform={}".format(self.platform),
+            "--target={}".format(self.target),
+            "--cpu-type={}".format(self.cpu_type),
+        ]
+        if self.cpu_variant:
+            cmd.append("--cpu-variant={}".format(self.cpu_variant))
+        return cmd + list(extra_args)
+
+
+def parse_specs(specs, default_cpu):
+    """Turn the command line entries (or files listing entries) into Jobs."""
+    jobs = []
+    for spec in specs:
+        if os.path.isfile(spec):
+            with open(spec) as f:
+                lines = [l.split("#")[0].strip() for l in f]
+            jobs.extend(Job(l, default_cpu) for l in lines if l)
+        else:
+            jobs.append(Job(spec, default_cpu))
+    return jobs
+
+
+def run_job(job, extra_args, lock, processes, stop):
+    # Jobs still queued when the matrix is interrupted are skipped, and keep
+    # the log of their previous build.
+    start = time.time()
+    with lock:
+        if stop.is_set():
+            return job
+        os.makedirs(job.builddir, exist_ok=True)
+        log = open(job.logfile, "w")
+        try:
+            print("[{}] Starting, log in {}".format(job.name, job.logfile))
+            p = subprocess.Popen(
+                job.command(extra_args), cwd=TOP_DIR,
+                stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        except OSError:
+            log.close()
+            raise
+        processes.append(p)
+    with log:
+        job.returncode = p.wait()
+    job.walltime = time.time() - start
+    with lock:
+        print("[{}] {} after {:.0f}s".format(
+            job.name, "Passed" if job.returncode == 0 else "FAILED", job.walltime))
+    return job
+
+
+def print_summary(jobs):
+    width = max(len(j.name) for j in jobs)
+    print()
+    print("-"*75)
+    print("{:{w}}  {:6}  {:>10}  {}".format("Build", "Result", "Wall time", "Log", w=width))
+    print("-"*75)
+    for job in jobs:
+        if job.returncode is None:
+            result, walltime = "SKIP", "-"
+        else:
+            result = "pass" if job.returncode == 0 else "FAIL"
+            walltime = "{:.0f}s".format(job.walltime)
+        print("{:{w}}  {:6}  {:>10}  {}".format(job.name, result, walltime, job.logfile, w=width))
+    print("-"*75)
+    passed = sum(1 for j in jobs if j.returncode == 0)
+    print("{} of {} builds passed.".format(passed, len(jobs)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("specs", nargs="+", metavar="PLATFORM/TARGET[/CPU[.VARIANT]]",
+        help="combination to build, or a file listing one combination per line")
+    parser.add_argument("-j", "--jobs", type=int, default=max(1, (os.cpu_count() or 2)//2),
+        help="number of builds to run at the same time")
+    parser.add_argument("--build-jobs", type=int, default=None,
+        help="number of jobs each build compiles the software with (default: the CPU count divided between the builds)")
+    parser.add_argument("--cpu-type", default=os.environ.get('CPU', 'lm32'),
+        help="CPU to use when an entry doesn't give one")
+
+    # Everything after "--" is passed to make.py.
+    argv = sys.argv[1:]
+    extra_args = []
+    if "--" in argv:
+        extra_args = argv[argv.index("--")+1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+
+    # Each make.py runs its own jobserver, share the CPUs between them
+    # instead of every build using all of them.
+    option_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    option_parser.add_argument("-j", "--jobs", type=int, default=None)
+    if option_parser.parse_known_args(extra_args)[0].jobs is None:
+        build_jobs = args.build_jobs or max(1, (os.cpu_count() or 1)//args.jobs)
+        extra_args.append("--jobs={}".format(build_jobs))
+
+    sys.path.insert(0, TOP_DIR)
+    jobs = parse_specs(args.specs, args.cpu_type)
+
+    # -Ot tofe_board changes the build directory, as in make.py.
+    option_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    option_parser.add_argument("-Ot", "--target-option", default=[], nargs=2, action="append")
+    target_option = option_parser.parse_known_args(extra_args)[0].target_option
+    for job in jobs:
+        job.target_option = target_option
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    processes = []
+    pool = ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        futures = [pool.submit(run_job, job, extra_args, lock, processes, stop) for job in jobs]
+        for job, future in zip(jobs, futures):
+            if future.exception() is not None:
+                print("[{}] Error: {}".format(job.name, future.exception()))
+    except KeyboardInterrupt:
+        with lock:
+            stop.set()
+            for p in processes:
+                if p.poll() is None:
+                    p.terminate()
+        raise
+    finally:
+        pool.shutdown()
+        print_summary(jobs)
+
+    return 0 if all(j.returncode == 0 for j in jobs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
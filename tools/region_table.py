@@ -0,0 +1,86 @@
+"""
+Table of the regions (gateware, BIOS, firmware, ...) in a flash image.
+
+mkimage.py writes the table in the last TABLE_SIZE bytes of the gateware area
+so the BIOS / firmware and the host tools can find and check each region
+without reading the whole flash.
+
+flash.py --mode=image writes the table with the image. The other flash.py
+modes rewrite it with the entries of the regions they wrote updated (see
+update()). Over JTAG that needs the table last written to the board, which
+flash.py keeps for --board-id in tools/flash_state.py.
+
+All values are big endian.
+
+    header:  magic "LXRT", format version (u16), entry count (u16),
+             CRC32 of the entries (u32)
+    entry:   name (8 bytes, NUL padded), offset (u32), length (u32),
+             CRC32 of the region data (u32), region version (u32)
+"""
+
+import struct
+import zlib
+
+
+MAGIC = b"LXRT"
+FORMAT_VERSION = 1
+TABLE_SIZE = 256
+
+_header = struct.Struct(">4sHHI")
+_entry = struct.Struct(">8sIIII")
+
+MAX_ENTRIES = (TABLE_SIZE - _header.size) // _entry.size
+
+
+class Region:
+    def __init__(self, name, offset, length, crc, version=1):
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+        self.version = version
+
+    def __repr__(self):
+        return "Region({!r}, 0x{:08x}, {}, 0x{:08x}, {})".format(
+            self.name, self.offset, self.length, self.crc, self.version)
+
+
+def table_offset(flash):
+    """Where the table goes, flash is the "flash" part of the build manifest."""
+    return flash["gateware_offset"] + flash["gateware_size"] - TABLE_SIZE
+
+
+def update(regions, name, offset, data):
+    """regions after data was written at offset: the regions it overlaps are
+    dropped, and replaced by an entry called name (unless name is None)."""
+    end = offset + len(data)
+    regions = [r for r in regions if r.offset + r.length <= offset or end <= r.offset]
+    if name is not None:
+        regions.append(Region(name, offset, len(data), zlib.crc32(data)))
+    return sorted(regions, key=lambda r: r.offset)
+
+
+def pack(regions):
+    assert len(regions) <= MAX_ENTRIES, "Too many regions for the region table"
+    entries = b"".join(
+        _entry.pack(r.name.encode("ascii"), r.offset, r.length, r.crc, r.version)
+        for r in regions)
+    data = _header.pack(MAGIC, FORMAT_VERSION, len(regions), zlib.crc32(entries)) + entries
+    return data + b"\xff"*(TABLE_SIZE - len(data))
+
+
+def unpack(data):
+    """Parse a region table, returns None if data doesn't hold a valid one."""
+    if len(data) < _header.size:
+        return None
+    magic, version, count, crc = _header.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION or count > MAX_ENTRIES:
+        return None
+    entries = bytes(data[_header.size:_header.size + count*_entry.size])
+    if len(entries) != count*_entry.size or zlib.crc32(entries) != crc:
+        return None
+    regions = []
+    for i in range(count):
+        name, offset, length, crc, version = _entry.unpack_from(entries, i*_entry.size)
+        regions.append(Region(name.rstrip(b"\0").decode("ascii"), offset, length, crc, version))
+    return regions
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Registry of the available platforms and targets.
+
+The platform and target modules are never imported, the registry is built by
+parsing the sources (and the targets' Makefile.mk) so it can be used without
+migen / litex being loaded. The result is cached in build/registry.json.
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import operator
+import os
+import re
+import sys
+
+
+TOP_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+CACHE_FILE = os.path.join(TOP_DIR, "build", "registry.json")
+REGISTRY_VERSION = 1
+
+DEFAULT_CPU = "lm32"
+
+# Class attributes of platforms.X.Platform recorded in the registry.
+PLATFORM_ATTRIBUTES = (
+    "name",
+    "default_clk_name",
+    "default_clk_period",
+    "gateware_size",
+    "spiflash_model",
+    "spiflash_read_dummy_bits",
+    "spiflash_clock_div",
+    "spiflash_total_size",
+    "spiflash_page_size",
+    "spiflash_sector_size",
+)
+
+_BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+}
+
+
+def _constant(node, names):
+    """Evaluate simple constant expressions like `int((128/8)*1024*1024)`."""
+    if isinstance(node, ast.Name) and node.id in names:
+        return names[node.id]
+    if isinstance(node, ast.Constant):
+        return node.value
+    # Python < 3.8
+    if type(node).__name__ == "Num":
+        return node.n
+    if type(node).__name__ == "Str":
+        return node.s
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_constant(node.operand, names)
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINOPS:
+        return _BINOPS[type(node.op)](_constant(node.left, names), _constant(node.right, names))
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id == "int" and len(node.args) == 1 and not node.keywords):
+        return int(_constant(node.args[0], names))
+    raise ValueError("Not a constant")
+
+
+def _platform_info(filename):
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == "Platform":
+            break
+    else:
+        return None
+
+    names = {}
+    for stmt in node.body:
+        if not isinstance(stmt, ast.Assign) or len(stmt.targets) != 1:
+            continue
+        target = stmt.targets[0]
+        if not isinstance(target, ast.Name):
+            continue
+        try:
+            names[target.id] = _constant(stmt.value, names)
+        except (ValueError, TypeError, ZeroDivisionError):
+            pass
+    return dict((k, v) for k, v in names.items() if k in PLATFORM_ATTRIBUTES)
+
+
+def _makefile_variable(filename, name):
+    regex = re.compile(r"^{}\s*=\s*(\S*)\s*$".format(re.escape(name)))
+    with open(filename) as f:
+        for line in f:
+            m = regex.match(line)
+            if m:
+                return m.group(1) or None
+    return None
+
+
+def _source_files():
+    files = [os.path.abspath(__file__)]
+    for d in ("platforms", "targets"):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(TOP_DIR, d)):
+            dirnames[:] = sorted(n for n in dirnames if n != "__pycache__")
+            files.extend(os.path.join(dirpath, f) for f in filenames
+                         if f.endswith(".py") or f == "Makefile.mk")
+    return sorted(files)
+
+
+def _fingerprint():
+    h = hashlib.sha1()
+    for filename in _source_files():
+        st = os.stat(filename)
+        h.update("{}:{}:{}\n".format(filename, st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def scan():
+    """Build the registry from the source tree."""
+    platforms = {}
+
+    platforms_dir = os.path.join(TOP_DIR, "platforms")
+    for filename in sorted(os.listdir(platforms_dir)):
+        if not filename.endswith(".py") or filename.startswith("__"):
+            continue
+        name = filename[:-3]
+        info = _platform_info(os.path.join(platforms_dir, filename))
+        if info is None:
+            # Platforms re-exported from litex (like sim) can't be parsed.
+            if not os.path.exists(os.path.join(TOP_DIR, "targets", name, "Makefile.mk")):
+                continue
+            info = {}
+        info["module"] = "platforms.{}".format(name)
+        info["targets"] = []
+        info["default_target"] = None
+        info["default_cpu"] = DEFAULT_CPU
+        platforms[name] = info
+
+    targets_dir = os.path.join(TOP_DIR, "targets")
+    for name in sorted(os.listdir(targets_dir)):
+        makefile = os.path.join(targets_dir, name, "Makefile.mk")
+        if name not in platforms or not os.path.exists(makefile):
+            continue
+        platforms[name]["targets"] = sorted(
+            f[:-3] for f in os.listdir(os.path.join(targets_dir, name))
+            if f.endswith(".py") and not f.startswith("__"))
+        platforms[name]["default_target"] = _makefile_variable(makefile, "DEFAULT_TARGET")
+        platforms[name]["default_cpu"] = _makefile_variable(makefile, "DEFAULT_CPU") or DEFAULT_CPU
+
+    return platforms
+
+
+def load():
+    """Get the registry, rescanning the sources if the cache is out of date."""
+    fingerprint = _fingerprint()
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+        if cache["version"] == REGISTRY_VERSION and cache["fingerprint"] == fingerprint:
+            return cache["platforms"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    platforms = scan()
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE + ".tmp", "w") as f:
+            json.dump({
+                "version": REGISTRY_VERSION,
+                "fingerprint": fingerprint,
+                "platforms": platforms,
+            }, f, indent=2, sort_keys=True)
+        os.replace(CACHE_FILE + ".tmp", CACHE_FILE)
+    except OSError:
+        pass
+    return platforms
+
+
+def buildable(platforms):
+    """Platforms which have targets."""
+    return [p for p, info in sorted(platforms.items()) if info["targets"]]
+
+
+def check(platform, target):
+    """Returns an error message if the platform / target doesn't exist."""
+    platforms = load()
+    if platform not in platforms:
+        return "Unknown platform {!r}, available platforms: {}".format(
+            platform, ", ".join(buildable(platforms)))
+    targets = platforms[platform]["targets"]
+    if target.lower() not in targets:
+        return "Unknown target {!r} for platform {}, available targets: {}".format(
+            target, platform, ", ".join(targets))
+    return None
+
+
+def print_list(platforms):
+    print("{:20} {:10} {:>10} {:>10}  {}".format(
+        "Platform", "CPU", "Gateware", "Flash", "Targets (* = default)"))
+    print("-"*75)
+    for p in buildable(platforms):
+        info = platforms[p]
+        targets = ["{}{}".format(t, "*" if t == info["default_target"] else "")
+                   for t in info["targets"]]
+        print("{:20} {:10} {:>10} {:>10}  {}".format(
+            p, info["default_cpu"],
+            hex(info["gateware_size"]) if "gateware_size" in info else "-",
+            hex(info["spiflash_total_size"]) if "spiflash_total_size" in info else "-",
+            " ".join(targets)))
+
+
+def print_makefile(platforms):
+    names = buildable(platforms)
+    print("# List of avaliable platforms")
+    print("PLATFORMS = {}".format(" ".join(names)))
+    for p in names:
+        print("# List of avaliable targets for {}".format(p))
+        print("TARGETS_{} = {}".format(p, " ".join(platforms[p]["targets"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--makefile", action="store_true", help="output build/cache.mk contents")
+    parser.add_argument("--json", action="store_true", help="output the registry as JSON")
+    args = parser.parse_args()
+
+    platforms = load()
+    if args.makefile:
+        print_makefile(platforms)
+    elif args.json:
+        json.dump(platforms, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_list(platforms)
+
+
+if __name__ == "__main__":
+    main()